@@ -1,9 +1,14 @@
+import os
+import logging
 import ifcfg
-from . import util
+from . import util, etciface_gen, probe, trace, accounting, survey, logs
 from .core import *
 from .iw import *
 from .wpasup import *
 
+# show what it's doing with a bare logging.basicConfig() (see logs.setup for the daemon)
+logging.getLogger(__name__).setLevel(logging.INFO)
+
 
 def get_ifaces(*ifaces):
     avail = ifcfg.interfaces()
@@ -13,10 +18,10 @@ def get_ifaces(*ifaces):
 
 def get_aps(*ifaces):
     '''List available APs for an interface.'''
-    return {
-        iface: WLan(iface).scan()
+    return ScanCoordinator({
+        iface: WLan(iface)
         for iface in get_ifaces(*(ifaces or ('wlan*',)))
-    }
+    }).scan()
 
 
 def get_ip(*ifaces, key='inet'):
@@ -31,8 +36,7 @@ def get_iface_info(key, *ifaces):
 
 
 def cli():
-    import logging
-    logging.basicConfig()
+    logs.setup(os.getenv('NETSWITCH_LOG_LEVEL', 'INFO'))
 
     import fire
     fire.Fire({
@@ -40,7 +44,20 @@ def cli():
         'aps': get_aps,
         'iface': get_ifaces,
         'connected': internet_connected,
+        'probe': probe.check,
+        'usage': accounting.usage,
+        'survey': survey.survey,
+        'survey-stats': survey.stats,
         'restart': util.restart_iface,
         'wpa': Wpa,
+        'import': import_networks,
+        'etc-interfaces': {
+            'show': etciface_gen.from_config,
+            'diff': etciface_gen.diff_config,
+            'apply': etciface_gen.apply,
+        },
         'run': run,
+        'plan': show_plan,
+        'replay': trace.simulate,
+        'dump-logs': logs.dump_logs,
     })
@@ -0,0 +1,200 @@
+'''Keep track of how much data goes through each interface.
+
+The kernel's byte counters (``/proc/net/dev``) are sampled every check and the
+difference is added to hourly and daily totals, which are saved to a json file
+so they survive restarts (and counters resetting when an interface comes back).
+
+```yaml
+usage_file: /var/lib/netswitch/usage.json
+budgets:
+  ppp*: 2GB             # per month (the last 30 days)
+  wlan1: {day: 500MB}   # or per hour / day / month
+# once an interface is over budget, use this priority instead
+prefer_when_over_budget: [wlan*, eth*, ppp*]
+```
+'''
+import re
+import json
+import fnmatch
+import logging
+from . import util
+
+logger = logging.getLogger(__name__)
+
+PROC_NET_DEV = '/proc/net/dev'
+DEFAULT_FILE = '/var/lib/netswitch/usage.json'
+HOUR, DAY = 3600, 86400
+PERIODS = {'hour': (HOUR, 'hourly', 1), 'day': (DAY, 'daily', 1), 'month': (DAY, 'daily', 30)}
+KEEP = {'hourly': 48, 'daily': 62}  # how many buckets to keep
+
+_UNITS = {'': 1, 'B': 1, 'K': 1e3, 'M': 1e6, 'G': 1e9, 'T': 1e12}
+
+
+def read_counters(fname=PROC_NET_DEV):
+    '''Get the ``(rx, tx)`` byte counters for each interface.'''
+    counters = {}
+    with open(fname, 'r') as f:
+        for line in f.readlines()[2:]:
+            name, _, data = line.partition(':')
+            data = data.split()
+            if len(data) >= 9:
+                counters[name.strip()] = int(data[0]), int(data[8])
+    return counters
+
+
+def parse_size(size):
+    '''Parse a size like ``500MB``, ``1.5G`` or ``1024`` into bytes.'''
+    if isinstance(size, (int, float)):
+        return size
+    m = re.fullmatch(r'\s*([\d.]+)\s*([KMGT]?)i?B?\s*', str(size), re.I)
+    if not m:
+        raise ValueError('Invalid size: {!r}'.format(size))
+    return float(m.group(1)) * _UNITS[m.group(2).upper()]
+
+
+def format_size(n):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(n) < 1000:
+            break
+        n /= 1000.
+    else:
+        unit = 'TB'
+    return '{:.0f}{}'.format(n, unit) if unit == 'B' else '{:.1f}{}'.format(n, unit)
+
+
+class Usage:
+    '''Rolling per-interface traffic totals.
+
+    Arguments:
+        fname (str): where to save the totals. None keeps them in memory.
+        save_interval (float): don't write the file more often than this.
+    '''
+    def __init__(self, fname=None, save_interval=60):
+        self.fname = fname
+        self.save_interval = save_interval
+        self.hourly = {}  # {iface: {hour: bytes}}
+        self.daily = {}   # {iface: {day: bytes}}
+        self.rates = {}   # {iface: (rx, tx) bytes/s}, from the last two samples
+        self._last = {}   # {iface: (rx, tx)}
+        self._last_t = None
+        self._saved_t = None
+        if fname:
+            self.load()
+
+    def __repr__(self):
+        return '<{} {}>'.format(self.__class__.__name__, self.fname or '(memory)')
+
+    def sample(self, counters=None, t=None):
+        '''Add the traffic since the last sample to the totals.'''
+        counters = read_counters() if counters is None else counters
+        t = util.clock.time() if t is None else t
+        dt = t - self._last_t if self._last_t is not None else None
+        hour, day = int(t // HOUR), int(t // DAY)
+        rates = {}
+        for iface, (rx, tx) in counters.items():
+            prev = self._last.get(iface)
+            if prev is None:
+                continue
+            # the counters reset if the interface went away and came back
+            drx = rx - prev[0] if rx >= prev[0] else rx
+            dtx = tx - prev[1] if tx >= prev[1] else tx
+            if drx or dtx:
+                h = self.hourly.setdefault(iface, {})
+                h[hour] = h.get(hour, 0) + drx + dtx
+                d = self.daily.setdefault(iface, {})
+                d[day] = d.get(day, 0) + drx + dtx
+            if dt:
+                rates[iface] = drx / dt, dtx / dt
+        self.rates = rates
+        self._last, self._last_t = dict(counters), t
+        self._prune(hour, day)
+        self.save(t)
+
+    def total(self, iface, period='day', t=None):
+        '''How many bytes went through an interface in the last hour / day / month.'''
+        size, attr, n = PERIODS[period]
+        now = int((util.clock.time() if t is None else t) // size)
+        buckets = getattr(self, attr).get(iface, {})
+        return sum(b for k, b in buckets.items() if now - n < k <= now)
+
+    def over_budget(self, budgets, t=None):
+        '''Which interfaces are over their budget. ``budgets`` is
+        ``{pattern: size}`` (per month) or ``{pattern: {period: size}}``.'''
+        over = set()
+        for iface in set(self.hourly) | set(self.daily):
+            for pat, budget in (budgets or {}).items():
+                if not fnmatch.fnmatch(iface, pat):
+                    continue
+                if not isinstance(budget, dict):
+                    budget = {'month': budget}
+                if any(self.total(iface, p, t) >= parse_size(b) for p, b in budget.items()):
+                    over.add(iface)
+        return over
+
+    def summary(self, t=None):
+        return {
+            iface: {
+                'hour': self.total(iface, 'hour', t),
+                'day': self.total(iface, 'day', t),
+                'month': self.total(iface, 'month', t),
+                'rate': self.rates.get(iface),
+            }
+            for iface in sorted(set(self.hourly) | set(self.daily) | set(self.rates))
+        }
+
+    def _prune(self, hour, day):
+        for attr, now in (('hourly', hour), ('daily', day)):
+            for buckets in getattr(self, attr).values():
+                for k in [k for k in buckets if k <= now - KEEP[attr]]:
+                    del buckets[k]
+
+    # persistence
+
+    def load(self, fname=None):
+        fname = fname or self.fname
+        try:
+            with open(fname, 'r') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning('Could not load usage from %s: %s', fname, e)
+            return
+        for attr in ('hourly', 'daily'):
+            setattr(self, attr, {
+                iface: {int(k): v for k, v in buckets.items()}
+                for iface, buckets in data.get(attr, {}).items()})
+        # so the traffic from the last save until the restart isn't lost
+        self._last = {iface: tuple(c) for iface, c in data.get('last', {}).items()}
+        self._last_t = data.get('last_t')
+
+    def save(self, t=None, force=False):
+        '''Write the totals to the file, at most every ``save_interval`` seconds
+        (unless ``force``). Returns whether it was written.'''
+        t = util.clock.time() if t is None else t
+        if not self.fname or not force and self._saved_t is not None and t - self._saved_t < self.save_interval:
+            return False
+        util.atomic_write(self.fname, json.dumps({
+            'hourly': self.hourly, 'daily': self.daily,
+            'last': self._last, 'last_t': self._last_t}, sort_keys=True))
+        self._saved_t = t
+        return True
+
+
+def usage(*ifaces, fname=DEFAULT_FILE, interval=1):
+    '''Show data usage per interface (hour / day / month) and the current rates.'''
+    u = Usage()  # don't write to the file the daemon is keeping
+    if fname:
+        u.load(fname)
+    u.sample()
+    util.clock.sleep(interval)
+    u.sample()
+    lines = ['{:<10} {:>10} {:>10} {:>10} {:>12} {:>12}'.format(
+        'iface', 'hour', 'day', 'month', 'rx/s', 'tx/s')]
+    for iface, d in u.summary().items():
+        if ifaces and not util.matches(ifaces, [iface]):
+            continue
+        rx, tx = d['rate'] or (0, 0)
+        lines.append('{:<10} {:>10} {:>10} {:>10} {:>12} {:>12}'.format(
+            iface, *(format_size(x) for x in (d['hour'], d['day'], d['month'], rx, tx))))
+    return '\n'.join(lines)
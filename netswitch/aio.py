@@ -0,0 +1,388 @@
+'''NetSwitch for asyncio applications.
+
+Scans, probes and restarts run as asyncio subprocesses and sockets instead of
+blocking a thread, so many checks and probes can share one event loop. The
+policy is the same as the sync classes (the async ones subclass them).
+
+```
+witch = AsyncNetSwitch(config)
+
+async def main():
+    connected = await witch.check(timeout=60)
+    await witch.run(interval=20)
+```
+
+Cancelling a task kills any subprocess it was waiting on.
+'''
+import math
+import socket
+import struct
+import inspect
+import asyncio
+import logging
+import access_points
+from . import util, probe, wpasup, sdnotify, commands
+from .iw import WLan, ScanCoordinator, tag_frequencies
+from .core import NetSwitch
+from .ifaces import Eth, PPP
+
+logger = logging.getLogger(__name__)
+
+
+async def run_cmd(cmd, timeout=None, stderr=True):
+    '''Run a command (an argv list) through ``commands.arun`` and return
+    ``(returncode, stdout)`` (with stderr after it, if ``stderr``). Raises
+    ``asyncio.TimeoutError`` if it took longer than ``timeout``.'''
+    result = await commands.arun(cmd, timeout=timeout)
+    if result.timed_out:
+        raise asyncio.TimeoutError('{} timed out after {:.0f}s'.format(cmd[0], result.dt))
+    return result.returncode, result.stdout + (result.stderr if stderr else b'')
+
+
+# probes
+
+async def check(iface=None, targets=None, quorum=None, timeout=None):
+    '''Async ``probe.check``: returns as soon as ``quorum`` probes succeed or
+    that can't happen anymore. The other probes are cancelled.'''
+    probes = [probe.parse(t) for t in util.flatten(targets or probe.defaults['targets'])]
+    quorum = max(1, min(quorum or probe.defaults['quorum'], len(probes)))
+    timeout = timeout or probe.defaults['timeout']
+    if not probes:
+        return False
+
+    tasks = [asyncio.ensure_future(_run(p, iface, timeout)) for p in probes]
+    ok = failed = 0
+    try:
+        for fut in asyncio.as_completed(tasks, timeout=timeout + 1):
+            if await fut:
+                ok += 1
+            else:
+                failed += 1
+            if ok >= quorum:
+                return True
+            if failed > len(probes) - quorum:
+                return False
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        for t in tasks:
+            t.cancel()
+    return False
+
+internet_connected = check
+
+
+async def _run(p, iface, timeout):
+    try:
+        return bool(await asyncio.wait_for(PROBES[p.kind](p.target, iface=iface, timeout=timeout), timeout))
+    except (OSError, ValueError, struct.error, asyncio.TimeoutError) as e:
+        logger.debug('Probe %s (%s) failed: (%s) %s', p, iface, type(e).__name__, e)
+        return False
+
+
+async def icmp(host, iface=None, timeout=probe.DEFAULT_TIMEOUT, n=1, reliability=0.5):
+    wait = str(max(1, math.ceil(timeout)))
+    cmd = ['ping', '-c', str(n), '-W', wait, '-w', wait] + (['-I', iface] if iface else []) + [host]
+    _, out = await run_cmd(cmd, timeout=timeout + 1)
+    matches = probe._packet_loss.search(out.decode('utf-8', 'replace'))
+    return bool(matches) and float(matches.groups()[0])/100 < reliability
+
+
+async def tcp(target, iface=None, timeout=probe.DEFAULT_TIMEOUT):
+    host, port = probe._host_port(target, 80)
+    with await _connect(host, port, iface):
+        return True
+
+
+async def dns(target, iface=None, timeout=probe.DEFAULT_TIMEOUT, name='example.com'):
+    host, port = probe._host_port(target, 53)
+    qid, query = probe._dns_query(name)
+    loop = asyncio.get_running_loop()
+    with await _connect(host, port, iface, socket.SOCK_DGRAM) as s:
+        await loop.sock_sendall(s, query)
+        resp = await loop.sock_recv(s, 512)
+    return probe._dns_ok(qid, resp)
+
+
+async def http(url, iface=None, timeout=probe.DEFAULT_TIMEOUT, status=204):
+    u, request = probe._http_request(url)
+    loop = asyncio.get_running_loop()
+    with await _connect(u.hostname, u.port or 80, iface) as s:
+        await loop.sock_sendall(s, request)
+        resp = await loop.sock_recv(s, 128)
+    return probe._http_ok(resp, status)
+
+
+PROBES = {'icmp': icmp, 'tcp': tcp, 'dns': dns, 'http': http}
+
+
+async def _connect(host, port, iface, kind=socket.SOCK_STREAM):
+    loop = asyncio.get_running_loop()
+    addr = (await loop.getaddrinfo(host, port, type=kind))[0]
+    s = socket.socket(addr[0], kind)
+    try:
+        s.setblocking(False)
+        probe._bind(s, iface)
+        await loop.sock_connect(s, addr[4])
+    except BaseException:
+        s.close()
+        raise
+    return s
+
+
+# interfaces
+
+async def ifup(name, sleep=1, timeout=30):
+    return await _ifconfig(name, 'up', sleep, timeout)
+
+
+async def ifdown(name, sleep=1, timeout=30):
+    return await _ifconfig(name, 'down', sleep, timeout)
+
+
+async def _ifconfig(name, cmd, sleep=1, timeout=30):
+    code, out = await run_cmd(['ifconfig', name, cmd], timeout=timeout)
+    if code:
+        logger.error(out.decode('utf-8', 'replace'))
+        return False
+    await asyncio.sleep(sleep)
+    return True
+
+
+async def restart_iface(name, sleep=3, timeout=None):
+    logger.info("Restarting Interface: %s", name)
+    deadline = util.Deadline(timeout)
+    if timeout is not None:
+        sleep = min(sleep, timeout / 4.)
+    went_down = await ifdown(name, sleep, timeout=deadline.remaining(30, floor=1))
+    back_up = await ifup(name, sleep, timeout=deadline.remaining(30, floor=1))
+    return went_down and back_up
+
+
+async def wpa_reconfigure(name, timeout=10):
+    logger.info("Reconfiguring wpa_supplicant: %s", name)
+    code, out = await run_cmd(['wpa_cli', '-i', name, 'reconfigure'], timeout=timeout)
+    if code:
+        logger.error(out.decode('utf-8', 'replace'))
+        return False
+    return True
+
+
+# wpa supplicant
+
+async def wpa_connect(wpa, backup=True, restart=True, reconfigure=False, timeout=None, **keys):
+    '''Async ``Wpa.connect``.'''
+    installed = wpa.install(backup, **keys)
+    if installed is None:
+        return True
+    if not installed or not restart:
+        return installed
+    return (
+        reconfigure and await wpa_reconfigure(wpa.iface, timeout=timeout or 10)
+        or await restart_iface(wpa.iface, timeout=timeout))
+
+
+async def connect(ssid, verify=False, timeout=None, iface='wlan0', **keys):
+    '''Async ``wpasup.connect``.'''
+    return await wpa_connect(wpasup.Wpa(ssid, iface=iface), timeout=timeout, **keys) and (
+        not verify or wpasup.verify_ssid(ssid, iface))
+
+
+# wifi
+
+class AsyncWLan(WLan):
+    '''A WLan whose scans, connects and probes are coroutines.'''
+    async def scan(self, trusted=None, timeout=None):
+        t0 = util.clock.time()
+        _, out = await run_cmd(
+            self.scan_argv(), timeout=self.scan_timeout if timeout is None else timeout, stderr=False)
+        out = access_points.ensure_str(out)
+        return self._scanned(tag_frequencies(self.wifi_scanner.parse_output(out), out), t0, trusted)
+
+    def start_scanning(self, interval=None, window=None):
+        # the scans from the rest of the cycle are shared by the coordinator instead
+        logger.warning('[%s] Background scanning is not supported with asyncio.', self.iface)
+
+    async def ap_available(self, ap):
+        return any(1 for ap_i in await self.scan() if ap in ap_i.ssid)
+
+    async def select_best_ssid(self, ssids=None, top=0.6, return_all=False, nscans=5, **kw):
+        self._log_checking(ssids)
+        top_seen, all_seen = await self._get_top_ssids(ssids, nscans=nscans, **kw)
+        out_ap = self._best_ssid(top_seen, nscans, top)
+        return (out_ap, all_seen) if return_all else out_ap
+
+    async def _scans(self, nscans=5, throttle=1, timeout=30):
+        if self.coordinator is not None and self.iface in self.coordinator.radios:
+            for scan in await self.coordinator.get_rounds(nscans, throttle=throttle, timeout=timeout):
+                yield scan.get(self.iface) or []
+            return
+
+        t0 = util.clock.time()
+        for i in range(nscans):
+            yield await self.scan(timeout=self._scan_command_timeout(self.deadline))
+            await asyncio.sleep(throttle)
+            if timeout and util.clock.time() - t0 >= timeout or self.deadline.expired:
+                break
+
+    async def _get_top_ssids(self, ssids=None, nscans=5, throttle=1, timeout=30, nfails=3):
+        all_seen, top_seen = set(), []
+        async for aps in self._scans(nscans, throttle=throttle, timeout=timeout):
+            self._tally(aps, ssids, nfails, top_seen, all_seen)
+        return top_seen, all_seen
+
+    async def connect(self, ssids='*', test=False, nscans=5, top=0.6, throttle=1, timeout=30, nfails=3,
+                      trusted=None, deadline=None, pin_bssid=False, band=None, roam_margin=8, band_bonus=10,
+                      **kw):
+        current = self._start_connect(deadline)
+        originally_connected = await self.probe()
+        ssids = self._connect_ssids(ssids, trusted)
+        if not ssids:
+            return
+
+        ssid = await self.select_best_ssid(
+            ssids, top=top, nscans=nscans, throttle=throttle, nfails=nfails,
+            timeout=self._select_timeout(timeout))
+        if not ssid:
+            logger.info('[%s] No ssid matches.', self.iface)
+            return
+
+        self._pin, bssid = self._choose_pin(ssid, pin_bssid, band, roam_margin, band_bonus)
+        connected = test or await self.activate(ssid)
+        if not connected and self._revert(ssid, current, originally_connected):
+            ssid, bssid = current, None
+            connected = test or await self.activate(ssid)
+        return self._finish_connect(ssid, bssid, connected)
+
+    async def activate(self, ssid):
+        t0 = util.clock.time()
+        connected = await connect(
+            ssid, verify=True, timeout=self.deadline.remaining(floor=1), iface=self.iface, **self._pin)
+        return self._traced('connect', ssid, connected, t0)
+
+    async def probe(self):
+        t0 = util.clock.time()
+        connected = await check(
+            self.iface, timeout=self.deadline.remaining(probe.defaults['timeout'], floor=1))
+        return self._traced('probe', self.ssid, connected, t0)
+
+
+class AsyncScanCoordinator(ScanCoordinator):
+    '''Scan radios concurrently on the event loop and share the rounds.'''
+    def __init__(self, radios=None):
+        super().__init__(radios)
+        self._alock = asyncio.Lock()
+
+    async def scan(self, ifaces=None):
+        radios = [(i, self.radios[i]) for i in ifaces or self.radios]
+        results = await asyncio.gather(*(self._scan(i, w) for i, w in radios))
+        return {i: aps for (i, _), aps in zip(radios, results)}
+
+    async def _scan(self, iface, wlan):
+        try:
+            aps = await wlan.scan(timeout=wlan._scan_command_timeout(self.deadline))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning('[%s] Scan failed: (%s) %s', iface, type(e).__name__, e)
+            return []
+        for ap in aps:
+            ap['radio'] = iface
+        return aps
+
+    async def get_rounds(self, n=5, throttle=1, timeout=30):
+        async with self._alock:
+            t0 = util.clock.time()
+            while len(self.rounds) < n:
+                if self.rounds:
+                    await asyncio.sleep(throttle)
+                self.rounds.append(await self.scan())
+                if timeout and util.clock.time() - t0 >= timeout or self.deadline.expired:
+                    break
+            return self.rounds[:n]
+
+
+# the switch
+
+class AsyncNetSwitch(NetSwitch):
+    '''``NetSwitch`` with ``check``, ``run`` and ``connect`` as coroutines.'''
+    backends = [('wlan*', AsyncWLan), ('eth*', Eth), ('ppp*', PPP)]
+
+    def __init__(self, *a, **kw):
+        super().__init__(*a, **kw)
+        self.scans = AsyncScanCoordinator()
+
+    async def check(self, timeout=None):
+        '''Check internet connections and interfaces. Return True if connected.
+
+        Each stage gets what's left of ``cycle_budget`` (see ``NetSwitch.check``).
+        If it takes longer than ``timeout`` seconds, the check is cancelled
+        and counts as not connected.'''
+        self.config.refresh()
+        self.start()
+        self.deadline = util.Deadline(self.cycle_budget if timeout is None else timeout)
+        self.hooks.emit('cycle_start')
+        t0, active = util.clock.time(), self.active
+        try:
+            connected = await asyncio.wait_for(self._check(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning('Check timed out after %ss.', timeout)
+            self.active, connected = None, False
+        return self._checked(connected, active, t0)
+
+    async def _check(self):
+        # ifcfg runs ifconfig / ip, so don't block the loop on it
+        interfaces, plan = await asyncio.get_running_loop().run_in_executor(None, self._begin_check)
+        if self.arbitration == 'score':
+            return await self._arbitrate(plan, interfaces)
+        for rank, step, ifup in self._steps(plan, interfaces):
+            if ifup:
+                await self._ifup(step.iface)
+            if await self.connect(step.iface, **self._connect_kw(step)) and (
+                    not step.require_internet or await self._probe(step.iface)):
+                return self._connected(step)
+        self.active = None
+        return await self._probe()
+
+    async def _arbitrate(self, plan, interfaces):
+        tried = {}
+        for rank, step, ifup in self._steps(plan, interfaces, tried):
+            if ifup:
+                await self._ifup(step.iface)
+            self._tried(tried, rank, step, await self.connect(step.iface, **self._connect_kw(step)) and (
+                not step.require_internet or await self._probe(step.iface)))
+        return self._pick(tried, len(plan)) or await self._probe()
+
+    async def run(self, interval=None, timeout=None):
+        interval = self.interval if interval is None else interval
+        self.notifier = self.notifier or sdnotify.Notifier()
+        self.notifier.starting(2 * (timeout or self.cycle_budget or sdnotify.CHECK_TIME))
+        await asyncio.get_running_loop().run_in_executor(None, self.summary)
+        while True:
+            t0 = util.clock.time()
+            connected = await self.check(timeout=timeout)
+            self.notifier.cycle(self.status(connected))
+            await self._sleep(max(0, interval - (util.clock.time() - t0)))
+
+    async def _sleep(self, seconds):
+        step = self.notifier.watchdog / 2. if self.notifier.watchdog else seconds
+        while seconds > 0:
+            await asyncio.sleep(min(step, seconds))
+            seconds -= step
+            if seconds > 0:
+                self.notifier.ping()
+
+    async def connect(self, iface, **kw):
+        connect = getattr(self._get_obj(iface), 'connect', None)
+        if not callable(connect):
+            return True
+        result = connect(**kw)
+        return await result if inspect.isawaitable(result) else result
+
+    async def _ifup(self, iface):
+        return await ifup(iface, timeout=self.deadline.remaining(30, floor=1))
+
+    async def _probe(self, iface=None):
+        t0 = util.clock.time()
+        connected = not self._skip_probe(iface) and await check(iface, timeout=self._probe_timeout())
+        return self._probed(iface, connected, t0)
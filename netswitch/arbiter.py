@@ -0,0 +1,103 @@
+'''Pick a link by score instead of by first match.
+
+In the default (``first``) mode, a check stops at the first config entry that
+connects, so a lossy eth0 always beats a good wlan0 and a single failed probe
+sends the device down the list and back. In ``score`` mode every interface in
+the plan is tried and scored:
+
+    score = priority * w_priority + quality * w_quality - cost * w_cost
+
+ - ``priority`` - 1 for the first step of the plan, down towards 0 for the last
+ - ``quality`` - a moving average of that interface's probe results (0 - 1)
+ - ``cost`` - from the ``costs`` config (e.g. ``{'ppp*': 1}``), +1 if it's over
+   its data budget
+
+And we only move off of a working link when another one beats it by
+``margin`` for ``dwell`` seconds.
+
+```yaml
+arbitration: score
+arbitration_margin: 0.2
+arbitration_dwell: 30
+costs: {ppp*: 0.5}
+```
+'''
+import logging
+from collections import namedtuple
+from . import util
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WEIGHTS = {'priority': 1., 'quality': 2., 'cost': 1.}
+
+
+class Score(namedtuple('Score', 'iface ssid ok priority quality cost score')):
+    def as_dict(self):
+        return self._asdict()
+
+
+class Arbiter:
+    '''Score candidate links and decide when to switch between them.
+
+    Arguments:
+        margin (float): how much better a candidate has to score than the current link.
+        dwell (float): how many seconds it has to stay that much better before we switch.
+        weights (dict): the ``priority``, ``quality`` and ``cost`` weights.
+        alpha (float): how much each probe moves an interface's quality.
+    '''
+    def __init__(self, margin=0.2, dwell=30, weights=None, alpha=0.3):
+        self.margin = margin
+        self.dwell = dwell
+        self.weights = dict(DEFAULT_WEIGHTS, **(weights or {}))
+        self.alpha = alpha
+        self.quality = {}
+        self.scores = []        # the last round of scores, best first
+        self.challenger = None  # (iface, since) - who's been beating the current link
+        self.reason = None      # why the last choice was made
+
+    def observe(self, iface, ok):
+        '''Fold a probe result into an interface's quality.'''
+        prev = self.quality.get(iface)
+        self.quality[iface] = float(ok) if prev is None else (
+            self.alpha * float(ok) + (1 - self.alpha) * prev)
+        return self.quality[iface]
+
+    def score(self, iface, ssid=None, ok=True, rank=0, n=1, cost=0):
+        '''Score a candidate at position ``rank`` of ``n`` in the plan.'''
+        priority = 1 - rank / float(max(n, 1))
+        quality = self.quality.get(iface, float(ok))
+        w = self.weights
+        score = priority * w['priority'] + quality * w['quality'] - cost * w['cost']
+        return Score(iface, ssid, bool(ok), round(priority, 3), round(quality, 3), cost, round(score, 3))
+
+    def choose(self, scores, current=None):
+        '''Pick the candidate to use. ``current`` is the iface we're using now.'''
+        self.scores = sorted(scores, key=lambda s: s.score, reverse=True)
+        up = [s for s in self.scores if s.ok]
+        if not up:
+            self.challenger, self.reason = None, 'nothing is up'
+            return None
+        best = up[0]
+        now = next((s for s in up if s.iface == current), None)
+        if now is None:
+            self.challenger, self.reason = None, 'the current link is down' if current else 'first link'
+            return best
+        if best.iface == now.iface or best.score < now.score + self.margin:
+            self.challenger, self.reason = None, 'staying'
+            return now
+        # someone's better - but have they been for long enough?
+        t = util.clock.time()
+        if self.challenger is None or self.challenger[0] != best.iface:
+            self.challenger = best.iface, t
+        if t - self.challenger[1] < self.dwell:
+            self.reason = '{} is better ({} vs {}), waiting {:.0f}s'.format(
+                best.iface, best.score, now.score, self.dwell - (t - self.challenger[1]))
+            return now
+        self.challenger, self.reason = None, '{} has been better for {}s'.format(best.iface, self.dwell)
+        return best
+
+    def summary(self):
+        return '\n'.join(
+            '{:<8} {:<16} ok={:<5} priority={:.2f} quality={:.2f} cost={} score={}'.format(
+                s.iface, str(s.ssid or ''), str(s.ok), s.priority, s.quality, s.cost, s.score)
+            for s in self.scores) + '\n({})'.format(self.reason)
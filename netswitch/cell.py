@@ -48,6 +48,12 @@ class Cell(serial.Serial):
             value = int(msg.split(': ')[1].split(',')[0].strip())
             return 2 * value - 112
 
+    @property
+    def registered(self):
+        '''Is the modem registered on the network (home or roaming)?'''
+        msg = self.ping() and self.send("AT+CREG?")
+        return creg_registered(msg) if isinstance(msg, str) else False
+
     @property
     def ccid(self):
         '''Return SIM CCID.'''
@@ -118,6 +124,20 @@ def sim_ccid(com_device=DEFAULT_DEVICE):
     with Cell.find_device(com_device) as cell:
         return cell.ccid
 
+def creg_registered(msg):
+    '''Parse an ``AT+CREG?`` reply: ``+CREG: <n>,<stat>[,<lac>,<ci>[,<act>]]``.
+    stat 1 is registered (home), 5 is registered (roaming).'''
+    line = next((l for l in msg.splitlines() if l.strip().startswith('+CREG:')), '')
+    fields = [f.strip() for f in line.split(':', 1)[-1].split(',')] if line else []
+    # an unsolicited result code leaves out <n> (so the quoted <lac> comes second)
+    stat = fields[1] if len(fields) > 1 and not fields[1].startswith('"') else (fields[0] if fields else None)
+    return stat in ('1', '5')
+
+
+def registered(com_device=DEFAULT_DEVICE_PATTERN):
+    with Cell.find_device(com_device) as cell:
+        return cell.registered
+
 
 if __name__ == '__main__':
     import fire
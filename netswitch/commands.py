@@ -0,0 +1,291 @@
+'''Run external commands (ping, ifconfig, wpa_cli, iwlist, systemctl, ...).
+
+Everything goes through ``run`` (or ``arun`` from asyncio) so that:
+
+ - commands are exec'd from an argv list (no shell)
+ - every command has a deadline, and is killed (with its children) if it
+   doesn't finish in time, so a hung ``ping`` can't freeze the daemon
+ - identical commands running at the same time (e.g. two threads scanning the
+   same radio) share one run
+ - the duration and exit status of each command is kept in ``metrics()``
+
+For tests (and benchmarks), swap in a fake executor:
+
+```
+fake = commands.FakeExecutor({('ifconfig', 'wlan0', 'up'): 0, 'ping': b'0% packet loss'})
+with commands.use_executor(fake):
+    netswitch.util.ifup('wlan0')
+fake.calls  # [('ifconfig', 'wlan0', 'up')]
+```
+'''
+import os
+import time
+import signal
+import asyncio
+import logging
+import threading
+import subprocess
+from collections import namedtuple
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TIMEOUT = 30
+
+
+class Result(namedtuple('Result', 'argv returncode stdout stderr dt timed_out')):
+    '''The outcome of a command. ``stdout`` and ``stderr`` are bytes.'''
+    @property
+    def ok(self):
+        return self.returncode == 0 and not self.timed_out
+
+    @property
+    def text(self):
+        return self.stdout.decode('utf-8', 'replace')
+
+    @property
+    def error(self):
+        return (self.stderr or self.stdout).decode('utf-8', 'replace').strip() or (
+            'timed out after {:.0f}s'.format(self.dt) if self.timed_out else
+            'exit status {}'.format(self.returncode))
+
+    def check(self):
+        '''Raise if the command failed (like ``subprocess.run(check=True)``).'''
+        if self.timed_out:
+            raise subprocess.TimeoutExpired(self.argv, self.dt, self.stdout, self.stderr)
+        if self.returncode != 0:
+            raise subprocess.CalledProcessError(self.returncode, self.argv, self.stdout, self.stderr)
+        return self
+
+
+class Executor:
+    '''Run commands as subprocesses.'''
+    def __call__(self, argv, timeout=None):
+        t0 = time.monotonic()
+        try:
+            proc = subprocess.Popen(
+                argv, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE, start_new_session=True)
+        except OSError as e:  # e.g. the command isn't installed
+            return Result(tuple(argv), 127, b'', str(e).encode(), time.monotonic() - t0, False)
+        timed_out = False
+        try:
+            out, err = proc.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            timed_out = True
+            _kill(proc)
+            out, err = proc.communicate()
+        except BaseException:
+            _kill(proc)
+            proc.wait()
+            raise
+        return Result(tuple(argv), proc.returncode, out, err, time.monotonic() - t0, timed_out)
+
+    async def arun(self, argv, timeout=None):
+        '''Like calling it, but as an asyncio subprocess (killed if we're cancelled).'''
+        t0 = time.monotonic()
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                *argv, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE, start_new_session=True)
+        except OSError as e:
+            return Result(tuple(argv), 127, b'', str(e).encode(), time.monotonic() - t0, False)
+        timed_out = False
+        try:
+            out, err = await asyncio.wait_for(proc.communicate(), timeout)
+        except asyncio.TimeoutError:
+            timed_out = True
+            _kill(proc)
+            out, err = await proc.communicate()
+        except BaseException:
+            _kill(proc)
+            await proc.wait()
+            raise
+        return Result(tuple(argv), proc.returncode, out or b'', err or b'', time.monotonic() - t0, timed_out)
+
+
+def _kill(proc):
+    try:  # the whole process group, so e.g. sudo's child goes too
+        os.killpg(proc.pid, signal.SIGKILL)
+    except OSError:
+        proc.kill()
+
+
+class FakeExecutor:
+    '''Answer commands from a table instead of running them.
+
+    ``responses`` maps an argv tuple (or just the program name) to a return
+    code, stdout (str / bytes), a ``Result``, or a function ``f(argv)``
+    returning one of those. Everything run is recorded in ``calls``.
+    '''
+    def __init__(self, responses=None, default=0, delay=0):
+        self.responses = dict(responses or {})
+        self.default = default
+        self.delay = delay
+        self.calls = []
+
+    def __call__(self, argv, timeout=None):
+        if self.delay:
+            time.sleep(self.delay)
+        return self._respond(argv)
+
+    async def arun(self, argv, timeout=None):
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        return self._respond(argv)
+
+    def _respond(self, argv):
+        argv = tuple(argv)
+        self.calls.append(argv)
+        resp = self.responses.get(argv, self.responses.get(argv[0], self.default))
+        if callable(resp):
+            resp = resp(argv)
+        if isinstance(resp, Result):
+            return resp
+        if isinstance(resp, (str, bytes)):
+            return Result(argv, 0, resp.encode() if isinstance(resp, str) else resp, b'', self.delay, False)
+        return Result(argv, resp, b'', b'', self.delay, False)
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+
+
+class Runner:
+    '''Run commands with deadlines, sharing identical concurrent runs.'''
+    def __init__(self, executor=None, timeout=DEFAULT_TIMEOUT):
+        self.executor = executor or Executor()
+        self.timeout = timeout
+        self._inflight = {}
+        self._ainflight = {}
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def run(self, argv, timeout=None, check=False, dedup=True):
+        '''Run a command and return a ``Result``.
+
+        Arguments:
+            argv (list): the command and its arguments.
+            timeout (float): kill the command after this many seconds.
+            check (bool): raise ``CalledProcessError`` / ``TimeoutExpired`` if it failed.
+            dedup (bool): if the same command is already running, wait for that
+                one instead of starting another.
+        '''
+        argv = tuple(str(a) for a in argv)
+        timeout = self.timeout if timeout is None else timeout
+        with self._lock:
+            call = self._inflight.get(argv) if dedup else None
+            leader = call is None
+            if leader:
+                call = _Call()
+                if dedup:
+                    self._inflight[argv] = call
+
+        if leader:
+            try:
+                call.result = result = self.executor(argv, timeout)
+            finally:
+                if dedup:
+                    with self._lock:
+                        self._inflight.pop(argv, None)
+                call.done.set()
+            self._record(result)
+        else:
+            with self._lock:
+                self._metric(argv[0])['deduped'] += 1
+            if call.done.wait(timeout) and call.result is not None:
+                result = call.result
+            else:
+                result = Result(argv, None, b'', b'', timeout, not call.done.is_set())
+        return result.check() if check else result
+
+    async def arun(self, argv, timeout=None, check=False, dedup=True):
+        '''``run`` for asyncio: the command runs as an asyncio subprocess (if
+        the executor has an ``arun``) and is killed if we're cancelled. Identical
+        commands are shared between tasks, the same as ``run`` does for threads.'''
+        argv = tuple(str(a) for a in argv)
+        timeout = self.timeout if timeout is None else timeout
+        fut = self._ainflight.get(argv) if dedup else None
+        if fut is None:
+            fut = asyncio.ensure_future(self._arun(argv, timeout))
+            if dedup:
+                self._ainflight[argv] = fut
+                fut.add_done_callback(lambda f: self._ainflight.pop(argv, None))
+            result = await fut
+        else:
+            with self._lock:
+                self._metric(argv[0])['deduped'] += 1
+            try:
+                result = await asyncio.shield(fut)
+            except asyncio.CancelledError:
+                if not fut.cancelled():  # it's us that was cancelled
+                    raise
+                result = Result(argv, None, b'', b'', timeout, True)
+        return result.check() if check else result
+
+    async def _arun(self, argv, timeout):
+        arun = getattr(self.executor, 'arun', None)
+        if arun is not None:
+            result = await arun(argv, timeout)
+        else:  # a plain callable - run it in a thread
+            result = await asyncio.get_running_loop().run_in_executor(None, self.executor, argv, timeout)
+        self._record(result)
+        return result
+
+    def _record(self, result):
+        with self._lock:
+            m = self._metric(result.argv[0])
+            m['count'] += 1
+            m['time'] += result.dt
+            m['max_time'] = max(m['max_time'], result.dt)
+            m['last_status'] = result.returncode
+            if result.timed_out:
+                m['timeouts'] += 1
+            elif not result.ok:
+                m['failures'] += 1
+        if result.timed_out:
+            logger.warning('Command timed out after %.1fs: %s', result.dt, ' '.join(result.argv))
+        logger.debug('Ran (%.2fs, status %s): %s', result.dt, result.returncode, ' '.join(result.argv))
+
+    def _metric(self, name):
+        # call with the lock held
+        return self._metrics.setdefault(name, dict(
+            count=0, failures=0, timeouts=0, deduped=0, time=0., max_time=0., last_status=None))
+
+    def metrics(self):
+        '''``{program: {count, failures, timeouts, deduped, time, max_time, last_status}}``'''
+        with self._lock:
+            return {k: dict(m) for k, m in self._metrics.items()}
+
+    def reset_metrics(self):
+        with self._lock:
+            self._metrics.clear()
+
+
+runner = Runner()
+
+
+def run(argv, timeout=None, check=False, dedup=True):
+    '''Run a command with the default runner (see ``Runner.run``).'''
+    return runner.run(argv, timeout=timeout, check=check, dedup=dedup)
+
+
+async def arun(argv, timeout=None, check=False, dedup=True):
+    '''Run a command with the default runner, from asyncio (see ``Runner.arun``).'''
+    return await runner.arun(argv, timeout=timeout, check=check, dedup=dedup)
+
+
+def metrics():
+    return runner.metrics()
+
+
+@contextmanager
+def use_executor(executor):
+    '''Temporarily run commands with a different executor (e.g. a ``FakeExecutor``).'''
+    prev, runner.executor = runner.executor, executor
+    try:
+        yield executor
+    finally:
+        runner.executor = prev
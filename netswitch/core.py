@@ -1,16 +1,19 @@
 import os
-import time
+import glob
 import functools
-import fnmatch
 import ifcfg
 import yaml
-from . import iw, wpasup, util
+from . import iw, wpasup, util, probe, accounting, survey, sdnotify, linkstate, logs
+from .arbiter import Arbiter, DEFAULT_WEIGHTS
+from .ppp import Dialer
+from .hooks import Hooks
+from .plan import compile_plan, prefer
+from .ifaces import IfaceManager, Eth, PPP, get_backend
 from .util import internet_connected
 
 import logging
 
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
 
 
 def log_kw(msg):
@@ -18,7 +21,7 @@ def log_kw(msg):
         msg_ = msg or func.__name__
         @functools.wraps(func)
         def inner(*a, **kw):
-            logger.info('{}: {}'.format(msg_, kw))
+            logger.info('%s: %s', msg_, kw)
             return func(*a, **kw)
         return inner
     return outer(msg) if callable(msg) else outer
@@ -53,34 +56,100 @@ class NetSwitch:
      - check if internet is already connected thru any interface
 
     '''
-    _iface_objs = {}  # cache at a class level - move if iw.Wlan gets more specific
+    backends = [('wlan*', iw.WLan), ('eth*', Eth), ('ppp*', PPP)]
     restart_missing_ip = False
     interfaces = ()
     interval = 0
+    cycle_budget = None  # seconds a check can take (None - no limit)
+    deadline = util.Deadline()  # the current check's deadline
+    scan_interval = None  # scan wifi in the background every n seconds
+    scan_window = 30
+    active = None     # the (iface, ssid) we're connected through
+    connected = None  # the result of the last check
+    trace = None   # a trace.Trace, when recording
+    notifier = None  # a sdnotify.Notifier, to tell systemd we're alive
+    scan_store = None  # a survey.ScanStore, to keep every scan
+    _networks = frozenset()  # ssids generated from the config
+    _config_version = 0
+    _plan = None
+    _dialers = None
+    dial = True  # start the dialers on the first check (off for plans and slices)
+    _dialing = False
+    usage = None  # an accounting.Usage
+    budgets = None
+    prefer_when_over_budget = None
+    over_budget = frozenset()  # interfaces that have used up their data budget
+    _snapshot = None  # the linkstate.Snapshot for this check
+    arbitration = 'first'  # or 'score' (see netswitch.arbiter)
+    arbiter = None
+    costs = None
 
     # initialization
     @log_kw('Config updated')
     def _on_config_update(self, *,
             interfaces=None, lifeline=os.getenv('LIFELINE_SSID'),
-            networks=None, ap_path=None, restart_missing_ip=False, interval=20):
+            networks=None, ap_path=None, restart_missing_ip=False, interval=20, cycle_budget=None,
+            scan_interval=None, scan_window=30,
+            probes=None, quorum=None, probe_timeout=None, iface_grace=60,
+            usage_file=None, budgets=None, prefer_when_over_budget=None, scan_store=None,
+            arbitration='first', arbitration_margin=0.2, arbitration_dwell=30,
+            score_weights=None, costs=None):
+        self._config_version += 1
         self.interval = interval
+        self.cycle_budget = cycle_budget
+        probe.set_defaults(probes, quorum=quorum, timeout=probe_timeout)
         self.restart_missing_ip = restart_missing_ip
+        self.scan_interval, self.scan_window = scan_interval, scan_window
+        self.iface_objs.grace = iface_grace
+        if self.usage is None or self.usage.fname != usage_file:
+            if self.usage is not None:
+                self.usage.save(force=True)
+            self.usage = accounting.Usage(usage_file)
+        self.budgets, self.prefer_when_over_budget = budgets, prefer_when_over_budget
+        if arbitration not in ('first', 'score'):
+            raise ValueError('Unknown arbitration "{}" (expected first or score)'.format(arbitration))
+        self.arbitration, self.costs = arbitration, costs
+        if self.arbiter is None:
+            self.arbiter = Arbiter()
+        # keep the quality history across config changes
+        self.arbiter.margin, self.arbiter.dwell = arbitration_margin, arbitration_dwell
+        self.arbiter.weights = dict(DEFAULT_WEIGHTS, **(score_weights or {}))
+        if (self.scan_store.path if self.scan_store else None) != scan_store:
+            if self.scan_store is not None:
+                self.scan_store.close()
+            self.scan_store = survey.ScanStore(scan_store) if scan_store else None
+        for obj in self.iface_objs.values():
+            if isinstance(obj, iw.WLan):
+                obj.store = self.scan_store
+                self._set_background_scanning(obj)
         self.interfaces = (
                 ([{'interface': 'wlan*', 'ssids': lifeline, 'require_internet': False}] if lifeline else []) + [
                 util.abbr_config(c, 'interface') for c in util.flatten(
                     ['eth*', 'ppp*', 'wlan*'] if interfaces is None else interfaces or [])
             ]
         )
+        if self._dialing:
+            self._set_dialers(self.interfaces)
 
         if lifeline:
             logger.debug('Using lifeline network: %s', lifeline)
         if ap_path:
             wpasup.set_ap_path(ap_path)
-        for w in networks or ():
-            wpasup.generate_wpa_config(**w)
+        # only rewrite the networks that changed, and remove ones dropped from the config
+        networks = networks or ()
+        ssids = frozenset(w['ssid'] for w in networks)
+        changes = wpasup.update_networks(networks, prune=self._networks - ssids)
+        self._networks = ssids
+        if changes['added'] or changes['updated'] or changes['removed']:
+            logger.info('Networks - added: %s, updated: %s, removed: %s', *(
+                ', '.join(changes[k]) or '--' for k in ('added', 'updated', 'removed')))
 
     @functools.wraps(_on_config_update)
     def __init__(self, __config=None, **kw):
+        self.iface_objs = IfaceManager(self._get_iface_obj)
+        self.hooks = Hooks()
+        self.scans = iw.ScanCoordinator()
+        self._links = {}  # {iface: LinkState}, read once per check
         fname = __config if isinstance(__config, str) else None
         if not fname and __config:
             kw['interfaces'] = __config
@@ -89,65 +158,412 @@ class NetSwitch:
     # public interface
 
     def check(self):
-        '''Check internet connections and interfaces. Return True if connected.'''
+        '''Check internet connections and interfaces. Return True if connected.
+
+        With a ``cycle_budget``, scanning, connecting, restarting and probing
+        only get the time that's left, and once it's used up the rest of the
+        plan is skipped.'''
         self.config.refresh()
-        interfaces = ifcfg.interfaces()
-        logger.info('Interfaces: {}'.format(', '.join(interfaces) or '--'))
-        for cfg in self.interfaces:
-            # check if any matching interfaces are available
-            ifaces = [i for i in interfaces if fnmatch.fnmatch(i, cfg['interface'])]
-            logger.debug('Iface {} - matches {}'.format(cfg['interface'], ', '.join(ifaces) or '--'))
-
-            # try to connect in order of wlan1, wlan0
-            restart_missing = cfg.get('restart_missing_ip', self.restart_missing_ip)
-            for iface in sorted(ifaces, reverse=True):
-                if restart_missing and not interfaces[iface].get('inet'):
-                    util.ifup(iface)
-                if self.connect(iface, **cfg) and (not cfg.get('require_internet', True) or internet_connected(iface)):
-                    return True
+        self.start()
+        self.deadline = util.Deadline(self.cycle_budget)
+        self.hooks.emit('cycle_start')
+        t0, active = util.clock.time(), self.active
+        connected = self._check()
+        return self._checked(connected, active, t0)
+
+    def _checked(self, connected, active, t0):
+        '''Record a check and emit events for anything that changed.'''
+        if self.trace is not None:
+            self.trace.write(
+                'cycle', connected=connected, active=self.active, dt=util.clock.time() - t0)
+
+        if self.active != active:
+            self.hooks.emit('switch', old=active, new=self.active)
+        if connected != self.connected:
+            if connected:
+                self.hooks.emit('connected', active=self.active)
+            else:
+                self.hooks.emit('offline')
+        self.connected = connected
+        return connected
+
+    def _check(self):
+        interfaces, plan = self._begin_check()
+        if self.arbitration == 'score':
+            return self._arbitrate(plan, interfaces)
+        for rank, step, ifup in self._steps(plan, interfaces):
+            if ifup:
+                self._ifup(step.iface)
+            if self.connect(step.iface, **self._connect_kw(step)) and (
+                    not step.require_internet or self._probe(step.iface)):
+                return self._connected(step)
         # check if internet is connected anyways
-        return internet_connected()
+        self.active = None
+        return self._probe()
+
+    def _arbitrate(self, plan, interfaces):
+        '''Try each interface in the plan, score them, and pick one (see ``netswitch.arbiter``).'''
+        tried = {}
+        for rank, step, ifup in self._steps(plan, interfaces, tried):
+            if ifup:
+                self._ifup(step.iface)
+            self._tried(tried, rank, step, self.connect(step.iface, **self._connect_kw(step)) and (
+                not step.require_internet or self._probe(step.iface)))
+        return self._pick(tried, len(plan)) or self._probe()
+
+    # the decisions in a check (shared with netswitch.aio, which only adds the awaits)
+
+    def _begin_check(self):
+        '''Look at the interfaces and get the plan for this cycle.'''
+        interfaces = self._interfaces()
+        logger.info('Interfaces: %s', ', '.join(interfaces) or '--')
+        self.iface_objs.update(interfaces)
+        self._links, self._snapshot = {}, None
+        self._account()
+        # share one set of (concurrent) scans between all radios for this cycle
+        self.scans.reset(self._radios(interfaces), self.deadline)
+        return interfaces, self.get_plan(interfaces)
+
+    def _steps(self, plan, interfaces, tried=None):
+        '''The steps worth trying, as ``(rank, step, ifup)`` (``ifup`` - whether
+        to bring the interface up first). Stops when the deadline is up and skips
+        blocked interfaces. With ``tried`` (``{iface: (ok, rank)}``, for
+        arbitration), it also skips interfaces that already connected.'''
+        for rank, step in enumerate(plan):
+            if tried is not None and tried.get(step.iface, (False,))[0]:
+                continue  # it already connected for a higher priority entry
+            if self.deadline.expired:
+                logger.warning('Out of time for this check (%ss), skipping the rest of the plan.', self.cycle_budget)
+                return
+            if self._blocked(step.iface):
+                if tried is not None:
+                    tried.setdefault(step.iface, (False, rank))
+                continue
+            yield rank, step, bool(step.restart_missing_ip and self._missing_ip(step.iface, interfaces))
+
+    def _connect_kw(self, step):
+        return dict(step.options, trusted=step.ssids, deadline=self.deadline)
+
+    def _connected(self, step):
+        self.active = step.iface, getattr(self._get_obj(step.iface), 'ssid', None)
+        return True
+
+    @staticmethod
+    def _tried(tried, rank, step, ok):
+        '''Record whether a step connected. An interface keeps the rank it
+        connected at, or of its first step if it never did.'''
+        if ok or step.iface not in tried:
+            tried[step.iface] = bool(ok), rank
+
+    def _radios(self, interfaces):
+        '''The wifi interfaces that can scan (not rfkill'd).'''
+        return {
+            i: obj for i, obj in ((i, self._get_obj(i)) for i in interfaces)
+            if isinstance(obj, iw.WLan) and not self._link(i).blocked}
+
+    def _blocked(self, iface):
+        '''Whether the kernel says an interface can't be used (rfkill'd, cable unplugged).'''
+        why = self._link(iface).blocked
+        if why:
+            logger.info('[%s] Skipping: %s.', iface, why)
+        return bool(why)
+
+    def _missing_ip(self, iface, interfaces):
+        has = self._link(iface).has_addr
+        return not interfaces[iface].get('inet') if has is None else not has
+
+    def _unreachable(self, iface=None):
+        '''Why a probe (through ``iface``) can't work, going by the kernel's state (or None).'''
+        self._forget_link(iface)  # we've probably just connected it, so look again
+        if iface:
+            return self._link(iface).offline
+        return 'no default route' if self._link_snapshot().no_default_route else None
+
+    def _link(self, iface):
+        '''The state of an interface, read once per check (see ``_forget_link``).'''
+        state = self._links.get(iface)
+        if state is None:
+            state = self._links[iface] = self._link_state(iface)
+        return state
+
+    def _forget_link(self, iface=None):
+        self._links.pop(iface, None)
+        self._snapshot = None
+
+    def _link_snapshot(self):
+        if self._snapshot is None:
+            self._snapshot = linkstate.snapshot()
+        return self._snapshot
+
+    def _pick(self, tried, n):
+        '''Score the interfaces that were tried and set the active one. True if one was picked.'''
+        scores = []
+        for iface, (up, rank) in tried.items():
+            self.arbiter.observe(iface, up)
+            scores.append(self.arbiter.score(
+                iface, getattr(self._get_obj(iface), 'ssid', None), up,
+                rank, n, self._cost(iface)))
+        choice = self.arbiter.choose(scores, self.active[0] if self.active else None)
+        logger.debug('Scores:\n%s', self.arbiter.summary())
+        self.hooks.emit('scores', scores=[s.as_dict() for s in self.arbiter.scores], choice=choice and choice.iface)
+        self.active = (choice.iface, choice.ssid) if choice is not None else None
+        return choice is not None
+
+    @property
+    def scores(self):
+        '''The last round of scores, best first (``arbitration: score`` only).'''
+        return [s.as_dict() for s in self.arbiter.scores] if self.arbiter else []
+
+    def _cost(self, iface):
+        cost = next((
+            c for pat, c in (self.costs or {}).items() if util.matches(pat, [iface])), 0)
+        return cost + (1 if iface in self.over_budget else 0)
 
     def run(self, interval=None):
         interval = self.interval if interval is None else interval
+        self.notifier = self.notifier or sdnotify.Notifier()
+        self.notifier.starting(2 * (self.cycle_budget or sdnotify.CHECK_TIME))
         self.summary()
-        self.check()
         while True:
-            time.sleep(interval)
-            self.check()
+            t0 = util.clock.time()
+            connected = self.check()
+            self.notifier.cycle(self.status(connected))
+            # keep to the interval, however long the check took
+            self._sleep(max(0, interval - (util.clock.time() - t0)))
         self.summary()
 
+    def _sleep(self, seconds):
+        # keep the watchdog fed while waiting, it's only checks that shouldn't hang
+        step = self.notifier.watchdog / 2. if self.notifier and self.notifier.watchdog else seconds
+        while seconds > 0:
+            util.clock.sleep(min(step, seconds))
+            seconds -= step
+            if seconds > 0:
+                self.notifier.ping()
+
+    def status(self, connected=None):
+        '''A one line summary of the current link.'''
+        connected = self.connected if connected is None else connected
+        if self.active:
+            iface, ssid = self.active
+            return 'Connected via {}{}'.format(iface, ' ({})'.format(ssid) if ssid else '')
+        return 'Connected (no preferred interface)' if connected else 'Offline'
+
+    def get_plan(self, interfaces=None):
+        '''The config compiled into an ordered list of steps for these interfaces.
+        It's only recompiled when the config, interfaces or trusted aps change.'''
+        interfaces = self._interfaces() if interfaces is None else interfaces
+        key = self._config_version, frozenset(interfaces), self._aps_version(), self.over_budget
+        if self._plan is None or self._plan.key != key:
+            self._plan = compile_plan(
+                self.interfaces, interfaces, self._trusted_ssids(),
+                restart_missing_ip=self.restart_missing_ip, key=key)
+            if self.over_budget:
+                self._plan = prefer(self._plan, self.prefer_when_over_budget, self.over_budget)
+            logger.debug('Compiled plan:\n%s', self._plan)
+        return self._plan
+
+    def record(self, fname):
+        '''Record scans, interfaces, probes and connections to a trace file
+        that can be replayed with ``netswitch.trace.simulate``.'''
+        from .trace import Trace
+        self.trace = Trace(fname)
+        self.trace.write('aps', ssids=sorted(wpasup.ssids_from_dir()))
+        for obj in self.iface_objs.values():
+            if isinstance(obj, iw.WLan):
+                obj.trace = self.trace
+        return self.trace
+
+    # hooks
+
+    def on(self, event, func=None, **kw):
+        '''Subscribe to an event (see ``netswitch.hooks``). Can be used as a decorator.'''
+        return self.hooks.on(event, func, **kw)
+
+    def on_cycle_start(self, func=None, **kw):
+        return self.hooks.on('cycle_start', func, **kw)
+
+    def on_probe(self, func=None, **kw):
+        return self.hooks.on('probe', func, **kw)
+
+    def on_switch(self, func=None, **kw):
+        return self.hooks.on('switch', func, **kw)
+
+    def on_connected(self, func=None, **kw):
+        return self.hooks.on('connected', func, **kw)
+
+    def on_offline(self, func=None, **kw):
+        return self.hooks.on('offline', func, **kw)
+
+    def on_scores(self, func=None, **kw):
+        return self.hooks.on('scores', func, **kw)
+
     # internal interface
 
     def connect(self, iface, **kw):
         '''Connect to an interface.'''
-        if iface not in self._iface_objs:
-            self._iface_objs[iface] = self._get_iface_obj(iface)
-        connect = getattr(self._iface_objs.get(iface), 'connect', None)
+        connect = getattr(self._get_obj(iface), 'connect', None)
         return connect(**kw) if callable(connect) else True
 
+    def _get_obj(self, iface):
+        return self.iface_objs[iface]
+
     def _get_iface_obj(self, iface):
-        if fnmatch.fnmatch(iface, 'wlan*'):
-            return iw.WLan(iface=iface)
-        return
+        obj = get_backend(iface, self.backends)(iface)
+        if isinstance(obj, iw.WLan):
+            obj.trace = self.trace
+            obj.store = self.scan_store
+            self._set_background_scanning(obj)
+        if isinstance(obj, PPP):
+            obj.dialer = (self._dialers or {}).get(iface)
+        return obj
+
+    def _set_dialers(self, config):
+        '''Start dialers for the config entries with a ``dialer``, and stop the
+        ones that were removed or changed.'''
+        current, self._dialers = self._dialers or {}, {}
+        for cfg in config:
+            if not cfg.get('dialer'):
+                continue
+            kw = cfg['dialer'] if isinstance(cfg['dialer'], dict) else {'cmd': cfg['dialer']}
+            # a pattern like ppp* can't be dialed, so assume the first one
+            iface = kw.get('iface') or (
+                'ppp0' if glob.has_magic(cfg['interface']) else cfg['interface'])
+            kw = dict(kw, iface=iface)
+            d = current.pop(iface, None)
+            if d is None or d.config != kw:
+                if d is not None:
+                    d.stop()
+                d = self._make_dialer(**kw)
+                d.config = kw
+                d.start()
+                logger.info('Started dialer: %s', d)
+            self._dialers[iface] = d
+        for d in current.values():
+            d.stop()
+            logger.info('Stopped dialer: %s', d)
+        for obj in self.iface_objs.values():
+            if isinstance(obj, PPP):
+                obj.dialer = self._dialers.get(obj.iface)
+
+    def _account(self):
+        '''Add this cycle's traffic to the usage totals and check the budgets.'''
+        counters = self._counters()
+        if not counters:
+            return
+        self.usage.sample(counters)
+        over = frozenset(self.usage.over_budget(self.budgets)) if self.budgets else frozenset()
+        if over - self.over_budget:
+            logger.warning('Over data budget: %s', ', '.join(sorted(over - self.over_budget)))
+        if self.over_budget - over:
+            logger.info('Back under data budget: %s', ', '.join(sorted(self.over_budget - over)))
+        self.over_budget = over
+
+    def _make_dialer(self, **kw):
+        return Dialer(**kw)
+
+    def start(self):
+        '''Start the dialers (``check`` does this the first time it's called).'''
+        if self.dial and not self._dialing:
+            self._dialing = True
+            self._set_dialers(self.interfaces)
+
+    def close(self):
+        '''Stop the dialers and background scanning, and save the usage totals.'''
+        self._set_dialers(())
+        self._dialing = False
+        self.iface_objs.clear()
+        if self.usage is not None:
+            self.usage.save(force=True)
+        if self.scan_store is not None:
+            self.scan_store.close()
+        if self.notifier is not None:
+            self.notifier.stopping()
+            self.notifier.close()
+
+    # the outside world - overridden when replaying traces
+
+    def _interfaces(self):
+        interfaces = ifcfg.interfaces()
+        if self.trace is not None:
+            self.trace.write('interfaces', interfaces={
+                k: {'inet': d.get('inet')} for k, d in interfaces.items()})
+        return interfaces
+
+    def _trusted_ssids(self):
+        return wpasup.ssids_from_dir()
+
+    def _aps_version(self):
+        '''Changes when aps are added or removed.'''
+        try:
+            return wpasup.Wpa.ap_path, os.stat(wpasup.Wpa.ap_path).st_mtime_ns
+        except OSError:
+            return wpasup.Wpa.ap_path, None
+
+    def _ifup(self, iface):
+        return util.ifup(iface, timeout=self.deadline.remaining(30, floor=1))
+
+    def _counters(self):
+        try:
+            return accounting.read_counters()
+        except OSError:  # not linux
+            return {}
+
+    def _link_state(self, iface):
+        return linkstate.read(iface, self._link_snapshot())
+
+    def _probe(self, iface=None):
+        t0 = util.clock.time()
+        connected = not self._skip_probe(iface) and internet_connected(
+            iface, timeout=self._probe_timeout())
+        return self._probed(iface, connected, t0)
+
+    def _skip_probe(self, iface):
+        # the last, any interface probe still runs, so we don't call ourselves offline for being slow
+        why = 'out of time for this check' if iface and self.deadline.expired else self._unreachable(iface)
+        if why:
+            logger.info('[%s] Not probing: %s.', iface or 'any', why)
+        return bool(why)
+
+    def _probe_timeout(self):
+        return self.deadline.remaining(probe.defaults['timeout'], floor=1)
+
+    def _probed(self, iface, connected, t0):
+        if self.trace is not None:
+            self.trace.write(
+                'probe', iface=iface, ok=bool(connected), dt=util.clock.time() - t0,
+                ssid=getattr(self.iface_objs.get(iface), 'ssid', None))
+        self.hooks.emit('probe', iface=iface, ok=connected, dt=util.clock.time() - t0)
+        return connected
+
+    def _set_background_scanning(self, wlan):
+        if self.scan_interval:
+            wlan.start_scanning(self.scan_interval, self.scan_window)
+        else:
+            wlan.stop_scanning()
+        return wlan
 
     # supplimentary interface
 
     def __getitem__(self, index):
-        return self.__class__(self.interfaces[index])
+        witch = self.__class__(self.interfaces[index])
+        witch.dial = False  # the modem belongs to the one we were sliced from
+        return witch
 
     def __str__(self):
         return self._summary()
 
     def summary(self):
-        logger.info(self._summary())
+        # only gather all of this if it's going to be logged
+        if logger.isEnabledFor(logging.INFO):
+            logger.info('%s', self._summary())
 
     def _summary(self):
         import json
         return '\n' + '\n'.join((
             '-'*50,
             'Current Network:',
-            wpasup.Wpa()._summary(),
+            '\n'.join('{}: {}'.format(i, w._summary()) for i, w in wpasup.current_networks().items()) or '--',
             '', 'Trusted APs: {}'.format(', '.join(wpasup.ssids_from_dir(wpasup.Wpa.ap_path))),
             '', 'Priority Config: {}'.format(self.interfaces),
             # '', 'Available Networks:',
@@ -208,15 +624,25 @@ class Config(dict):
 
 #@util._debug_args
 # @functools.wraps(NetSwitch)
-def run(config=None, interval=20, **kw):
+def run(config=None, interval=20, record=None, **kw):
     witch = NetSwitch(config, **kw)
+    if record:
+        witch.record(record)
+    logs.handle_dump_signal()
     try:
         witch.run(interval=interval)
     except KeyboardInterrupt:
         print('Interrupted.')
+    finally:
+        witch.close()
     return witch
 
 
+def show_plan(config=None, **kw):
+    '''Show the steps a check would go through with the current interfaces.'''
+    return str(NetSwitch(config, **kw).get_plan())
+
+
 if __name__ == '__main__':
     NetSwitch([
         {'interface': 'wlan*', 'ssids': ['s0nycL1f3l1ne']},
@@ -18,10 +18,19 @@ wpa-roam /etc/wpa_supplicant/wpa_supplicant.conf
 
 allow-hotplug wlan1
 iface wlan1 inet manual
-wpa-roam /etc/wpa_supplicant/wpa_supplicant.conf
+wpa-roam /etc/wpa_supplicant/wpa_supplicant-wlan1.conf
 '''
 import re
+import logging
 import functools
+import yaml
+from . import util, wpasup
+from .etcinterfaces import Interfaces, Stanza, ETC_INTERFACES_FNAME, IGNORED_IFACES, unique
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONFIG = ['eth*', 'ppp*', 'wlan*']
+WILDCARD_COUNT = 2  # how many interfaces a pattern like wlan* stands for
 
 def _expand_wildcard(*rng):
     def outer(func):
@@ -42,16 +51,18 @@ def source_dir(fname='/etc/network/interfaces.d'):
 def lo(**kw):
     return _iface('lo', method='loopback', **kw)
 
-@_expand_wildcard(2)
+@_expand_wildcard(WILDCARD_COUNT)
 def eth(i=0, **kw):
     return _iface('eth{}'.format(i), **kw)
 
-@_expand_wildcard(2)
-def wlan(i=0, wpa='/etc/wpa_supplicant/wpa_supplicant.conf', roam=True, **kw):
-    kw['wpa_{}'.format('roam' if roam else 'conf')] = wpa
-    return _iface('wlan{}'.format(i), hotplug=True, **kw)
+@_expand_wildcard(WILDCARD_COUNT)
+def wlan(i=0, wpa=None, roam=True, **kw):
+    name = 'wlan{}'.format(i)
+    # each radio gets its own config, so they can be on different networks
+    kw['wpa_{}'.format('roam' if roam else 'conf')] = wpa or wpasup.wpa_path(name)
+    return _iface(name, hotplug=True, **kw)
 
-@_expand_wildcard(2)
+@_expand_wildcard(WILDCARD_COUNT)
 def ppp(i=0, method='wvdial', **kw):
     name = 'ppp{}'.format(i)
     return _iface(
@@ -64,9 +75,20 @@ IFACES = {'wlan': wlan, 'eth': eth, 'ppp': ppp}
 def iface(name, *a, **kw):
     if callable(name):
         return name(*a, **kw)
-    matches = re.search(r'([A-z]+)([\d\*]*)', name)
-    name, i = matches.groups()
-    return IFACES[name.lower()](i or '*', *a, **kw)
+    kind, i = _parse(name)
+    return IFACES[kind](i, *a, **kw)
+
+def names(pattern):
+    '''The interfaces a pattern stands for, e.g. ``wlan*`` -> ``['wlan0', 'wlan1']``.'''
+    kind, i = _parse(pattern)
+    return ['{}{}'.format(kind, j) for j in (range(WILDCARD_COUNT) if i == '*' else [i])]
+
+def _parse(name):
+    matches = re.fullmatch(r'([A-Za-z]+)(\d*|\*)', name)
+    if not matches or matches.group(1).lower() not in IFACES:
+        raise ValueError('Can\'t generate a stanza for "{}" (only {})'.format(name, ', '.join(IFACES)))
+    kind, i = matches.groups()
+    return kind.lower(), i or '*'
 
 # utils
 
@@ -96,17 +118,134 @@ def default():
     return build_file(eth, ppp, wlan)
 
 def from_config(config=None):
+    '''Build an interfaces file from a NetSwitch priority config.
+
+    ``config`` can be a NetSwitch, its ``interfaces`` list, a config file, or
+    None for the default (eth*, ppp*, wlan*). Extra options for an interface
+    can be given under the entry's ``etc`` key. An interface matched by more
+    than one entry (e.g. ``wlan*`` and ``wlan0``) uses the first. Interfaces
+    we can't generate stanzas for (e.g. ``usb0``) are skipped.
+    '''
+    if isinstance(config, str):
+        config = _load_interfaces(config)
+    config = getattr(config, 'interfaces', config)
     config = [
-        {'interface': 'wlan*', 'ssids': 's0nycL1f3l1ne'},
-        {'interface': 'eth*'},
-        {'interface': 'ppp*'},
-        {'interface': 'wlan*'},
-    ]
+        util.abbr_config(c, 'interface')
+        for c in util.flatten(DEFAULT_CONFIG if config is None else config)]
+    # one entry per interface - the first has the highest priority
+    seen = {}
+    for c in config:
+        try:
+            for name in names(c['interface']):
+                seen.setdefault(name, c)
+        except ValueError as e:
+            logger.warning('Skipping: %s', e)
     return build_file(*(
-        iface(c['interface'], **c.get('etc', {}))
-        for c in config
+        iface(name, **c.get('etc', {}))
+        for name, c in seen.items()
     ))
 
+def _load_interfaces(fname):
+    '''The ``interfaces`` section of a NetSwitch config file.'''
+    with open(fname, 'r') as f:
+        return (yaml.safe_load(f) or {}).get('interfaces')
+
+
+# diff and apply
+
+def _semantic(stanzas, name):
+    '''Compare stanzas for one interface regardless of formatting, comments or
+    which other interfaces share an ``auto``/``allow-*`` line.'''
+    return sorted(
+        s.semantic() if s.is_block else ((s.kind, name), ())
+        for s in stanzas)
+
+
+def diff(new, current=None):
+    '''Compare two Interfaces and return the names whose stanzas differ.
+
+    Only interfaces defined in ``new`` are considered, so anything else in the
+    current config (e.g. hand-written bridges) is left alone.
+    '''
+    current = Interfaces(current) if current is None or isinstance(current, str) else current
+    return [
+        name for name in unique(n for s in new.stanzas for n in s.names)
+        if _semantic(new.by_name[name], name) != _semantic(current.by_name.get(name, []), name)
+    ]
+
+
+def diff_config(config=None, fname=ETC_INTERFACES_FNAME):
+    '''Show which interfaces would change if the config was applied.'''
+    return diff(Interfaces.from_string(from_config(config)), fname)
+
+
+def _replace(current, new, name):
+    '''Update the stanzas for an interface in ``current`` to match ``new``.
+
+    Existing stanzas are edited in place (keeping their comments and position),
+    missing ones are added next to the others and stale ones are removed.
+    '''
+    old = list(current.by_name.get(name, []))
+    keep, prev = set(), None
+    for s in new.by_name[name]:
+        key = s.kind, name, s.family
+        o = current.index.get(key)
+        if o is not None:
+            if o.is_block and o.semantic() != s.semantic():
+                o.header = s.header
+                o.set_subs(s.subs)
+                current.touch(o)
+        else:
+            header = ' '.join((s.kind, name)) if not s.is_block else s.header
+            o = Stanza(header)
+            o.extend(s.subs)
+            if prev is not None:
+                current.add(o, after=prev)
+            elif old:
+                current.add(o, before=old[0])
+            else:
+                current.add(o)
+        keep.add(id(o))
+        prev = o
+
+    for s in old:
+        if id(s) in keep:
+            continue
+        if len(s.names) > 1:  # shared (e.g. `auto eth0 wlan0`) - just drop this one
+            s.header = ' '.join(p for p in s.parts if p != name)
+            current.touch(s)
+        else:
+            current.remove(s)
+
+
+def apply(config=None, fname=ETC_INTERFACES_FNAME, restart=True, dry_run=False):
+    '''Write the interface stanzas generated from a NetSwitch config.
+
+    Only stanzas that changed are rewritten (atomically) and only the
+    interfaces that changed are restarted. Returns the changed interfaces.
+    '''
+    new = Interfaces.from_string(from_config(config))
+    current = Interfaces(fname)
+    changed = diff(new, current)
+    if not changed:
+        logger.debug('%s is up to date.', fname)
+        return []
+    logger.info('Interfaces changed in %s: %s', fname, ', '.join(changed))
+    if dry_run:
+        return changed
+
+    for name in changed:
+        _replace(current, new, name)
+    current.save()
+
+    if restart:
+        import ifcfg
+        present = ifcfg.interfaces()
+        for name in changed:
+            if name in present and name not in IGNORED_IFACES:
+                util.restart_iface(name)
+    return changed
+
 
 if __name__ == '__main__':
     import fire
@@ -1,80 +1,391 @@
 #!/usr/bin/env python
+'''Parse and edit /etc/network/interfaces (and the files it sources).
+
+Stanzas are kept with their original lines (comments, blank lines and
+indentation) so that an untouched file renders back exactly as it was read.
+Every stanza is indexed by (kind, name, family), so lookups and edits don't
+need to scan the whole file.
+'''
 import os
+import re
+import glob
+from . import util
 
 ETC_INTERFACES_FNAME = '/etc/network/interfaces'
 
 SUPER_BLOCK_KEYS = 'iface', 'mapping'
-SUPER_LINE_KEYS = 'auto', 'allow-', 'source'
+SUPER_LINE_KEYS = 'auto', 'allow-', 'source', 'rename', 'no-auto-down', 'no-scripts'
 SUPER_KEYS = SUPER_BLOCK_KEYS + SUPER_LINE_KEYS
+INCLUDE_KEYS = 'source', 'source-directory'
 
 IGNORED_IFACES = ('lo',)
+SUB_INDENT = '    '
+
+# only files matching this are read by source-directory (see interfaces(5))
+_SOURCE_DIR_FNAME = re.compile(r'^[a-zA-Z0-9_-]+$')
+
+_file_cache = {}  # fname -> (stamp, (preamble, [(header, lines), ...]))
+
+
+class Stanza:
+    '''A super-directive (e.g. ``iface eth0 inet manual``) and the lines under it.
+
+    ``lines`` holds the raw lines following the header (sub-directives,
+    comments and blank lines) so the stanza can be written back untouched.
+    '''
+    def __init__(self, header, lines=(), fname=None):
+        self.header = header.strip()
+        self.lines = list(lines)
+        self.fname = fname
+
+    def __str__(self):
+        return '\n'.join([self.header] + self.lines)
+
+    def __repr__(self):
+        return '<{} {!r} subs={}>'.format(self.__class__.__name__, self.header, self.subs)
+
+    @property
+    def parts(self):
+        return self.header.split()
+
+    @property
+    def kind(self):
+        return self.parts[0]
+
+    @property
+    def names(self):
+        '''The interfaces this stanza refers to.'''
+        parts = self.parts
+        if self.kind in SUPER_BLOCK_KEYS:
+            return parts[1:2]
+        if self.kind.startswith(('auto', 'allow-', 'no-')):
+            return parts[1:]
+        return []
+
+    @property
+    def name(self):
+        names = self.names
+        return names[0] if names else None
+
+    @property
+    def family(self):
+        parts = self.parts
+        return parts[2] if self.kind == 'iface' and len(parts) > 2 else None
+
+    @property
+    def method(self):
+        parts = self.parts
+        return parts[3] if self.kind == 'iface' and len(parts) > 3 else None
+
+    @property
+    def keys(self):
+        return [(self.kind, name, self.family) for name in self.names]
+
+    @property
+    def is_block(self):
+        return self.kind in SUPER_BLOCK_KEYS
+
+    @property
+    def subs(self):
+        '''Sub-directives, without comments, blank lines or indentation.'''
+        return [l for l in (l.strip() for l in self.lines) if l and not l.startswith('#')]
+
+    @property
+    def options(self):
+        '''Sub-directives as {option: [values, ...]}.'''
+        opts = {}
+        for sub in self.subs:
+            k, _, v = sub.partition(' ')
+            opts.setdefault(k, []).append(' '.join(v.split()))
+        return opts
+
+    def semantic(self):
+        '''A whitespace and comment insensitive representation of the stanza.'''
+        return (tuple(self.parts), tuple(' '.join(s.split()) for s in self.subs))
+
+    # editing
+
+    def _sub_index(self):
+        '''Where new sub-directives go: after the last existing one.'''
+        i = max((i for i, l in enumerate(self.lines)
+                 if l.strip() and not l.strip().startswith('#')), default=-1)
+        return i + 1
+
+    def _indent(self):
+        return next((l[:len(l) - len(l.lstrip())] for l in self.lines
+                     if l.strip() and l[:1].isspace()), SUB_INDENT)
+
+    def extend(self, subs):
+        i, indent = self._sub_index(), self._indent()
+        self.lines[i:i] = [indent + s.strip() for s in subs]
+
+    def set_subs(self, subs):
+        '''Replace all sub-directives, keeping any comments and trailing lines.'''
+        i = self._sub_index()
+        keep_head = [l for l in self.lines[:i] if l.strip().startswith('#')]
+        indent = self._indent()
+        self.lines = keep_head + [indent + s.strip() for s in subs] + self.lines[i:]
+
+    def set_option(self, key, *values):
+        '''Set (or with no values, remove) a sub-directive by option name.'''
+        out, done, indent = [], False, self._indent()
+        for l in self.lines:
+            if l.strip().split(' ', 1)[0] == key:
+                if not done:
+                    out.extend(indent + ' '.join((key, str(v))) for v in values)
+                    done = True
+                continue
+            out.append(l)
+        self.lines = out
+        if not done and values:
+            self.extend(' '.join((key, str(v))) for v in values)
+
+
+class IfaceFile:
+    '''A single interfaces file: an optional preamble followed by stanzas.'''
+    def __init__(self, text='', fname=None, stamp=None, parsed=None):
+        self.fname = fname
+        self.stamp = stamp
+        self.trailing_newline = text.endswith('\n') if text else True
+        preamble, stanzas = parsed or parse(text)
+        self.preamble = list(preamble)
+        self.stanzas = [Stanza(h, lines, fname=fname) for h, lines in stanzas]
+        self.dirty = False
+
+    @classmethod
+    def load(cls, fname):
+        '''Load a file, reusing the parse from the last time if it hasn't changed.'''
+        stamp = _stamp(fname)
+        cached = _file_cache.get(fname)
+        if cached and cached[0] == stamp:
+            parsed, trailing_newline = cached[1]
+            f = cls(fname=fname, stamp=stamp, parsed=parsed)
+            f.trailing_newline = trailing_newline
+            return f
+        with open(fname, 'r') as fh:
+            text = fh.read()
+        f = cls(text, fname=fname, stamp=stamp)
+        _file_cache[fname] = stamp, (f._parsed(), f.trailing_newline)
+        return f
+
+    def _parsed(self):
+        return tuple(self.preamble), [(s.header, tuple(s.lines)) for s in self.stanzas]
+
+    def __str__(self):
+        return '\n'.join(self.preamble + [str(s) for s in self.stanzas]) + (
+            '\n' if self.trailing_newline else '')
+
+    @property
+    def changed(self):
+        '''Has the file been modified on disk since it was loaded?'''
+        return bool(self.fname) and _stamp(self.fname) != self.stamp
+
+    def save(self, fname=None):
+        fname = fname or self.fname
+        util.atomic_write(fname, str(self))
+        if fname == self.fname:
+            self.stamp = _stamp(fname)
+            self.dirty = False
+
+
+def _stamp(fname):
+    '''What we compare to tell if a file changed. The float mtime can miss a
+    write in the same tick (or round), so use the ns mtime and the size. None
+    if it doesn't exist.'''
+    try:
+        st = os.stat(fname)
+    except FileNotFoundError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+def parse(text):
+    '''Split interfaces text into (preamble lines, [(header, lines), ...]).'''
+    preamble, stanzas = [], []
+    for line in text.splitlines():
+        if line.strip().startswith(SUPER_KEYS):
+            stanzas.append((line.strip(), []))
+        elif stanzas:
+            stanzas[-1][1].append(line)
+        else:
+            preamble.append(line)
+    return preamble, stanzas
 
 
 class Interfaces:
-    """Manage /etc/network/interfaces file
+    """Manage /etc/network/interfaces, following `source` and `source-directory`.
+
+    Original source: https://gist.github.com/Apsu/8799432
 
-    Source: https://gist.github.com/Apsu/8799432
+    Example:
+
+    ```
+    ifaces = Interfaces()
+    ifaces['wlan0'].set_option('wpa-roam', '/etc/wpa_supplicant/wpa_supplicant.conf')
+    ifaces.save()
+    ```
     """
-    body = ''
-    def __init__(self, fname=ETC_INTERFACES_FNAME):
+    def __init__(self, fname=ETC_INTERFACES_FNAME, follow=True):
         fname, lines = (fname, None) if isinstance(fname, str) else (None, fname)
         self.fname = fname
-        if os.path.isfile(fname):
-            with open(self.fname, 'r') as f:
-                self.body = f.read()
-        self.lines = [l for l in (l.strip() for l in self.body.splitlines()) if l]
-        self.directives = self.parse(self.lines)  # Parsed directives
+        self.follow = follow
+        if fname and os.path.isfile(fname):
+            self.root = IfaceFile.load(fname)
+        else:
+            self.root = IfaceFile('\n'.join(lines or ()), fname=fname)
+        self._build()
+
+    @classmethod
+    def from_string(cls, text, follow=False):
+        self = cls.__new__(cls)
+        self.fname, self.follow = None, follow
+        self.root = IfaceFile(text)
+        self._build()
+        return self
+
+    def _build(self, files=None):
+        '''Resolve includes and (re)build the indices.
+
+        Passing the already loaded ``files`` just re-flattens them (after an edit).
+        '''
+        self.files = {}
+        self.stanzas = []
+        self._includes = {}  # (kind, path) -> the files it matched
+        self._include(self.root, {self.fname}, files or {})
+        self.reindex()
+
+    def _include(self, f, seen, files):
+        self.files[f.fname] = f
+        for s in f.stanzas:
+            self.stanzas.append(s)
+            if self.follow and s.kind in INCLUDE_KEYS and len(s.parts) > 1:
+                fnames = self._includes[s.kind, s.parts[1]] = self._resolve(s.kind, s.parts[1])
+                for fname in fnames:
+                    if fname not in seen:
+                        seen.add(fname)
+                        self._include(files.get(fname) or IfaceFile.load(fname), seen, files)
+
+    def _resolve(self, kind, path):
+        base = os.path.dirname(self.fname or ETC_INTERFACES_FNAME)
+        path = os.path.join(base, path)
+        if kind == 'source-directory':
+            return [os.path.join(path, f) for f in sorted(os.listdir(path))
+                    if _SOURCE_DIR_FNAME.match(f) and os.path.isfile(os.path.join(path, f))
+                    ] if os.path.isdir(path) else []
+        return [f for f in sorted(glob.glob(path)) if os.path.isfile(f)]
+
+    def reindex(self):
+        self.index = {}
+        self.by_name = {}
+        for s in self.stanzas:
+            for key in s.keys:
+                self.index.setdefault(key, s)
+            for name in s.names:
+                self.by_name.setdefault(name, []).append(s)
+
+    def refresh(self):
+        '''Reload if any of the files changed on disk, or an include matches
+        different files now (e.g. one was added to interfaces.d). Returns True if reloaded.'''
+        if any(f.changed for f in self.files.values()) or any(
+                self._resolve(kind, path) != fnames for (kind, path), fnames in self._includes.items()):
+            self.root = (
+                IfaceFile.load(self.fname) if self.fname and os.path.isfile(self.fname)
+                else IfaceFile(fname=self.fname))
+            self._build()
+            return True
+        return False
 
     def __str__(self):
-        return '\n'.join([
-            str(sup) +
-            ''.join(['\n    {}'.format(s) for s in subs]) +
-            ('\n' if sup.startswith(SUPER_BLOCK_KEYS) else '')
-            for sup, subs in self.directives
-        ])
-
-    def parse(self, lines):
-        "Parse super- and sub-directives, and return nested results"
-        it = iter(lines)
-        directives = []
-        for directive in it:
-            while directive.startswith(SUPER_BLOCK_KEYS):  # If we're on a super, start sub loop
-                sup, subs = None, []  # Clear super/sub directives
-                for sub in it:
-                    if sub.startswith(SUPER_KEYS):  # If sub is actually a super
-                        sup = sub
-                        break
-                    subs.append(sub) # Else it's just a sub, so add it
-                directives.append([directive, subs])
-                if not sup:  # If we didn't find a super, return
-                    return directives
-                directive = sup  # Store super for next inner loop check
-            # Not a super here so just add directive
-            directives.append([directive, []])
-        return directives
-
-    def save(self, fname):
-        with open(fname, 'w') as f:
-            f.write(str(self))
+        return str(self.root)
+
+    def __contains__(self, name):
+        return ('iface', name, 'inet') in self.index or name in self.by_name
+
+    def __getitem__(self, name):
+        s = self.get(name)
+        if s is None:
+            raise KeyError(name)
+        return s
+
+    def get(self, name, kind='iface', family='inet'):
+        '''Look up a stanza by interface name.'''
+        return self.index.get((kind, name, family if kind == 'iface' else None))
+
+    def find(self, kind):
+        '''All stanzas of a kind, e.g. ``find('allow-hotplug')``.'''
+        return [s for s in self.stanzas if s.kind == kind]
+
+    # editing
+
+    def add(self, stanza, after=None, before=None, fname=None):
+        '''Add a stanza to the end of a file (or after/before another stanza).'''
+        if isinstance(stanza, str):
+            stanza = Stanza(stanza)
+        ref = after or before
+        f = self.files.get(fname if fname is not None else (ref.fname if ref else self.fname))
+        f = f or self.root
+        stanza.fname = f.fname
+        if ref is not None and ref in f.stanzas:
+            f.stanzas.insert(f.stanzas.index(ref) + bool(after), stanza)
+        else:
+            if f.stanzas and f.stanzas[-1].is_block and f.stanzas[-1].lines[-1:] != ['']:
+                f.stanzas[-1].lines.append('')  # keep blocks visually separated
+            f.stanzas.append(stanza)
+        f.dirty = True
+        self._build(self.files)
+        return stanza
+
+    def remove(self, stanza):
+        f = self.files[stanza.fname]
+        f.stanzas.remove(stanza)
+        f.dirty = True
+        self._build(self.files)
+
+    def touch(self, stanza):
+        '''Mark the file containing a stanza as modified.'''
+        self.files[stanza.fname].dirty = True
 
     def swap(self, one, two):
-        "Swap one directive with another"
-        for i, (sup, _) in enumerate(self.directives):
-            self.directives[i][0] = sup.replace(one, two)
+        "Rename an interface everywhere it's named in a super-directive"
+        for s in self.stanzas:
+            parts = s.parts
+            if one in parts[1:]:
+                s.header = ' '.join(two if p == one else p for p in parts)
+                self.touch(s)
+        self.reindex()
 
     def add_subs(self, sup, subs, offset=0):
         "Add sub-directives to super-directive"
-        for supi, subsi in self.directives[offset:]:
-            if sup in supi:
-                subsi.extend(subs)
-                return
-        self.directives.append((sup, subs))
+        key = Stanza(sup).keys
+        s = self.index.get(key[0]) if key else None
+        if s is None:
+            s = next((s for s in self.stanzas[offset:] if s.header == sup.strip()), None)
+        if s is None:
+            s = self.add(Stanza(sup))
+        s.extend(subs)
+        self.touch(s)
+        return s
+
+    def save(self, fname=None):
+        '''Write modified files. Passing ``fname`` writes just the root file there.'''
+        if fname:
+            return self.root.save(fname)
+        for f in self.files.values():
+            if f.dirty and f.fname:
+                f.save()
+
+    # views
+
+    @property
+    def directives(self):
+        '''[[super, [subs, ...]], ...] for the root file.'''
+        return [[s.header, s.subs] for s in self.root.stanzas]
 
     @property
     def iface_priority(self):
-        return unique([
-            p[1] for p in (l.split(' ') for l, subs in self.directives)
-            if p[0] in SUPER_BLOCK_KEYS and p[1] not in IGNORED_IFACES])
+        return unique(
+            s.name for s in self.stanzas
+            if s.is_block and s.name not in IGNORED_IFACES)
 
 
 def unique(it):
@@ -82,39 +393,6 @@ def unique(it):
     return [x for x in it if not x in seen and not seen.add(x)]
 
 
-# class Directive:
-#     def __init__(self, sup, subs=()):
-#         self.sup, self.subs = sup, list(subs)
-#
-#     def __str__(self):
-#         return (
-#             str(self.sup) +
-#             ''.join(['\n    {}'.format(s) for s in self.subs]) +
-#             ('\n' if self.sup.startswith(SUPER_BLOCK_KEYS) else '')
-#         )
-#
-#     def append(self, *sub):
-#         self.subs.append(' '.join(sub))
-#
-#     def extend(self, *subs):
-#         self.subs.extend(subs)
-#
-#     def replace(self, one, two):
-#         self.sup = self.sup.replace(one, two)
-#
-#
-# class Iface(Directive):
-#     def __init__(self, iface, subs=(), allow='hotplug', ipv6=False, method='manual'):
-#         sup = 'iface {} inet{} {}'.format(iface, '6'*ipv6, method)
-#         if allow:
-#             sup = 'allow-{} {}\n'.format(allow, iface) + sup
-#         super().__init__(sup, list(subs))
-#
-#
-# def ppp(i=0, *a, **kw):
-#     return iface('ppp{}'.format(i), *a, **kw)
-
-
 if __name__ == '__main__':
     ifaces = Interfaces('input.txt')
     ifaces.swap("eth3", "lxb-mgmt")
@@ -0,0 +1,114 @@
+'''Subscribe to what NetSwitch is doing.
+
+```
+witch = NetSwitch(config)
+
+@witch.on_switch
+def restart_vpn(old, new):
+    subprocess.run(['systemctl', 'restart', 'openvpn'])
+
+witch.on_offline(flush_uploads, sync=True)  # run inline, in the check loop
+```
+
+Events (and the keyword arguments subscribers are called with):
+
+ - ``cycle_start()`` - a check is starting
+ - ``probe(iface, ok, dt)`` - an internet probe finished (``iface=None`` means any)
+ - ``switch(old, new)`` - the active ``(iface, ssid)`` changed (None means no link)
+ - ``connected(active)`` - we got internet back (or have it on the first check)
+ - ``offline()`` - we lost internet (or don't have it on the first check)
+ - ``scores(scores, choice)`` - candidates were scored (``arbitration: score`` only)
+'''
+import queue
+import asyncio
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+EVENTS = {
+    'cycle_start': (),
+    'probe': ('iface', 'ok', 'dt'),
+    'switch': ('old', 'new'),
+    'connected': ('active',),
+    'offline': (),
+    'scores': ('scores', 'choice'),
+}
+
+
+class Hooks:
+    '''Event subscribers.
+
+    Subscribers run on a background thread by default so a slow one can't stall
+    the switching loop (if too many events pile up, new ones are dropped).
+    Pass ``sync=True`` to run inline instead. Coroutine functions are scheduled
+    on ``loop`` (or run on the background thread if there isn't one).
+
+    Emitting an event that nobody subscribed to is just a dict lookup.
+    '''
+    def __init__(self, maxsize=100):
+        self._subs = {}
+        self._queue = queue.Queue(maxsize)
+        self._thread = None
+        self.dropped = 0
+
+    def on(self, event, func=None, sync=False, loop=None):
+        '''Subscribe to an event. Can be used as a decorator.'''
+        if event not in EVENTS:
+            raise ValueError('Unknown event "{}" (expected one of {})'.format(event, ', '.join(EVENTS)))
+        if func is None:
+            return lambda func: self.on(event, func, sync=sync, loop=loop)
+        # copy on write so emit never sees a list being modified
+        self._subs[event] = self._subs.get(event, ()) + ((func, sync, loop),)
+        return func
+
+    def off(self, event, func):
+        '''Unsubscribe from an event.'''
+        self._subs[event] = tuple(s for s in self._subs.get(event, ()) if s[0] is not func)
+
+    def emit(self, event, **kw):
+        subs = self._subs.get(event)
+        if not subs:
+            return
+        for func, sync, loop in subs:
+            if loop is not None and asyncio.iscoroutinefunction(func):
+                asyncio.run_coroutine_threadsafe(func(**kw), loop)
+            elif sync:
+                self._call(func, kw)
+            else:
+                self._submit(func, kw)
+
+    def _submit(self, func, kw):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._worker, name='netswitch-hooks', daemon=True)
+            self._thread.start()
+        try:
+            self._queue.put_nowait((func, kw))
+        except queue.Full:
+            self.dropped += 1
+            logger.warning('Hook queue is full, dropping %s (%d dropped so far).', _name(func), self.dropped)
+
+    def _worker(self):
+        while True:
+            func, kw = self._queue.get()
+            try:
+                self._call(func, kw)
+            finally:
+                self._queue.task_done()
+
+    def _call(self, func, kw):
+        try:
+            if asyncio.iscoroutinefunction(func):
+                asyncio.run(func(**kw))
+            else:
+                func(**kw)
+        except Exception:
+            logger.exception('Error in hook %s', _name(func))
+
+    def join(self):
+        '''Wait for the background subscribers to catch up.'''
+        self._queue.join()
+
+
+def _name(func):
+    return getattr(func, '__qualname__', None) or repr(func)
@@ -0,0 +1,105 @@
+'''Per-interface backends, and keeping track of them as interfaces come and go.
+'''
+import fnmatch
+import logging
+from . import util
+
+logger = logging.getLogger(__name__)
+
+
+class Iface:
+    '''The default backend - there's nothing to do to connect.'''
+    def __init__(self, iface):
+        self.iface = iface
+
+    def __repr__(self):
+        return '<{} {}>'.format(self.__class__.__name__, self.iface)
+
+    def connect(self, **kw):
+        return True
+
+    def close(self):
+        '''Called when the interface is gone for good.'''
+
+
+class Eth(Iface):
+    '''Wired ethernet.'''
+
+
+class PPP(Iface):
+    '''Cellular (ppp) link. If it has a dialer (``netswitch.ppp.Dialer``),
+    it's only connected when the dialer has the link up.'''
+    dialer = None
+
+    def connect(self, **kw):
+        return self.dialer is None or self.dialer.up
+
+
+class IfaceManager:
+    '''Create a backend when an interface shows up and drop it once the
+    interface has been gone for longer than ``grace`` seconds.
+
+    Anything a backend remembers (failed ssids, scanners, ...) belongs to that
+    device, so if a different device shows up under the same name (its mac
+    address changed), the old backend is dropped right away.
+    '''
+    def __init__(self, factory, grace=60):
+        self.factory = factory
+        self.grace = grace
+        self.objs = {}
+        self._ether = {}
+        self._missing = {}  # iface -> when we noticed it was gone
+
+    def __contains__(self, iface):
+        return iface in self.objs
+
+    def __getitem__(self, iface):
+        if iface not in self.objs:
+            self.objs[iface] = self.factory(iface)
+            logger.debug('Added interface backend: %s', self.objs[iface])
+        return self.objs[iface]
+
+    def get(self, iface, default=None):
+        return self.objs.get(iface, default)
+
+    def values(self):
+        return list(self.objs.values())
+
+    def update(self, interfaces):
+        '''Note which interfaces are present (``{iface: {'ether': mac, ...}}``)
+        and evict backends for interfaces that are gone.'''
+        now = util.clock.time()
+        for iface in list(self.objs):
+            info = interfaces.get(iface)
+            if info is None:
+                since = self._missing.setdefault(iface, now)
+                if now - since >= self.grace:
+                    self.evict(iface, 'gone for {:.0f}s'.format(now - since))
+                continue
+            self._missing.pop(iface, None)
+            ether = (info or {}).get('ether')
+            if ether and self._ether.get(iface) not in (None, ether):
+                self.evict(iface, 'new device ({} -> {})'.format(self._ether[iface], ether))
+        for iface, info in interfaces.items():
+            ether = (info or {}).get('ether')
+            if ether:
+                self._ether[iface] = ether
+
+    def evict(self, iface, reason=''):
+        obj = self.objs.pop(iface, None)
+        self._missing.pop(iface, None)
+        self._ether.pop(iface, None)
+        if obj is not None:
+            logger.info('Removing interface backend %s%s', obj, ' - ' + reason if reason else '')
+            close = getattr(obj, 'close', None)
+            if callable(close):
+                close()
+
+    def clear(self):
+        for iface in list(self.objs):
+            self.evict(iface)
+
+
+def get_backend(iface, backends):
+    '''Pick the backend class for an interface from ``[(pattern, cls), ...]``.'''
+    return next((cls for pat, cls in backends if fnmatch.fnmatch(iface, pat)), Iface)
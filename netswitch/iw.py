@@ -1,99 +1,448 @@
 import os
+import re
 import glob
 import math
 import time
+import shlex
 import shutil
-from collections import Counter
+import struct
+import threading
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
 import access_points
 import logging
-from . import util, wpasup
+from . import util, wpasup, commands, probe
 
 
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
 
 
 class WLan:
+    coordinator = None  # a ScanCoordinator, if scans are shared with other radios
+    trace = None        # a trace.Trace, to record scans and connections
+    store = None        # a survey.ScanStore, to keep every scan
+    ssid = None         # the last ssid we connected to
+    scan_interval = 3   # background scanning cadence (see start_scanning)
+    scan_window = 30    # how many seconds of background scans to keep
+    scan_timeout = 30   # kill the scan command if it takes longer than this
+    connect_reserve = 10  # seconds of the cycle budget to leave for connecting after scanning
+    deadline = util.Deadline()  # the current cycle's deadline (see connect)
+    bssid = None        # the bssid we pinned the connection to (see connect)
+    signal_window = 120  # seconds of signal history to keep for each bssid
+    _signal = None
+    _pin = {}           # network keys to set when activating (bssid, freq_list)
+    _scan_thread = None
     def __init__(self, iface='wlan0'):
         self.iface = iface
         self.wifi_scanner = access_points.get_scanner(iface)
         if self.wifi_scanner.cmd.startswith('sudo ') and not shutil.which('sudo'):
             self.wifi_scanner.cmd = self.wifi_scanner.cmd[5:]
+        # run the scanner's command through netswitch.commands instead of a shell
+        self.wifi_scanner.call_subprocess = self._run_scanner
         self._failed_ssids = {}
 
+    def scan_argv(self):
+        '''The scanner's command as an argv list.'''
+        # stderr is captured separately, so the shell redirect isn't needed
+        return [a for a in shlex.split(self.wifi_scanner.cmd) if a != '2>/dev/null']
 
-    def scan(self, trusted=None):
-        aps = self.wifi_scanner.get_access_points()
+    def _run_scanner(self, cmd=None, timeout=None):
+        result = commands.run(self.scan_argv(), timeout=self.scan_timeout if timeout is None else timeout)
+        if not result.ok:
+            logger.debug('[%s] Scan command failed: %s', self.iface, result.error)
+        return result.stdout
+
+
+    def scan(self, trusted=None, timeout=None):
+        t0 = util.clock.time()
+        out = access_points.ensure_str(self._run_scanner(timeout=timeout))
+        return self._scanned(tag_frequencies(self.wifi_scanner.parse_output(out), out), t0, trusted)
+
+    def _scanned(self, aps, t0, trusted=None):
         aps = sorted(aps, key=lambda ap: ap.quality, reverse=True)
+        self._record_signal(aps)
+        if self.trace is not None:
+            self.trace.write(
+                'scan', iface=self.iface, dt=util.clock.time() - t0,
+                aps=[[ap.ssid, ap.bssid, ap.quality] for ap in aps])
+        if self.store is not None:
+            try:
+                self.store.append(self.iface, aps)
+            except (OSError, struct.error) as e:
+                logger.warning('[%s] Could not store scan: %s', self.iface, e)
         #logger.info('all aps: {}'.format([a.ssid for a in aps]))
         return [ap for ap in aps if ap.ssid in trusted] if trusted else aps
 
+    # background scanning
+
+    @property
+    def scanning(self):
+        return self._scan_thread is not None and self._scan_thread.is_alive()
+
+    def start_scanning(self, interval=None, window=None):
+        '''Keep scanning in a background thread, keeping the last ``window`` seconds
+        of scans so that ``select_best_ssid`` can answer without waiting on the radio.'''
+        self.scan_interval = self.scan_interval if interval is None else interval
+        self.scan_window = self.scan_window if window is None else window
+        if self.scanning:
+            return
+        self._recent = deque()
+        self._stop_scanning = threading.Event()
+        self._scan_thread = threading.Thread(
+            target=self._scan_loop, name='netswitch-scan-{}'.format(self.iface), daemon=True)
+        self._scan_thread.start()
+
+    def stop_scanning(self):
+        if self._scan_thread is not None:
+            self._stop_scanning.set()
+            self._scan_thread.join()
+            self._scan_thread = None
+
+    def close(self):
+        self.stop_scanning()
+        if self.coordinator is not None:
+            self.coordinator.radios.pop(self.iface, None)
+
+    def _scan_loop(self):
+        while not self._stop_scanning.is_set():
+            t0 = time.time()
+            try:
+                aps = self.scan()
+            except Exception as e:
+                logger.warning('[%s] Scan failed: (%s) %s', self.iface, type(e).__name__, e)
+            else:
+                for ap in aps:
+                    ap['radio'] = self.iface
+                self._recent.append((time.time(), aps))
+                while self._recent and self._recent[0][0] < time.time() - self.scan_window:
+                    self._recent.popleft()
+            self._stop_scanning.wait(max(0, self.scan_interval - (time.time() - t0)))
+
+    def recent_scans(self, n=None, window=None):
+        '''Background scans from the last ``window`` seconds (at most the last ``n``).'''
+        if self._scan_thread is None:
+            return []
+        since = time.time() - (self.scan_window if window is None else window)
+        scans = [aps for t, aps in list(self._recent) if t >= since]
+        return scans[-n:] if n else scans
+
+    # signal history per bssid
+
+    def _record_signal(self, aps):
+        if self._signal is None:
+            self._signal = {}
+        now = util.clock.time()
+        for ap in aps:
+            if ap.bssid:
+                self._signal.setdefault(ap.bssid.lower(), deque()).append(
+                    (now, ap.quality or 0, ap.ssid, ap.frequency))
+        for bssid, hist in list(self._signal.items()):
+            while hist and hist[0][0] < now - self.signal_window:
+                hist.popleft()
+            if not hist:
+                del self._signal[bssid]
+
+    def bss_stats(self, ssid=None):
+        '''Recent signal per bssid: ``{bssid: {ssid, frequency, band, quality, n}}``,
+        where quality is the mean over the last ``signal_window`` seconds.'''
+        stats = {}
+        for bssid, hist in list((self._signal or {}).items()):
+            hist = [h for h in list(hist) if ssid is None or h[2] == ssid]
+            if hist:
+                freq = hist[-1][3]
+                stats[bssid] = dict(
+                    ssid=hist[-1][2], frequency=freq, band=band_of(freq),
+                    quality=sum(h[1] for h in hist) / len(hist), n=len(hist))
+        return stats
+
+    def _choose_pin(self, ssid, pin_bssid=False, band=None, roam_margin=8, band_bonus=10):
+        '''Pick the network keys to steer ``ssid`` to its best radio: the
+        strongest ``bssid`` (plus ``band_bonus`` if it's on the preferred band),
+        or just the preferred band's frequencies. We only move off the bssid
+        we're pinned to if the new one is better by more than ``roam_margin``.'''
+        band = band and normalize_band(band)
+        stats = self.bss_stats(ssid)
+        if not stats or not (pin_bssid or band):
+            return {}, None
+        score = lambda b: stats[b]['quality'] + (band_bonus if band and stats[b]['band'] == band else 0)
+        best = max(stats, key=score)
+        current = self.bssid if self.ssid == ssid else None
+        if current in stats and best != current and score(best) - score(current) <= roam_margin:
+            best = current
+        if pin_bssid:
+            if best != current:
+                logger.info(
+                    '[%s] Pinning %s to %s (%.0f vs %s).', self.iface, ssid, best, score(best),
+                    '{:.0f}'.format(score(current)) if current in stats else '--')
+            return {'bssid': best}, best
+        freqs = sorted({s['frequency'] for s in stats.values() if s['band'] == band})
+        return ({'freq_list': ' '.join(map(str, freqs))} if freqs else {}), None
+
     def ap_available(self, ap):
         '''Check if an ap is available.'''
         return any(1 for ap_i in self.scan() if ap in ap_i.ssid)
 
     def select_best_ssid(self, ssids=None, top=0.6, return_all=False, nscans=5, **kw): #, n_single=4
         #if ssids and len(ssids) < 3:
-        logger.info('[{}] Checking for networks: {}'.format(
-            self.iface, (', '.join(ssids) if len(ssids) < 5 else '[{} trusted]'.format(len(ssids))) if ssids else '- any -'))
-        # select best
-        nmin = math.ceil(nscans*top)
+        self._log_checking(ssids)
         top_seen, all_seen = self._get_top_ssids(ssids, nscans=nscans, **kw)
+        out_ap = self._best_ssid(top_seen, nscans, top)
+        return (out_ap, all_seen) if return_all else out_ap
+
+    def _log_checking(self, ssids):
+        logger.info(
+            '[%s] Checking for networks: %s', self.iface,
+            (', '.join(ssids) if len(ssids) < 5 else '[{} trusted]'.format(len(ssids))) if ssids else '- any -')
+
+    def _best_ssid(self, top_seen, nscans=5, top=0.6):
+        '''The ssid that was the strongest trusted one in the most scans.'''
+        nmin = math.ceil(nscans*top)
         most_common = Counter(top_seen).most_common(1)
         ap, count = most_common[0] if most_common else (None, -1)
         out_ap = count >= top and ap
         if ap and not out_ap:
-            logger.debug('AP ({}) was seen but not strong enough ({}/{}).'.format(ap, count, nmin))
-        return (out_ap, all_seen) if return_all else out_ap
+            logger.debug('AP (%s) was seen but not strong enough (%s/%s).', ap, count, nmin)
+        return out_ap
+
+    def _scans(self, nscans=5, throttle=1, timeout=30):
+        '''Yield up to ``nscans`` scans. If this radio is part of a coordinator,
+        the scans are shared with the other radios (and the rest of the cycle).
+        If it's scanning in the background, the recent scans are used right away.'''
+        recent = self.recent_scans(nscans) if self.scanning else None
+        if recent:
+            yield from recent
+            return
+
+        if self.coordinator is not None and self.iface in self.coordinator.radios:
+            for scan in self.coordinator.get_rounds(nscans, throttle=throttle, timeout=timeout):
+                yield scan.get(self.iface) or []
+            return
+
+        t0 = util.clock.time()
+        for i in range(nscans):
+            yield self.scan(timeout=self._scan_command_timeout(self.deadline))
+            # throttle and timeout
+            util.clock.sleep(throttle)
+            if timeout and util.clock.time() - t0 >= timeout or self.deadline.expired:
+                break
 
     def _get_top_ssids(self, ssids=None, nscans=5, throttle=1, timeout=30, nfails=3):
         all_seen, top_seen = set(), []
-        t0 = time.time()
         #logger.debug('Selecting best network from: {}'.format(ssids or 'all'))
         #while len(top_seen) < nscans:
-        for i in range(nscans):
-            # get ssid names
-            sids = [ap.ssid for ap in self.scan()]
-            # filter only the trusted ones
-            trusted = [s for s in sids if s in ssids] if ssids is not None else sids
-            # remove any failed ssids
-            trusted = [s for s in trusted if self._failed_ssids.get(s, 0) < nfails]
-
-            logger.debug('Scan {} - trusted: {}, all={}'.format(
-                len(top_seen), trusted, len(sids)))
-            all_seen.update(trusted)
-            top_seen.extend(trusted[:1])
-            # throttle and timeout
-            time.sleep(throttle)
-            if timeout and time.time() - t0 >= timeout:
-                break
+        for aps in self._scans(nscans, throttle=throttle, timeout=timeout):
+            self._tally(aps, ssids, nfails, top_seen, all_seen)
         return top_seen, all_seen
 
-    def connect(self, ssids='*', test=False, **kw):
-        current = wpasup.Wpa().ssid
-        originally_connected = util.internet_connected(self.iface)
-        # coerce to list of globs
-        ssids = [
-            os.path.splitext(os.path.basename(s))[0]
-            for pat in util.flatten(ssids)
-            for s in glob.glob(wpasup.ssid_path(pat))]
+    def _tally(self, aps, ssids, nfails, top_seen, all_seen):
+        '''Note the trusted ssids in a scan, and which one was strongest.'''
+        # get ssid names
+        sids = [ap.ssid for ap in aps]
+        # filter only the trusted ones
+        trusted = [s for s in sids if s in ssids] if ssids is not None else sids
+        # remove any failed ssids
+        trusted = [s for s in trusted if self._failed_ssids.get(s, 0) < nfails]
+
+        logger.debug('Scan %s - trusted: %s, all=%s', len(top_seen), trusted, len(sids))
+        all_seen.update(trusted)
+        top_seen.extend(trusted[:1])
+
+    def connect(self, ssids='*', test=False, nscans=5, top=0.6, throttle=1, timeout=30, nfails=3,
+                trusted=None, deadline=None, pin_bssid=False, band=None, roam_margin=8, band_bonus=10,
+                **kw):
+        current = self._start_connect(deadline)
+        originally_connected = self.probe()
+        ssids = self._connect_ssids(ssids, trusted)
         if not ssids:
-            logger.warning('No ssid conf files found matching the provided pattern. Check your aps directory.')
             return
 
         # check for available ssids and take best one
-        ssid = self.select_best_ssid(ssids)
+        ssid = self.select_best_ssid(
+            ssids, top=top, nscans=nscans, throttle=throttle, nfails=nfails,
+            timeout=self._select_timeout(timeout))
         if not ssid:
-            logger.info('[{}] No ssid matches.'.format(self.iface))
+            logger.info('[%s] No ssid matches.', self.iface)
             return
 
+        # steer to the best radio for that ssid
+        self._pin, bssid = self._choose_pin(ssid, pin_bssid, band, roam_margin, band_bonus)
+
         # connect to new network, revert if it failed (e.g. the password was wrong)
-        connected = test or wpasup.connect(ssid, verify=True)
-        if not connected and current and originally_connected:
-            self._failed_ssids[ssid] = self._failed_ssids.get(ssid, 0) + 1
-            logger.warning('Could not connect to {}. reverting back to {}'.format(ssid, current))
-            ssid = current
-            connected = test or wpasup.connect(ssid, verify=True)
-
-        logger.info('[{}] AP ({}) Connected? {}.'.format(self.iface, ssid, connected))
+        connected = test or self.activate(ssid)
+        if not connected and self._revert(ssid, current, originally_connected):
+            ssid, bssid = current, None
+            connected = test or self.activate(ssid)
+        return self._finish_connect(ssid, bssid, connected)
+
+    # the decisions in connect (shared with netswitch.aio, which only adds the awaits)
+
+    def _start_connect(self, deadline):
+        '''Start a connect. Returns the ssid we're on now.'''
+        # scanning, connecting and probing only get what's left of the cycle's budget
+        self.deadline = deadline or util.Deadline()
+        current = self.current_ssid()
+        self.ssid = self.ssid or current
+        return current
+
+    def _connect_ssids(self, ssids, trusted=None):
+        # coerce to list of globs (unless they were already expanded)
+        ssids = list(trusted) if trusted is not None else self.trusted_ssids(ssids)
+        if not ssids:
+            logger.warning('No ssid conf files found matching the provided pattern. Check your aps directory.')
+        return ssids
+
+    def _scan_command_timeout(self, deadline):
+        '''Kill a scan that runs past the cycle's deadline (or ``scan_timeout``).'''
+        return deadline.remaining(self.scan_timeout, floor=1)
+
+    def _select_timeout(self, timeout):
+        return self.deadline.remaining(timeout, reserve=self.connect_reserve, floor=0.1)
+
+    def _revert(self, ssid, current, originally_connected):
+        '''Whether to go back to ``current`` after failing to connect to ``ssid``.'''
+        if not (current and originally_connected):
+            return False
+        self._failed_ssids[ssid] = self._failed_ssids.get(ssid, 0) + 1
+        logger.warning('Could not connect to %s. reverting back to %s', ssid, current)
+        self._pin = {}
+        return True
+
+    def _finish_connect(self, ssid, bssid, connected):
+        logger.info('[%s] AP (%s) Connected? %s.', self.iface, ssid, connected)
+        self.ssid = ssid if connected else None
+        self.bssid = bssid if connected else None
         return connected
+
+    # the outside world - overridden when replaying traces
+
+    def current_ssid(self):
+        return wpasup.Wpa(iface=self.iface).ssid
+
+    def trusted_ssids(self, ssids='*'):
+        '''Expand ssid globs to the ssids we have credentials for.'''
+        return [
+            os.path.splitext(os.path.basename(s))[0]
+            for pat in util.flatten(ssids)
+            for s in glob.glob(wpasup.ssid_path(pat))]
+
+    def activate(self, ssid):
+        t0 = util.clock.time()
+        connected = wpasup.connect(
+            ssid, verify=True, timeout=self.deadline.remaining(floor=1), iface=self.iface, **self._pin)
+        return self._traced('connect', ssid, connected, t0)
+
+    def probe(self):
+        t0 = util.clock.time()
+        connected = util.internet_connected(
+            self.iface, timeout=self.deadline.remaining(probe.defaults['timeout'], floor=1))
+        return self._traced('probe', self.ssid, connected, t0)
+
+    def _traced(self, event, ssid, ok, t0):
+        if self.trace is not None:
+            self.trace.write(
+                event, iface=self.iface, ssid=ssid, ok=bool(ok), dt=util.clock.time() - t0)
+        return ok
+
+
+def tag_frequencies(aps, output):
+    '''Add each ap's ``frequency`` (MHz) from iwlist's output (the scanner
+    doesn't parse it). Other scanners' aps are left without one.'''
+    freqs, bssid = {}, None
+    for line in output.splitlines():
+        line = line.strip()
+        if line.startswith('Cell'):
+            bssid = line.split('Address:', 1)[-1].strip().lower()
+        elif line.startswith('Frequency:') and bssid:
+            m = re.match(r'Frequency:\s*([\d.]+)\s*GHz', line)
+            if m:
+                freqs[bssid] = int(round(float(m.group(1)) * 1000))
+    for ap in aps:
+        ap['frequency'] = freqs.get((ap.bssid or '').lower())
+    return aps
+
+
+def band_of(freq):
+    '''The band ('2.4', '5' or '6') of a frequency in MHz.'''
+    if not freq:
+        return None
+    return '2.4' if freq < 3000 else '5' if freq < 5925 else '6'
+
+
+def normalize_band(band):
+    '''``5``, ``'5GHz'``, ``'5g'`` -> ``'5'``.'''
+    band = str(band).lower().replace('ghz', '').rstrip('g').strip()
+    return '2.4' if band in ('2', '2.4') else band
+
+
+class ScanCoordinator:
+    '''Scan several radios at the same time and share the results.
+
+    The scans collected during a check cycle are kept until ``reset`` so that
+    every config entry (and every radio) looking at wifi uses the same scans
+    instead of each running its own scan loop.
+
+    ```
+    scans = ScanCoordinator({'wlan0': WLan('wlan0'), 'wlan1': WLan('wlan1')})
+    scans.scan()  # {'wlan0': [ap, ...], 'wlan1': [ap, ...]}
+    ```
+    '''
+    deadline = util.Deadline()  # the current cycle's deadline
+
+    def __init__(self, radios=None):
+        self.radios = {}
+        self.rounds = []
+        self._lock = threading.Lock()
+        self.reset(radios or {})
+
+    def reset(self, radios=None, deadline=None):
+        '''Start a new cycle (optionally with a new set of radios), with scans
+        cut short at ``deadline``.'''
+        with self._lock:
+            self.deadline = deadline or util.Deadline()
+            if radios is not None:
+                self.radios = dict(radios)
+                for wlan in self.radios.values():
+                    wlan.coordinator = self
+            self.rounds = []
+
+    def scan(self, ifaces=None):
+        '''Scan radios concurrently. Each ap is tagged with the ``radio`` that saw it.'''
+        radios = [(i, self.radios[i]) for i in ifaces or self.radios]
+        if len(radios) < 2:
+            return {i: self._scan(i, w) for i, w in radios}
+        with ThreadPoolExecutor(len(radios)) as pool:
+            futs = [(i, pool.submit(self._scan, i, w)) for i, w in radios]
+            return {i: f.result() for i, f in futs}
+
+    def _scan(self, iface, wlan):
+        try:
+            aps = wlan.scan(timeout=wlan._scan_command_timeout(self.deadline))
+        except Exception as e:
+            logger.warning('[%s] Scan failed: (%s) %s', iface, type(e).__name__, e)
+            return []
+        for ap in aps:
+            ap['radio'] = iface
+        return aps
+
+    def get_rounds(self, n=5, throttle=1, timeout=30):
+        '''Get up to ``n`` rounds of scans, only scanning for the ones we don't have yet.'''
+        with self._lock:
+            t0 = util.clock.time()
+            while len(self.rounds) < n:
+                if self.rounds:
+                    util.clock.sleep(throttle)
+                self.rounds.append(self.scan())
+                if timeout and util.clock.time() - t0 >= timeout or self.deadline.expired:
+                    break
+            return self.rounds[:n]
+
+    def view(self):
+        '''The best quality seen for each ssid, per radio: ``{radio: {ssid: quality}}``.'''
+        view = {i: {} for i in self.radios}
+        for scan in self.rounds:
+            for iface, aps in scan.items():
+                for ap in aps:
+                    q = view[iface].get(ap.ssid)
+                    if q is None or (ap.quality or 0) > q:
+                        view[iface][ap.ssid] = ap.quality or 0
+        return view
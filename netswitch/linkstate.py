@@ -0,0 +1,187 @@
+'''Cheap checks of what the kernel knows about a link.
+
+Reading a few files in /sys and /proc takes microseconds, while a probe through
+a link with no cable plugged in (or a scan on a radio that's rfkill'd) takes a
+full timeout. So before connecting and probing, we look at:
+
+ - ``/sys/class/net/<iface>/{operstate,carrier,flags}``
+ - ``/sys/class/net/<iface>/phy80211/rfkill*/{soft,hard}``
+ - whether it has an address (ipv4, or a global ipv6 from ``/proc/net/if_inet6``)
+ - the default routes in ``/proc/net/route`` and ``/proc/net/ipv6_route``
+
+The system-wide tables are read once into a ``Snapshot`` that can be shared
+by the ``read``s for every interface in a check.
+
+Anything we can't read is None (unknown) and never counts against a link, so
+this does nothing on other platforms.
+'''
+import os
+import glob
+import errno
+import socket
+import struct
+import logging
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+SYS_NET = '/sys/class/net'
+PROC_ROUTE = '/proc/net/route'
+PROC_IF_INET6 = '/proc/net/if_inet6'
+PROC_IPV6_ROUTE = '/proc/net/ipv6_route'
+
+IFF_UP = 0x1
+SIOCGIFADDR = 0x8915
+
+
+class LinkState(namedtuple('LinkState', 'iface exists admin_up operstate carrier wireless rfkill has_addr default_route')):
+    '''What the kernel says about an interface (None - unknown).'''
+    @property
+    def blocked(self):
+        '''Why connecting can't work (or None).'''
+        if self.rfkill:
+            return 'rfkill blocked'
+        # wifi has no carrier until it's associated, but a wired link should
+        if not self.wireless and self.admin_up and self.carrier is False:
+            return 'no carrier'
+        return None
+
+    @property
+    def offline(self):
+        '''Why a probe through it can't work (or None).'''
+        why = self.blocked
+        if why:
+            return why
+        if self.admin_up is False:
+            return 'interface is down'
+        if self.carrier is False:
+            return 'no carrier'
+        if self.operstate in ('down', 'lowerlayerdown', 'notpresent'):
+            return 'operstate {}'.format(self.operstate)
+        if self.has_addr is False:
+            return 'no address'
+        return None
+
+
+class Snapshot(namedtuple('Snapshot', 'routes routes6 ipv6')):
+    '''The default routes (ipv4 and ipv6) and global ipv6 addresses, read once.'''
+    @property
+    def no_default_route(self):
+        '''Whether we know there's no default route at all (ipv4 or ipv6).'''
+        return self.routes is not None and not self.routes and not self.routes6
+
+
+def snapshot():
+    return Snapshot(default_routes(), default_routes6(), _ipv6_addresses())
+
+
+def read(iface, snap=None):
+    '''Read the state of an interface (using ``snap`` for the system-wide tables).'''
+    base = os.path.join(SYS_NET, iface)
+    if not os.path.isdir(base):  # not linux, or we were told about it some other way
+        return LinkState(iface, False if os.path.isdir(SYS_NET) else None, *[None] * 7)
+    snap = snap or snapshot()
+    flags = _read(base, 'flags')
+    carrier = _read(base, 'carrier')  # EINVAL if it's admin down
+    routes = None if snap.routes is None and snap.routes6 is None else (
+        (snap.routes or set()) | (snap.routes6 or set()))
+    return LinkState(
+        iface, True,
+        bool(int(flags, 16) & IFF_UP) if flags else None,
+        _read(base, 'operstate'),
+        None if carrier is None else carrier == '1',
+        os.path.isdir(os.path.join(base, 'wireless')) or os.path.isdir(os.path.join(base, 'phy80211')),
+        _rfkill(base),
+        has_address(iface, snap.ipv6),
+        None if routes is None else iface in routes)
+
+
+def default_routes():
+    '''The interfaces with a default route (in the main table), or None if unknown.'''
+    try:
+        with open(PROC_ROUTE, 'r') as f:
+            lines = f.read().splitlines()[1:]
+    except OSError:
+        return None
+    ifaces = set()
+    for l in lines:
+        parts = l.split()
+        # Iface Destination Gateway Flags ... Mask
+        if len(parts) > 7 and parts[1] == '00000000' and parts[7] == '00000000' and int(parts[3], 16) & 1:
+            ifaces.add(parts[0])
+    return ifaces
+
+
+def default_routes6():
+    '''The interfaces with an ipv6 default route, or None if unknown.'''
+    try:
+        with open(PROC_IPV6_ROUTE, 'r') as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return None
+    ifaces = set()
+    for l in lines:
+        parts = l.split()
+        # dest dest_len src src_len next_hop metric refcnt use flags iface
+        # (the kernel keeps a reject route for ::/0 on lo)
+        if len(parts) >= 10 and parts[0] == '0' * 32 and parts[1] == '00' and int(parts[8], 16) & 1 and parts[9] != 'lo':
+            ifaces.add(parts[9])
+    return ifaces
+
+
+def has_address(iface, ipv6=None):
+    '''Whether an interface has an ipv4 or global ipv6 address (None if unknown).
+    ``ipv6`` - the global ipv6 addresses, if they've already been read.'''
+    v4 = _ipv4_address(iface)
+    if v4 or (_ipv6_addresses() if ipv6 is None else ipv6).get(iface):
+        return True
+    return None if v4 is None else False
+
+
+def _ipv4_address(iface):
+    '''The interface's ipv4 address, '' if it doesn't have one, None if we can't tell.'''
+    try:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    except OSError:
+        return None
+    try:
+        import fcntl
+        req = struct.pack('256s', iface[:15].encode())
+        return socket.inet_ntoa(fcntl.ioctl(sock.fileno(), SIOCGIFADDR, req)[20:24])
+    except OSError as e:
+        return '' if e.errno == errno.EADDRNOTAVAIL else None
+    except ImportError:  # not unix
+        return None
+    finally:
+        sock.close()
+
+
+def _ipv6_addresses():
+    '''``{iface: [address, ...]}`` for global ipv6 addresses ({} if unknown).'''
+    try:
+        with open(PROC_IF_INET6, 'r') as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return {}
+    addrs = {}
+    for l in lines:
+        parts = l.split()
+        # address ifindex prefixlen scope flags iface - scope 0 is global
+        if len(parts) >= 6 and parts[3] == '00':
+            addrs.setdefault(parts[5], []).append(parts[0])
+    return addrs
+
+
+def _rfkill(base):
+    states = [
+        _read(d, 'soft') == '1' or _read(d, 'hard') == '1'
+        for d in glob.glob(os.path.join(base, 'phy80211', 'rfkill*'))]
+    return any(states) if states else None
+
+
+def _read(base, name):
+    try:
+        with open(os.path.join(base, name), 'r') as f:
+            return f.read().strip()
+    except OSError:
+        return None
@@ -0,0 +1,152 @@
+'''Logging that's kind to SD cards.
+
+ - ``RateLimit`` drops a message that was already logged in the last ``window``
+   seconds (and says how many times it repeated when it's let through again),
+   and lets at most ``burst`` messages from the same line through per ``per``
+   seconds.
+ - ``RingBuffer`` keeps the last ``capacity`` records (debug and up) in memory
+   and only writes them to disk when something goes wrong (an error), or when
+   asked - ``kill -USR1 <pid>`` or ``python -m netswitch dump-logs``.
+
+```python
+from netswitch import logs
+logs.setup(level='INFO', ring_file='/var/log/netswitch_debug.log')
+```
+'''
+import os
+import sys
+import time
+import signal
+import logging
+import threading
+from collections import deque, OrderedDict
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RING_FILE = '/var/log/netswitch_debug.log'
+FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+
+ring = None  # the RingBuffer set up by ``setup``
+
+
+class RateLimit(logging.Filter):
+    '''Drop repeated and too frequent messages. Errors always get through.'''
+    def __init__(self, window=300, burst=10, per=60, max_keys=1000):
+        super().__init__()
+        self.window = window
+        self.burst = burst
+        self.per = per
+        self.max_keys = max_keys
+        self.suppressed = 0
+        self._seen = OrderedDict()  # (name, level, message) -> [when, times repeated]
+        self._recent = {}           # (name, level, template) -> deque of times
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.ERROR:
+            return True
+        t, msg = record.created, record.getMessage()
+        key, tkey = (record.name, record.levelno, msg), (record.name, record.levelno, record.msg)
+        with self._lock:
+            seen = self._seen.get(key)
+            if seen is not None and t - seen[0] < self.window:
+                seen[1] += 1
+                self.suppressed += 1
+                return False
+            times = self._recent.setdefault(tkey, deque())
+            while times and t - times[0] >= self.per:
+                times.popleft()
+            if len(times) >= self.burst:
+                self.suppressed += 1
+                return False
+            times.append(t)
+            self._seen[key] = [t, 0]
+            self._seen.move_to_end(key)
+            while len(self._seen) > self.max_keys:
+                self._seen.popitem(last=False)
+            if len(self._recent) > self.max_keys:
+                self._recent.clear()
+        if seen is not None and seen[1]:
+            record.msg, record.args = '{} (repeated {} times)'.format(msg, seen[1]), ()
+        return True
+
+
+class RingBuffer(logging.Handler):
+    '''Keep the last ``capacity`` records in memory, and write them to ``fname``
+    when an error is logged (at most once every ``min_interval`` seconds) or
+    when ``dump`` is called. Records are only formatted when they're written.'''
+    def __init__(self, capacity=2000, fname=DEFAULT_RING_FILE, flush_level=logging.ERROR, min_interval=60):
+        super().__init__(logging.DEBUG)
+        self.records = deque(maxlen=capacity)
+        self.fname = fname
+        self.flush_level = flush_level
+        self.min_interval = min_interval
+        self._last_flush = None
+        self.setFormatter(logging.Formatter(FORMAT))
+
+    def emit(self, record):
+        self.records.append(record)
+        if record.levelno >= self.flush_level and (
+                self._last_flush is None or record.created - self._last_flush >= self.min_interval):
+            self._last_flush = record.created
+            self.dump()
+
+    def dump(self, fname=None):
+        '''Append the buffered records to a file and clear the buffer. Returns the file.'''
+        fname = fname or self.fname
+        self.acquire()
+        try:
+            records, self.records = list(self.records), deque(maxlen=self.records.maxlen)
+        finally:
+            self.release()
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(fname)), exist_ok=True)
+            with open(fname, 'a') as f:
+                f.write('--- {} records, dumped {} ---\n'.format(len(records), time.strftime('%Y-%m-%d %H:%M:%S')))
+                f.writelines(self.format(r) + '\n' for r in records)
+        except OSError as e:
+            sys.stderr.write('Could not write the log buffer to {}: {}\n'.format(fname, e))
+            return None
+        return fname
+
+
+def setup(level='INFO', ring_size=2000, ring_file=DEFAULT_RING_FILE, window=300, burst=10, per=60):
+    '''Log ``level`` and up to stderr (rate limited), and keep debug logs in a ring buffer.'''
+    global ring
+    console = logging.StreamHandler()
+    console.setLevel(level.upper() if isinstance(level, str) else level)
+    console.setFormatter(logging.Formatter(FORMAT))
+    console.addFilter(RateLimit(window, burst, per))
+    root = logging.getLogger()
+    root.addHandler(console)
+
+    pkg = logging.getLogger('netswitch')
+    # the level is decided here - don't let a module's own level hide records from the ring
+    for name, child in list(logging.root.manager.loggerDict.items()):
+        if name.startswith('netswitch.') and isinstance(child, logging.Logger):
+            child.setLevel(logging.NOTSET)
+    if ring_size:
+        ring = RingBuffer(ring_size, ring_file)
+        pkg.addHandler(ring)
+        pkg.setLevel(logging.DEBUG)
+    else:
+        pkg.setLevel(console.level)
+    return ring
+
+
+def handle_dump_signal(sig=getattr(signal, 'SIGUSR1', None)):
+    '''Dump the ring buffer when the process gets ``sig``.'''
+    if sig is None or ring is None or threading.current_thread() is not threading.main_thread():
+        return False
+    signal.signal(sig, lambda *a: logger.warning('Dumped logs to %s', ring.dump()))
+    return True
+
+
+def dump_logs(pid=None, name='netswitch'):
+    '''Ask a running netswitch (``pid``, or the systemd service ``name``) to write its log buffer.'''
+    if pid:
+        os.kill(int(pid), signal.SIGUSR1)
+    else:
+        from . import commands
+        commands.run(['systemctl', 'kill', '--signal=SIGUSR1', '--kill-who=main', name], check=True)
+    return ring.fname if ring else DEFAULT_RING_FILE
@@ -0,0 +1,91 @@
+'''Compile the interface priority config into the steps a check runs through.
+
+The config only changes when it's reloaded, and the interfaces and trusted
+aps rarely change, so instead of matching every config entry against every
+interface on every check, we do it once and keep the result until one of
+them changes.
+'''
+import re
+import fnmatch
+from collections import namedtuple
+from . import util
+
+WIFI_PATTERN = 'wlan*'
+
+# the keys a config entry uses that aren't passed to the interface's connect
+STEP_KEYS = 'interface', 'ssids', 'restart_missing_ip', 'require_internet', 'dialer'
+
+
+class Step(namedtuple('Step', 'iface ssids restart_missing_ip require_internet options entry')):
+    '''Try to connect ``iface`` (to one of ``ssids``, if it's wifi).
+
+    ``entry`` is the index of the config entry it came from.
+    '''
+    def as_dict(self):
+        return dict(self._asdict(), ssids=list(self.ssids) if self.ssids is not None else None)
+
+
+class Plan:
+    '''An ordered list of steps, and what it was compiled from.'''
+    def __init__(self, steps, key=None):
+        self.steps = list(steps)
+        self.key = key
+
+    def __iter__(self):
+        return iter(self.steps)
+
+    def __len__(self):
+        return len(self.steps)
+
+    def __str__(self):
+        return '\n'.join(
+            '{:>2}. {:<8} {}{}'.format(
+                i + 1, s.iface,
+                '[{}]'.format(', '.join(s.ssids)) if s.ssids is not None else '',
+                ''.join(' {}={}'.format(k, v) for k, v in sorted(dict(
+                    s.options, require_internet=s.require_internet,
+                    restart_missing_ip=s.restart_missing_ip).items())))
+            for i, s in enumerate(self.steps)) or '-- no matching interfaces --'
+
+    def as_list(self):
+        return [s.as_dict() for s in self.steps]
+
+
+def pattern(*pats):
+    '''Compile glob patterns into a single regex.'''
+    return re.compile('|'.join('(?:{})'.format(fnmatch.translate(p)) for p in pats) or '(?!)')
+
+
+def compile_plan(config, interfaces, trusted=(), restart_missing_ip=False, key=None):
+    '''Build a plan from config entries, the available interfaces and trusted ssids.
+
+    Interfaces matching an entry are tried in reverse order (wlan1, then wlan0).
+    '''
+    interfaces, trusted = sorted(interfaces, reverse=True), sorted(trusted)
+    wifi = pattern(WIFI_PATTERN)
+    steps = []
+    for i, cfg in enumerate(config):
+        match = pattern(cfg['interface']).match
+        ssid_match = pattern(*(s for s in util.flatten(cfg.get('ssids') or '*') if s is not None)).match
+        ssids = tuple(s for s in trusted if ssid_match(s))
+        for iface in (x for x in interfaces if match(x)):
+            steps.append(Step(
+                iface,
+                ssids if wifi.match(iface) else None,
+                cfg.get('restart_missing_ip', restart_missing_ip),
+                cfg.get('require_internet', True),
+                {k: v for k, v in cfg.items() if k not in STEP_KEYS},
+                i))
+    return Plan(steps, key)
+
+
+def prefer(plan, order=None, demote=()):
+    '''Reorder a plan's steps - by the first pattern in ``order`` that matches
+    their interface or, without an order, by moving the ``demote`` interfaces
+    last. Ties keep their original order.'''
+    if order:
+        pats = [pattern(p).match for p in util.flatten(order)]
+        rank = lambda s: next((i for i, m in enumerate(pats) if m(s.iface)), len(pats))
+    else:
+        rank = lambda s: s.iface in demote
+    return Plan(sorted(plan.steps, key=rank), plan.key)
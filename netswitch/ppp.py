@@ -0,0 +1,168 @@
+'''Keep a cellular (ppp) link up.
+
+```
+dialer = Dialer('ppp0', 'wvdial')
+dialer.start()  # dials, and redials as soon as the link drops
+```
+
+Or from the config:
+
+```yaml
+interfaces:
+  - wlan*
+  - interface: ppp0
+    dialer: wvdial
+```
+
+Before dialing, the modem is asked if it's registered on the network
+(``AT+CREG?``) so we don't burn attempts when there's no coverage. Failed
+attempts back off exponentially (``backoff`` doubling up to ``max_backoff``
+seconds), and the backoff resets once the link comes up.
+'''
+import os
+import shlex
+import logging
+import threading
+import subprocess
+from . import util, cell
+
+logger = logging.getLogger(__name__)
+
+
+class Dialer:
+    '''Supervise a dialer process (wvdial, pppd, ...) for a ppp interface.
+
+    Arguments:
+        iface (str): the interface the dialer brings up.
+        cmd (str, list): the dialer command.
+        backoff (float): seconds to wait after the first failed attempt.
+        max_backoff (float): the most we'll wait between attempts.
+        dial_timeout (float): give up on an attempt if the link isn't up by then.
+        registration (bool): check that the modem is registered before dialing.
+        modem (str): the modem's AT command port (a glob).
+        poll (float): how often to check the link.
+    '''
+    def __init__(self, iface='ppp0', cmd='wvdial', backoff=1, max_backoff=60, dial_timeout=45,
+                 registration=True, modem=cell.DEFAULT_DEVICE_PATTERN, poll=1):
+        self.iface = iface
+        self.cmd = shlex.split(cmd) if isinstance(cmd, str) else list(cmd)
+        self.backoff, self.max_backoff = backoff, max_backoff
+        self.dial_timeout = dial_timeout
+        self.registration = registration
+        self.modem = modem
+        self.poll = poll
+        self.state = 'stopped'
+        self.attempts = 0  # failed attempts since the link was last up
+        self.dials = 0     # total
+        self._proc = None
+        self._dialed_at = None
+        self._next_attempt = 0
+        self._thread = None
+        self._stop = threading.Event()
+
+    def __repr__(self):
+        return '<{} {} {} ({})>'.format(self.__class__.__name__, self.iface, ' '.join(self.cmd), self.state)
+
+    @property
+    def up(self):
+        return self.link_up()
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self.state = 'starting'
+        self._thread = threading.Thread(
+            target=self._loop, name='netswitch-dial-{}'.format(self.iface), daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._kill()
+        self.state = 'stopped'
+
+    close = stop
+
+    # the outside world
+
+    def link_up(self):
+        return os.path.exists('/sys/class/net/{}'.format(self.iface))
+
+    def registered(self):
+        try:
+            return cell.registered(self.modem)
+        except OSError as e:  # no modem
+            logger.warning('[%s] Could not check modem registration: %s', self.iface, e)
+            return False
+
+    # supervising
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                self.step()
+            except Exception:
+                logger.exception('[%s] Dialer error', self.iface)
+            self._stop.wait(self.poll)
+
+    def step(self):
+        '''Check the link and (re)dial if needed.'''
+        now = util.clock.time()
+        if self.link_up():
+            if self.state != 'up':
+                logger.info('[%s] Link is up.', self.iface)
+            self.state, self.attempts = 'up', 0
+            return
+
+        if self.state == 'up':  # redial right away, no backoff
+            logger.warning('[%s] Link lost, redialing.', self.iface)
+            self._kill()
+            self._next_attempt = now
+
+        if self._proc is not None:
+            running = self._proc.poll() is None
+            if running and now - self._dialed_at < self.dial_timeout:
+                self.state = 'dialing'
+                return
+            logger.warning('[%s] Dial attempt failed (%s).', self.iface, 'timed out' if running else 'dialer exited')
+            self._kill()
+            self._failed(now)
+
+        if now < self._next_attempt:
+            self.state = 'backoff'
+            return
+        if self.registration and not self.registered():
+            logger.info('[%s] Modem is not registered - not dialing.', self.iface)
+            self.state = 'unregistered'
+            self._failed(now)
+            return
+        self._dial(now)
+
+    def _dial(self, now):
+        logger.info('[%s] Dialing: %s', self.iface, ' '.join(self.cmd))
+        self._proc = subprocess.Popen(
+            self.cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL, start_new_session=True)
+        self._dialed_at = now
+        self.dials += 1
+        self.state = 'dialing'
+
+    def _failed(self, now):
+        delay = min(self.backoff * 2 ** self.attempts, self.max_backoff)
+        self.attempts += 1
+        self._next_attempt = now + delay
+        logger.debug('[%s] Next attempt in %.0fs.', self.iface, delay)
+
+    def _kill(self):
+        proc, self._proc = self._proc, None
+        if proc is not None and proc.poll() is None:
+            proc.terminate()
+            try:
+                proc.wait(5)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                proc.wait()
+
@@ -0,0 +1,224 @@
+'''Connectivity probes.
+
+A probe target is a string like:
+
+ - ``icmp:8.8.8.8`` - ping
+ - ``tcp:1.1.1.1:443`` - open a tcp connection
+ - ``dns:8.8.8.8`` - send a dns query and wait for an answer
+ - ``http://connectivitycheck.gstatic.com/generate_204`` - expect a 204 (a
+   captive portal will answer with something else)
+
+``check`` fires all of them at once (through a specific interface, if given)
+and returns as soon as ``quorum`` of them succeed, or as soon as that can no
+longer happen.
+'''
+import re
+import math
+import socket
+import struct
+import random
+import logging
+import concurrent.futures
+from urllib.parse import urlsplit
+from . import util, commands
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TARGETS = (
+    'icmp:8.8.8.8',
+    'tcp:1.1.1.1:443',
+    'dns:8.8.8.8',
+    'http://connectivitycheck.gstatic.com/generate_204',
+)
+DEFAULT_QUORUM = 1
+DEFAULT_TIMEOUT = 3
+
+# can be changed from the NetSwitch config
+defaults = {'targets': DEFAULT_TARGETS, 'quorum': DEFAULT_QUORUM, 'timeout': DEFAULT_TIMEOUT}
+
+SO_BINDTODEVICE = getattr(socket, 'SO_BINDTODEVICE', 25)
+
+
+def set_defaults(targets=None, quorum=None, timeout=None):
+    '''Set the probes used by ``check`` (and ``internet_connected``) by default.'''
+    defaults['targets'] = tuple(util.flatten(targets)) if targets else DEFAULT_TARGETS
+    defaults['quorum'] = quorum or DEFAULT_QUORUM
+    defaults['timeout'] = timeout or DEFAULT_TIMEOUT
+
+
+def check(iface=None, targets=None, quorum=None, timeout=None):
+    '''Check if we can reach the internet (optionally through ``iface``).
+
+    Arguments:
+        targets (list): probe targets (see module docstring).
+        quorum (int): how many probes need to succeed. 1 means first success wins.
+        timeout (float): timeout for each probe (they all run at the same time).
+
+    Returns:
+        connected (bool)
+    '''
+    probes = [parse(t) for t in util.flatten(targets or defaults['targets'])]
+    quorum = max(1, min(quorum or defaults['quorum'], len(probes)))
+    timeout = timeout or defaults['timeout']
+    if not probes:
+        return False
+    if len(probes) == 1:
+        return _run(probes[0], iface, timeout)
+
+    pool = concurrent.futures.ThreadPoolExecutor(len(probes))
+    futs = [pool.submit(_run, p, iface, timeout) for p in probes]
+    ok = failed = 0
+    try:
+        for fut in concurrent.futures.as_completed(futs, timeout=timeout + 1):
+            if fut.result():
+                ok += 1
+            else:
+                failed += 1
+            if ok >= quorum:
+                return True
+            if failed > len(probes) - quorum:
+                return False
+    except concurrent.futures.TimeoutError:
+        pass
+    finally:  # don't wait on the stragglers
+        pool.shutdown(wait=False, cancel_futures=True)
+    return False
+
+
+def _run(probe, iface, timeout):
+    try:
+        ok = bool(probe(iface=iface, timeout=timeout))
+    except (OSError, ValueError, struct.error) as e:
+        logger.debug('Probe %s (%s) failed: (%s) %s', probe, iface, type(e).__name__, e)
+        ok = False
+    return ok
+
+
+class Probe:
+    '''A single probe target, e.g. ``Probe('tcp', '1.1.1.1:443')``.'''
+    def __init__(self, kind, target):
+        if kind not in PROBES:
+            raise ValueError('Unknown probe type "{}" (expected one of {})'.format(kind, ', '.join(PROBES)))
+        self.kind, self.target = kind, target
+
+    def __call__(self, iface=None, timeout=DEFAULT_TIMEOUT):
+        return PROBES[self.kind](self.target, iface=iface, timeout=timeout)
+
+    def __str__(self):
+        return self.target if self.kind == 'http' else '{}:{}'.format(self.kind, self.target)
+
+    def __repr__(self):
+        return '<{} {}>'.format(self.__class__.__name__, self)
+
+
+def parse(spec):
+    '''Parse a probe target string.'''
+    if isinstance(spec, Probe):
+        return spec
+    if spec.startswith(('http://', 'https://')):
+        return Probe('http', spec)
+    kind, _, target = spec.partition(':')
+    if not target:  # a bare host - ping it
+        kind, target = 'icmp', kind
+    return Probe(kind, target)
+
+
+# probes
+
+_packet_loss = re.compile(r'([\d.]+)% packet loss')
+
+def icmp(host, iface=None, timeout=DEFAULT_TIMEOUT, n=1, reliability=0.5):
+    '''Ping a host. Succeeds if packet loss is below ``reliability``.'''
+    wait = str(max(1, math.ceil(timeout)))
+    cmd = ['ping', '-c', str(n), '-W', wait, '-w', wait] + (['-I', iface] if iface else []) + [host]
+    result = commands.run(cmd, timeout=timeout + 1)
+    matches = _packet_loss.search(result.text)
+    if matches:
+        loss = float(matches.groups()[0])/100
+        if 0 < loss < 1 and loss > reliability:
+            logger.warning('packet loss high: %.1f%%', loss * 100)
+        return loss < reliability
+    return False
+
+
+def tcp(target, iface=None, timeout=DEFAULT_TIMEOUT):
+    '''Open a tcp connection to ``host:port``.'''
+    host, port = _host_port(target, 80)
+    with _connect(host, port, iface, timeout):
+        return True
+
+
+def dns(target, iface=None, timeout=DEFAULT_TIMEOUT, name='example.com'):
+    '''Ask a dns server (``host[:port]``) for an A record. Any answer counts.'''
+    host, port = _host_port(target, 53)
+    qid, query = _dns_query(name)
+    addr = socket.getaddrinfo(host, port, type=socket.SOCK_DGRAM)[0]
+    with socket.socket(addr[0], socket.SOCK_DGRAM) as s:
+        _bind(s, iface)
+        s.settimeout(timeout)
+        s.sendto(query, addr[4])
+        resp = s.recv(512)
+    return _dns_ok(qid, resp)
+
+
+def http(url, iface=None, timeout=DEFAULT_TIMEOUT, status=204):
+    '''Fetch a url and expect a certain status (204 by default, to catch captive portals).'''
+    u, request = _http_request(url)
+    with _connect(u.hostname, u.port or 80, iface, timeout) as s:
+        s.sendall(request)
+        resp = s.recv(128)
+    return _http_ok(resp, status)
+
+
+PROBES = {'icmp': icmp, 'tcp': tcp, 'dns': dns, 'http': http}
+
+
+# utils
+
+def _host_port(target, port):
+    host, _, p = target.rpartition(':') if target.count(':') == 1 else (target, '', '')
+    return host, int(p or port)
+
+
+def _dns_query(name):
+    qid = random.getrandbits(16)
+    return qid, struct.pack('>HHHHHH', qid, 0x0100, 1, 0, 0, 0) + b''.join(
+        bytes([len(p)]) + p.encode() for p in name.split('.')) + b'\0' + struct.pack('>HH', 1, 1)
+
+
+def _dns_ok(qid, resp):
+    if len(resp) < 4:  # truncated
+        return False
+    rid, flags = struct.unpack('>HH', resp[:4])
+    return rid == qid and bool(flags & 0x8000)
+
+
+def _http_request(url):
+    u = urlsplit(url)
+    if u.scheme != 'http':
+        raise ValueError('Only plain http is supported for probes: {}'.format(url))
+    return u, 'GET {} HTTP/1.1\r\nHost: {}\r\nConnection: close\r\n\r\n'.format(
+        u.path or '/', u.netloc).encode()
+
+
+def _http_ok(resp, status):
+    line = resp.split(b'\r\n', 1)[0].split()
+    return len(line) > 1 and line[1] == str(status).encode()
+
+
+def _bind(sock, iface):
+    if iface:
+        sock.setsockopt(socket.SOL_SOCKET, SO_BINDTODEVICE, iface.encode())
+
+
+def _connect(host, port, iface, timeout):
+    addr = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)[0]
+    s = socket.socket(addr[0], socket.SOCK_STREAM)
+    try:
+        _bind(s, iface)
+        s.settimeout(timeout)
+        s.connect(addr[4])
+    except BaseException:
+        s.close()
+        raise
+    return s
@@ -0,0 +1,82 @@
+'''Tell systemd how the service is doing (the sd_notify protocol).
+
+When run as a ``Type=notify`` service, systemd sets ``NOTIFY_SOCKET`` and we
+send it datagrams like ``READY=1`` (after the first check), ``STATUS=...``
+(shown by ``systemctl status``) and ``WATCHDOG=1`` (after every check, so a
+daemon stuck in a check is restarted once ``WatchdogSec`` passes). Outside of
+systemd, it all does nothing.
+'''
+import os
+import socket
+import logging
+
+logger = logging.getLogger(__name__)
+
+CHECK_TIME = 60  # how long a check might take, without a cycle_budget
+
+
+class Notifier:
+    '''Send notifications to the socket in ``NOTIFY_SOCKET`` (if there is one).'''
+    def __init__(self, path=None, environ=None):
+        environ = os.environ if environ is None else environ
+        self.path = environ.get('NOTIFY_SOCKET') if path is None else path
+        self.watchdog = _watchdog_seconds(environ)
+        self.ready = False
+        self._sock = None
+
+    def __repr__(self):
+        return '<{} {}>'.format(self.__class__.__name__, self.path or 'disabled')
+
+    @property
+    def enabled(self):
+        return bool(self.path)
+
+    def send(self, *lines, **fields):
+        '''Send ``KEY=value`` lines, e.g. ``send(READY=1, STATUS='ok')``.
+        Returns whether it was sent.'''
+        if not self.enabled:
+            return False
+        msg = '\n'.join(list(lines) + ['{}={}'.format(k, v) for k, v in fields.items()])
+        addr = '\0' + self.path[1:] if self.path.startswith('@') else self.path
+        try:
+            if self._sock is None:
+                self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self._sock.sendto(msg.encode(), addr)
+            return True
+        except OSError as e:
+            logger.debug('Could not notify systemd (%s): %s', self.path, e)
+            return False
+
+    def starting(self, seconds):
+        '''Ask systemd to wait ``seconds`` more for us to be ready (the first check).'''
+        if self.ready:
+            return False
+        return self.send(STATUS='Running the first check', EXTEND_TIMEOUT_USEC=int(seconds * 1e6))
+
+    def cycle(self, status):
+        '''A check finished: ready (the first time), the status, and a watchdog ping.'''
+        fields = {} if self.ready else {'READY': 1}
+        self.ready = True
+        return self.send(STATUS=status, WATCHDOG=1, **fields)
+
+    def ping(self):
+        return self.send(WATCHDOG=1)
+
+    def stopping(self):
+        return self.send(STOPPING=1)
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+
+def _watchdog_seconds(environ):
+    '''The watchdog timeout systemd gave us, if it's meant for this process.'''
+    usec, pid = environ.get('WATCHDOG_USEC'), environ.get('WATCHDOG_PID')
+    if not usec or pid and pid != str(os.getpid()):
+        return None
+    try:
+        return int(usec) / 1e6
+    except ValueError:
+        return None
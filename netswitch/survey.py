@@ -0,0 +1,254 @@
+'''Keep a record of the wifi environment, and survey it.
+
+Every ap seen in a scan is stored as a fixed-width record (26 bytes: time,
+bssid, radio, ssid, frequency, signal) appended to a file that can be mmap'd
+and searched by time without parsing. Radio and ssid names are stored once per
+file in a ``.names`` file next to it. Once the file gets to ``max_bytes /
+segments`` it's rotated with its names (``scans.bin`` -> ``scans.bin.1`` ->
+...), so disk use is bounded.
+
+```yaml
+scan_store: /var/lib/netswitch/scans.bin
+```
+
+```bash
+# scan all radios as fast as they'll go and print each ap as a json line
+python -m netswitch survey --store scans.bin
+# signal percentiles per ssid for the last hour
+python -m netswitch survey-stats scans.bin --since -3600
+```
+'''
+import os
+import sys
+import json
+import mmap
+import struct
+import logging
+import threading
+from collections import namedtuple
+from . import util
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'NSSCAN02'
+RECORD = struct.Struct('<d6sIIHh')  # t, bssid, radio, ssid, frequency (MHz), signal
+
+Record = namedtuple('Record', 't radio bssid ssid frequency signal')
+
+
+class ScanStore:
+    '''An append-only, rotating file of scan records.
+
+    Arguments:
+        path (str): the current file. Older ones get ``.1``, ``.2``, ... appended.
+        max_bytes (int): the most disk all of the files can use.
+        segments (int): how many files to split that into.
+    '''
+    def __init__(self, path, max_bytes=64 * 2**20, segments=4):
+        self.path = path
+        self.segments = max(2, segments)
+        self.max_bytes = max_bytes
+        self._f = None
+        self._lock = threading.Lock()
+        self._names = _load_names(self.path)
+        self._ids = {n: i for i, n in enumerate(self._names)}
+
+    def __repr__(self):
+        return '<{} {}>'.format(self.__class__.__name__, self.path)
+
+    @property
+    def segment_bytes(self):
+        return max(len(MAGIC) + RECORD.size, self.max_bytes // self.segments)
+
+    # writing
+
+    def append(self, radio, aps, t=None):
+        '''Add the aps from one scan.'''
+        t = util.clock.time() if t is None else t
+        with self._lock:
+            data = b''.join(
+                RECORD.pack(
+                    t, _pack_bssid(ap.get('bssid')), self._id(radio), self._id(ap.get('ssid') or ''),
+                    ap.get('frequency') or 0, int(ap.get('quality') or 0))
+                for ap in aps)
+            f = self._file()
+            f.write(data)
+            f.flush()
+            if f.tell() >= self.segment_bytes:
+                self._rotate()
+
+    def _file(self):
+        if self._f is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self._f = open(self.path, 'ab')
+            if self._f.tell() == 0:
+                self._f.write(MAGIC)
+        return self._f
+
+    def _rotate(self):
+        self._f.close()
+        self._f = None
+        for i in range(self.segments - 1, 0, -1):
+            src = self.path if i == 1 else '{}.{}'.format(self.path, i - 1)
+            dst = '{}.{}'.format(self.path, i)
+            for ext in ('', '.names'):
+                if os.path.exists(src + ext):
+                    os.replace(src + ext, dst + ext)
+                elif os.path.exists(dst + ext):
+                    os.remove(dst + ext)
+        # each file has its own names, so they go when its records do
+        self._names, self._ids = [], {}
+        logger.debug('Rotated scan store %s', self.path)
+
+    def close(self):
+        with self._lock:
+            if self._f is not None:
+                self._f.close()
+                self._f = None
+
+    # names
+
+    def _id(self, name):
+        i = self._ids.get(name)
+        if i is None:
+            with open(self.path + '.names', 'a') as f:
+                f.write(json.dumps(name) + '\n')
+            i = self._ids[name] = len(self._names)
+            self._names.append(name)
+        return i
+
+    # reading
+
+    def files(self):
+        '''The files, oldest first.'''
+        fs = ['{}.{}'.format(self.path, i) for i in range(self.segments - 1, 0, -1)] + [self.path]
+        return [f for f in fs if os.path.exists(f)]
+
+    def records(self, since=None, until=None, ssid=None, radio=None):
+        '''Yield records between ``since`` and ``until`` (negative times are
+        relative to now), optionally for one ssid / radio.'''
+        since, until = _abs_time(since), _abs_time(until)
+        for fname in self.files():
+            with self._lock:  # the current file's names could be being written
+                names = _load_names(fname)
+            ids = {n: i for i, n in enumerate(names)}
+            ssid_id = ids.get(ssid, -1) if ssid is not None else None
+            radio_id = ids.get(radio, -1) if radio is not None else None
+            for t, bssid, r, s, freq, signal in self._scan_file(fname, since, until):
+                if (ssid_id is None or s == ssid_id) and (radio_id is None or r == radio_id):
+                    yield Record(t, names[r], _unpack_bssid(bssid), names[s], freq or None, signal)
+
+    def _scan_file(self, fname, since=None, until=None):
+        with open(fname, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            n = (size - len(MAGIC)) // RECORD.size
+            if n <= 0:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if mm[:len(MAGIC)] != MAGIC:
+                    logger.warning('%s is not a scan store file.', fname)
+                    return
+                # records are in time order, so binary search for the range
+                at = lambda i: RECORD.unpack_from(mm, len(MAGIC) + i * RECORD.size)
+                lo = _bisect(at, n, since) if since is not None else 0
+                hi = _bisect(at, n, until, right=True) if until is not None else n
+                for i in range(lo, hi):
+                    yield at(i)
+
+    def percentiles(self, since=None, until=None, q=(10, 50, 90), by='ssid', **kw):
+        '''Signal percentiles grouped by ``ssid``, ``bssid`` or ``radio``:
+        ``{key: {'n': count, 'p10': ..., 'p50': ..., 'p90': ...}}``.'''
+        groups = {}
+        for r in self.records(since, until, **kw):
+            groups.setdefault(getattr(r, by), []).append(r.signal)
+        out = {}
+        for key, values in groups.items():
+            values.sort()
+            out[key] = dict({'p{}'.format(p): _percentile(values, p) for p in q}, n=len(values))
+        return out
+
+
+def _bisect(at, n, t, right=False):
+    lo, hi = 0, n
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if at(mid)[0] < t or right and at(mid)[0] == t:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+def _percentile(values, p):
+    '''Nearest-rank percentile of sorted values.'''
+    return values[min(len(values) - 1, max(0, int(round(p / 100. * len(values) + 0.5)) - 1))]
+
+
+def _load_names(fname):
+    try:
+        with open(fname + '.names', 'r') as f:
+            return [json.loads(l) for l in f if l.strip()]
+    except FileNotFoundError:
+        return []
+
+
+def _abs_time(t):
+    return util.clock.time() + t if t is not None and t < 0 else t
+
+
+def _pack_bssid(bssid):
+    try:
+        return bytes.fromhex((bssid or '').replace(':', '').replace('-', ''))[:6].ljust(6, b'\0')
+    except ValueError:
+        return b'\0' * 6
+
+
+def _unpack_bssid(b):
+    return ':'.join('{:02x}'.format(x) for x in b) if any(b) else None
+
+
+# cli
+
+def survey(*ifaces, interval=0, duration=None, count=None, store=None, out=None):
+    '''Scan all radios as fast as they go, printing each ap seen as a json line.
+
+    Arguments:
+        ifaces (str): radios to scan (default: wlan*).
+        interval (float): seconds between rounds of scans.
+        duration (float): stop after this many seconds.
+        count (int): stop after this many rounds.
+        store (str): also append the scans to a scan store file.
+    '''
+    from . import iw, get_ifaces
+    out = out or sys.stdout
+    coordinator = iw.ScanCoordinator({
+        i: iw.WLan(i) for i in get_ifaces(*(ifaces or ('wlan*',)))})
+    if not coordinator.radios:
+        logger.warning('No radios to survey.')
+        return
+    store = ScanStore(store) if isinstance(store, str) else store
+    t0, rounds = util.clock.time(), 0
+    try:
+        while (count is None or rounds < count) and (duration is None or util.clock.time() - t0 < duration):
+            t = util.clock.time()
+            for radio, aps in coordinator.scan().items():
+                for ap in aps:
+                    out.write(json.dumps(dict(
+                        t=round(t, 3), radio=radio, ssid=ap.ssid, bssid=ap.bssid,
+                        frequency=ap.get('frequency'), signal=ap.quality)) + '\n')
+                if store is not None:
+                    store.append(radio, aps, t)
+            out.flush()
+            rounds += 1
+            if interval:
+                util.clock.sleep(max(0, interval - (util.clock.time() - t)))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if store is not None:
+            store.close()
+
+
+def stats(path, since=None, until=None, by='ssid', ssid=None, radio=None):
+    '''Signal percentiles from a scan store (negative times are seconds ago).'''
+    return ScanStore(path).percentiles(since, until, by=by, ssid=ssid, radio=radio)
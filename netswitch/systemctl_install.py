@@ -1,6 +1,7 @@
 
 
 import shlex
+from . import sdnotify
 
 SERVICE_FNAME_TEMPLATE = '/etc/systemd/system/{}.service'
 SERVICE_TEMPLATE = '''
@@ -14,7 +15,10 @@ StandardOutput=append:/var/log/{name}_stdout.log
 StandardError=append:/var/log/{name}_stderr.log
 Restart=always
 RestartSec={restartsec}
-Type=simple
+Type=notify
+NotifyAccess=main
+WatchdogSec={watchdogsec}
+TimeoutStartSec={timeoutstartsec}
 User=root
 
 [Install]
@@ -22,8 +26,21 @@ WantedBy=multi-user.target
 '''
 
 
-def format(*a, name='netswitch', restartsec=10, **kw):
-    return SERVICE_TEMPLATE.format(args=asargs(*a, **kw), name=name, restartsec=restartsec)
+def format(*a, name='netswitch', restartsec=10, watchdogsec=None, timeoutstartsec=None, **kw):
+    '''Render the service file.
+
+    The service is ready once the first check is done, which gets
+    ``timeoutstartsec`` (default: twice the ``cycle_budget``). After that, systemd
+    restarts it if a check doesn't finish within ``watchdogsec`` (default: twice
+    the interval plus the cycle budget).'''
+    check = kw.get('cycle_budget') or sdnotify.CHECK_TIME
+    if watchdogsec is None:
+        watchdogsec = int(2 * (kw.get('interval', 20) + check))
+    if timeoutstartsec is None:
+        timeoutstartsec = int(2 * check)
+    return SERVICE_TEMPLATE.format(
+        args=asargs(*a, **kw), name=name, restartsec=restartsec,
+        watchdogsec=watchdogsec, timeoutstartsec=timeoutstartsec)
 
 
 def install(*a, name='netswitch', enable=True, **kw):
@@ -37,19 +54,17 @@ def install(*a, name='netswitch', enable=True, **kw):
     start_enable_service(name, enable=True)
 
 
-def start_enable_service(name, enable=True):
+def start_enable_service(name, enable=True, timeout=30):
+    import time
     import subprocess
-    # start service
-    cmd = ([
-            'systemctl', 'enable', name, '&&',] if enable else []) + [
-            'systemctl', 'start', name, '&&',
-            'sleep', '1', '&&',
-            'systemctl', 'status', name
-        ]
-    #print(cmd)
-    #return
+    from . import commands
     try:
-        subprocess.run(cmd, stderr=subprocess.PIPE, check=True, shell=True)
+        # start service
+        if enable:
+            commands.run(['systemctl', 'enable', name], timeout=timeout, check=True)
+        commands.run(['systemctl', 'start', name], timeout=timeout, check=True)
+        time.sleep(1)
+        print(commands.run(['systemctl', 'status', name], timeout=timeout, check=True).text)
     except subprocess.CalledProcessError as e:
         print(e.stderr.decode())
         raise
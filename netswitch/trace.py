@@ -0,0 +1,264 @@
+'''Record what netswitch sees and replay it against the switching policy.
+
+Recording (``netswitch run config.yml --record trace.jsonl``) writes one json
+event per line: interface tables, scans, probe results and connection
+attempts, each with a timestamp (and how long it took).
+
+Replaying drives the normal NetSwitch / WLan policy against a trace using a
+virtual clock, so hours of field data can be run in seconds while tuning
+``nscans``, ``top``, ``nfails``, ``interval`` and the priority list.
+
+```
+report = simulate('trace.jsonl', ['wlan*', 'ppp*'], interval=10)
+for nscans in (1, 3, 5):
+    print(nscans, simulate('trace.jsonl', [{'interface': 'wlan*', 'nscans': nscans}]))
+```
+'''
+import json
+import time
+import bisect
+import fnmatch
+import threading
+import access_points
+from . import util, iw, linkstate
+from .core import NetSwitch
+
+
+class Trace:
+    '''Append events to a jsonl file.'''
+    def __init__(self, fname):
+        self.fname = fname
+        self._f = open(fname, 'a')
+        self._lock = threading.Lock()
+
+    def write(self, event, **kw):
+        line = json.dumps(dict(t=round(util.clock.time(), 3), event=event, **kw))
+        with self._lock:
+            self._f.write(line + '\n')
+            self._f.flush()
+
+    def close(self):
+        self._f.close()
+
+
+def load(fname):
+    '''Load the events from a trace file.'''
+    with open(fname, 'r') as f:
+        return [json.loads(l) for l in f if l.strip()]
+
+
+class VirtualClock:
+    '''A clock that only moves when someone sleeps (or does something slow).'''
+    def __init__(self, t=0):
+        self.t = t
+        self._lock = threading.Lock()
+
+    def time(self):
+        return self.t
+
+    def sleep(self, dt):
+        with self._lock:
+            self.t += max(0, dt)
+
+    def advance_to(self, t):
+        '''Move forward to ``t`` (used so concurrent work only costs the slowest one).'''
+        with self._lock:
+            self.t = max(self.t, t)
+
+
+class Replay:
+    '''Look up the state recorded in a trace at a point in time.'''
+    # how long things took if the trace doesn't say
+    default_dt = {'scan': 2, 'connect': 5, 'probe': 2}
+
+    def __init__(self, events):
+        self.events = sorted(events, key=lambda e: e['t'])
+        self.start = self.events[0]['t'] if self.events else 0
+        self.end = self.events[-1]['t'] if self.events else 0
+        self._index = {}  # (event, key) -> ([t, ...], [event, ...])
+        for e in self.events:
+            for key in self._keys(e):
+                ts, es = self._index.setdefault(key, ([], []))
+                ts.append(e['t'])
+                es.append(e)
+        self.clock = VirtualClock(self.start)
+
+    @classmethod
+    def from_file(cls, fname):
+        return cls(load(fname))
+
+    def _keys(self, e):
+        kind = e['event']
+        if kind in ('scan', 'connect', 'probe'):
+            yield kind, e.get('iface')
+        if kind in ('connect', 'probe'):
+            yield kind, e.get('iface'), e.get('ssid')
+        if kind in ('interfaces', 'aps'):
+            yield kind,
+
+    def at(self, *key, t=None):
+        '''The latest event for a key, as of time ``t`` (default: now).'''
+        ts, es = self._index.get(key, ((), ()))
+        i = bisect.bisect_right(ts, self.clock.time() if t is None else t)
+        return es[i - 1] if i else (es[0] if es else None)
+
+    def spend(self, kind, event=None, t0=None):
+        '''Advance the clock by however long an event took.'''
+        dt = (event or {}).get('dt', self.default_dt.get(kind, 0))
+        t0 = self.clock.time() if t0 is None else t0
+        self.clock.advance_to(t0 + dt)
+
+    # the outside world, as it was recorded
+
+    def interfaces(self):
+        e = self.at('interfaces')
+        return dict(e['interfaces']) if e else {}
+
+    def trusted(self):
+        e = self.at('aps')
+        return e['ssids'] if e else sorted({
+            ap[0] for e in self.events if e['event'] == 'scan' for ap in e['aps']})
+
+    def scan(self, iface):
+        t0 = self.clock.time()
+        e = self.at('scan', iface)
+        self.spend('scan', e, t0)
+        return [access_points.AccessPoint(*ap, None) for ap in (e['aps'] if e else ())]
+
+    def probe(self, iface=None, ssid=None):
+        t0 = self.clock.time()
+        e = (self.at('probe', iface, ssid) if ssid else None) or self.at('probe', iface)
+        self.spend('probe', e, t0)
+        return bool(e and e['ok'])
+
+    def connect(self, iface, ssid):
+        '''Connecting works if the ap was last seen and it didn't fail when recorded.'''
+        t0 = self.clock.time()
+        e = self.at('connect', iface, ssid)
+        self.spend('connect', e, t0)
+        seen = self.at('scan', iface)
+        return bool(seen and any(ap[0] == ssid for ap in seen['aps'])) and (e is None or e['ok'])
+
+
+class ReplayWLan(iw.WLan):
+    '''A WLan that scans and connects using a trace.'''
+    def __init__(self, iface, replay):
+        self.iface = iface
+        self.replay = replay
+        self._failed_ssids = {}
+        self._current = None
+
+    def scan(self, trusted=None, timeout=None):
+        aps = sorted(self.replay.scan(self.iface), key=lambda ap: ap.quality or 0, reverse=True)
+        return [ap for ap in aps if ap.ssid in trusted] if trusted else aps
+
+    def current_ssid(self):
+        return self._current
+
+    def trusted_ssids(self, ssids='*'):
+        return util.matches(list(util.flatten(ssids)), self.replay.trusted())
+
+    def activate(self, ssid):
+        ok = self.replay.connect(self.iface, ssid)
+        self._current = ssid if ok else self._current
+        return ok
+
+    def probe(self):
+        return self.replay.probe(self.iface, self.ssid or self._current)
+
+
+class ReplayNetSwitch(NetSwitch):
+    '''A NetSwitch that sees the world through a trace.'''
+    def __init__(self, replay, *a, **kw):
+        self.replay = replay
+        super().__init__(*a, **kw)
+
+    def _on_config_update(self, *, networks=None, ap_path=None, **kw):
+        # don't touch the real aps directory when replaying
+        return super()._on_config_update(**kw)
+
+    def _get_iface_obj(self, iface):
+        if fnmatch.fnmatch(iface, 'wlan*'):
+            return ReplayWLan(iface, self.replay)
+        return super()._get_iface_obj(iface)
+
+    def _interfaces(self):
+        return self.replay.interfaces()
+
+    def _probe(self, iface=None):
+        return self.replay.probe(iface, getattr(self.iface_objs.get(iface), 'ssid', None))
+
+    def _ifup(self, iface):
+        return True
+
+    def _link_state(self, iface):
+        return linkstate.LinkState(iface, *[None] * 8)  # unknown - go by the trace
+
+    def _set_dialers(self, config):
+        pass  # don't dial anything when replaying
+
+    def _counters(self):
+        return {}
+
+    def _trusted_ssids(self):
+        return self.replay.trusted()
+
+    def _aps_version(self):
+        return None
+
+
+def simulate(trace, config=None, interval=None, duration=None, **kw):
+    '''Replay a trace against a config and report how the policy did.
+
+    Arguments:
+        trace (str, list, Replay): a trace file, its events, or a Replay.
+        config: the NetSwitch priority config.
+        interval (float): seconds between checks (default: the config's).
+        duration (float): only simulate this many seconds of the trace.
+        **kw: other NetSwitch options.
+
+    Returns:
+        report (dict): cycles, switches, offline time, decision latency, etc.
+    '''
+    replay = (
+        trace if isinstance(trace, Replay) else
+        Replay.from_file(trace) if isinstance(trace, str) else Replay(trace))
+    wall0, clock = time.time(), util.clock
+    util.clock = replay.clock
+    try:
+        witch = ReplayNetSwitch(replay, config, **kw)
+        interval = witch.interval if interval is None else interval
+        end = replay.end if duration is None else min(replay.end, replay.start + duration)
+
+        cycles, latency, switches, offline, links = 0, [], 0, 0, []
+        active = None
+        while replay.clock.time() < end:
+            t0 = replay.clock.time()
+            connected = witch.check()
+            latency.append(replay.clock.time() - t0)
+            cycles += 1
+            if cycles == 1 or witch.active != active:
+                switches += cycles > 1
+                active = witch.active
+                links.append((round(t0 - replay.start, 3), active))
+            # like NetSwitch.run, keep to the interval however long the check took
+            replay.clock.sleep(max(0, (interval or 1) - latency[-1]))
+            if not connected:
+                offline += replay.clock.time() - t0
+    finally:
+        util.clock = clock
+
+    latency = sorted(latency)
+    return {
+        'duration': round(replay.clock.time() - replay.start, 3),
+        'cycles': cycles,
+        'switches': switches,
+        'offline': round(offline, 3),
+        'latency': {
+            'mean': round(sum(latency) / len(latency), 3) if latency else None,
+            'p50': latency[len(latency) // 2] if latency else None,
+            'max': latency[-1] if latency else None,
+        },
+        'links': links,
+        'wall_time': round(time.time() - wall0, 3),
+    }
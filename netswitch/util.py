@@ -1,8 +1,11 @@
+import os
 import sys
-import re
+import time
+import tempfile
 import fnmatch
-import subprocess
+import warnings
 import logging
+from . import commands
 
 logger = logging.getLogger(__name__)
 
@@ -35,6 +38,40 @@ def flatten(*items):
 
 
 
+class Clock:
+    '''The clock used for timeouts and sleeps. Swapped for a virtual one when
+    replaying traces (see ``netswitch.trace``).'''
+    sleep = staticmethod(time.sleep)
+    time = staticmethod(time.time)
+
+clock = Clock()
+
+
+class Deadline:
+    '''A time that some work needs to be done by (no limit if ``seconds`` is None).
+
+    Each stage asks for what's left of the budget so it can cut its work short
+    (fewer scans, shorter probes) instead of running over.
+    '''
+    def __init__(self, seconds=None):
+        self.end = None if seconds is None else clock.time() + seconds
+
+    def __repr__(self):
+        return '<{} {}>'.format(self.__class__.__name__, 'unlimited' if self.end is None else '{:.1f}s left'.format(self.remaining()))
+
+    def remaining(self, default=None, reserve=0, floor=0):
+        '''Seconds left (minus ``reserve``), but no more than ``default``.
+        Without a deadline, just ``default``.'''
+        if self.end is None:
+            return default
+        left = max(floor, self.end - reserve - clock.time())
+        return left if default is None else min(default, left)
+
+    @property
+    def expired(self):
+        return self.end is not None and clock.time() >= self.end
+
+
 def mask_dict_values(dct, *keys, ch='*', drop=None):
     return {
         k: ch*len(v) if v and k in keys else v
@@ -51,46 +88,110 @@ def abbr_config(value, key):
     return value if isinstance(value, dict) else {key: value}
 
 
+# files
+
+def atomic_write(fname, data, mode=None):
+    '''Write a file so that readers only ever see the old or the new contents.
+
+    Writes to a temp file in the same directory, fsyncs it, then renames it over
+    the original (and fsyncs the directory so the rename survives a power cut).
+    '''
+    dname = os.path.dirname(os.path.abspath(fname))
+    os.makedirs(dname, exist_ok=True)
+    if mode is None:
+        mode = os.stat(fname).st_mode & 0o777 if os.path.exists(fname) else 0o644
+    data = data.encode() if isinstance(data, str) else data
+    fd, tmp = tempfile.mkstemp(prefix='.{}.'.format(os.path.basename(fname)), dir=dname)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp, mode)
+        os.replace(tmp, fname)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    _fsync_dir(dname)
+    return True
+
+
+def file_hash(fname, algorithm='sha256'):
+    '''Hash a file's contents. Returns None if the file doesn't exist.'''
+    import hashlib
+    try:
+        with open(fname, 'rb') as f:
+            return hashlib.new(algorithm, f.read()).hexdigest()
+    except FileNotFoundError:
+        return None
+
+
+def _fsync_dir(dname):
+    try:
+        fd = os.open(dname, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
 # internet
 
-_packet_loss = re.compile(r'([\d.]+)% packet loss')
-def internet_connected(iface=None, n=3, reliability=0.5):
-    '''Check if we're connected to the internet (optionally, check a specific interface `iface`)'''
-    cmd = "ping {} -c {} 8.8.8.8".format('-I {}'.format(iface) if iface else '', n)
-    #logger.info(cmd)
-    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=True)
-    matches = _packet_loss.search(result.stdout.decode('utf-8'))
-    #logger.info('stdout: {}'.format(result.stdout.decode('utf-8')))
-    if matches:
-        loss = float(matches.groups()[0])/100
-        if 0 < loss < 1 and loss > reliability:
-            logger.warning('packet loss high: {:.1%}'.format(loss))
-        return loss < reliability
-    return False
+def internet_connected(iface=None, n=None, reliability=None, *, targets=None, quorum=None, timeout=None):
+    '''Check if we're connected to the internet (optionally, check a specific interface `iface`)
+
+    Several probes (ping, tcp, dns, http) are run at once, see ``netswitch.probe``.
+    ``n`` and ``reliability`` are deprecated - they ping 8.8.8.8 like before.
+    '''
+    from . import probe
+    if n is not None or reliability is not None:
+        warnings.warn(
+            'internet_connected(iface, n, reliability) is deprecated, use targets, quorum and timeout.',
+            DeprecationWarning, stacklevel=2)
+        return probe.icmp(
+            '8.8.8.8', iface, timeout=timeout or probe.defaults['timeout'],
+            n=3 if n is None else n, reliability=0.5 if reliability is None else reliability)
+    return probe.check(iface, targets, quorum=quorum, timeout=timeout)
 
 
 # ifup / ifdown
 
-def _ifupdown_(cmd, name, sleep=1, force=True):
-    try:
-        subprocess.run(
-            #'if{} {} {} && sleep {}'.format(cmd, name, force*'--force', sleep),
-            'ifconfig {} {} && sleep {}'.format(name, cmd, sleep),
-            check=True, capture_output=True, shell=True)
-    except subprocess.CalledProcessError as e:
-        logger.error(e.stderr and e.stderr.decode())
+def _ifupdown_(cmd, name, sleep=1, force=True, timeout=30):
+    result = commands.run(['ifconfig', name, cmd], timeout=timeout)
+    if not result.ok:
+        logger.error(result.error)
         return False
+    clock.sleep(sleep)
     return True
 
-def ifup(name, sleep=1, force=True):
-    return _ifupdown_('up', name, sleep=sleep, force=force)
+def ifup(name, sleep=1, force=True, timeout=30):
+    return _ifupdown_('up', name, sleep=sleep, force=force, timeout=timeout)
+
+def ifdown(name, sleep=1, force=True, timeout=30):
+    return _ifupdown_('down', name, sleep=sleep, force=force, timeout=timeout)
+
+def wpa_reconfigure(name, timeout=10):
+    '''Tell wpa_supplicant to re-read its config without taking the interface down.'''
+    logger.info("Reconfiguring wpa_supplicant: %s", name)
+    result = commands.run(['wpa_cli', '-i', name, 'reconfigure'], timeout=timeout)
+    if not result.ok:
+        logger.error(result.error)
+        return False
+    return True
 
-def ifdown(name, sleep=1, force=True):
-    return _ifupdown_('down', name, sleep=sleep, force=force)
+def restart_iface(name=None, sleep=3, timeout=None):
+    '''Restart the specified network interface. Returns True if restarted without error.
 
-def restart_iface(name=None, sleep=3):
-    '''Restart the specified network interface. Returns True if restarted without error.'''
-    logger.info("Restarting Interface: {}".format(name))
-    went_down = ifdown(name, sleep)
-    back_up = ifup(name, sleep)
+    With a ``timeout``, the settling time is shortened to fit.'''
+    logger.info("Restarting Interface: %s", name)
+    deadline = Deadline(timeout)
+    if timeout is not None:
+        sleep = min(sleep, timeout / 4.)
+    went_down = ifdown(name, sleep, timeout=deadline.remaining(30, floor=1))
+    back_up = ifup(name, sleep, timeout=deadline.remaining(30, floor=1))
     return went_down and back_up
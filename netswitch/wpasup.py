@@ -1,9 +1,9 @@
 '''Utils for managing wpa supplicant files.
 '''
 import os
+import re
 import glob
 import logging
-from shutil import copyfile
 from . import util
 
 
@@ -12,52 +12,104 @@ logger = logging.getLogger(__name__)
 def set_ap_path(path):
     Wpa.ap_path = path
 
-def connect(ssid, verify=False):
-    return Wpa(ssid).connect() and (not verify or verify_ssid(ssid))
+def connect(ssid, verify=False, timeout=None, iface='wlan0', **keys):
+    return Wpa(ssid, iface=iface).connect(timeout=timeout, **keys) and (not verify or verify_ssid(ssid, iface))
 
-def verify_ssid(ssid):
-    return Wpa().ssid == ssid
+def verify_ssid(ssid, iface='wlan0'):
+    return Wpa(iface=iface).ssid == ssid
 
 
 class Wpa:
+    '''A wpa_supplicant config: one of the aps in ``ap_path`` (given an ssid),
+    or the one an interface is currently using.
+
+    Each interface has its own config (see ``wpa_path``) so that radios can be
+    on different networks and switching one doesn't restart the others.
+    '''
     ap_path = '/etc/wpa_supplicant/aps'
     WPA_PATH = "/etc/wpa_supplicant/wpa_supplicant.conf"
+    IFACE_WPA_PATH = "/etc/wpa_supplicant/wpa_supplicant-{iface}.conf"
+    PRIMARY_IFACE = 'wlan0'  # the interface that uses WPA_PATH
     def __init__(self, ssid=None, path=None, iface='wlan0', ap_path=None):
         self.ap_path = ap_path or self.ap_path
         self.iface = iface
-        self.path = path or (ssid_path(ssid, self.ap_path) if ssid else self.WPA_PATH)
+        self.path = path or (ssid_path(ssid, self.ap_path) if ssid else wpa_path(iface))
         self.ssid = ssid or self.info.get('ssid')
 
-    def connect(self, backup=True, restart=True):
-        '''Set ap as current wpa_supplicant.'''
-        wpa = Wpa()
-        if wpa.ssid != self.ssid:
-            if backup:
-                wpa.backup()
-            return (
-                self.copy(self.WPA_PATH)
-                and not restart or util.restart_iface(self.iface))
-        return True
+    def connect(self, backup=True, restart=True, reconfigure=False, timeout=None, **keys):
+        '''Set ap as current wpa_supplicant.
+
+        Nothing is written or restarted if the file contents are identical, but
+        changed credentials for the same ssid are applied. Use ``reconfigure``
+        to have wpa_supplicant re-read the file instead of bouncing the interface.
+        ``timeout`` bounds the restart. Extra ``keys`` (e.g. ``bssid`` or
+        ``freq_list``) are set in the network block that gets installed.
+        '''
+        installed = self.install(backup, **keys)
+        if installed is None:
+            return True
+        if not installed or not restart:
+            return installed
+        return (
+            reconfigure and util.wpa_reconfigure(self.iface, timeout=timeout or 10)
+            or util.restart_iface(self.iface, timeout=timeout))
+
+    def install(self, backup=True, **keys):
+        '''Copy this file over the interface's current config. Returns None if
+        they're already the same (so there's nothing to restart), and False if
+        there's no file to copy.'''
+        if not self.exists:
+            logger.error('No wpa_supplicant config for %s at %s.', self.ssid, self.path)
+            return False
+        wpa = Wpa(iface=self.iface)
+        keys = {k: v for k, v in keys.items() if v is not None}
+        text = set_network_keys(self.text, **keys) if keys else None
+        if text is not None and text == wpa.text or text is None and self.hash == wpa.hash:
+            return None
+        if backup and wpa.ssid != self.ssid:
+            # don't clobber (possibly newer) credentials already in aps/
+            wpa.backup(force=False)
+        if text is not None:
+            return util.atomic_write(wpa.path, text)
+        return self.copy(wpa.path) or None  # False - it was already the same
+
+    @property
+    def text(self):
+        '''The file contents (None if it doesn't exist).'''
+        if not self.exists:
+            return None
+        with open(self.path, 'r') as f:
+            return f.read()
 
     @property
     def exists(self):
         return self.path and os.path.exists(self.path)
 
+    @property
+    def hash(self):
+        '''Hash of the file contents (None if it doesn't exist).'''
+        return util.file_hash(self.path) if self.path else None
+
     def copy(self, dest):
-        '''Copy wpa_supplicant to destination.'''
+        '''Copy wpa_supplicant to destination (atomically, skipped if identical).
+        Returns whether anything was written.'''
         if self.path != dest and self.exists:
-            copyfile(self.path, dest)
-        return True
+            return _copy_if_changed(self.path, dest)
+        return False
 
     def create(self, **kw):
         '''Generate wpa supplicant.'''
         generate_wpa_config(self.ssid, **kw)
 
     def backup(self, force=True):
-        '''Make sure that the current wifi network is present in aps/.
+        '''Make sure that the current wifi network is present in aps/. A bssid
+        or band pin (see ``WLan.connect``) isn't kept - it was only for this connection.
         '''
         if force or self.ssid not in ssids_from_dir(self.ap_path):
-            self.copy(ssid_path(self.ssid, self.ap_path))
+            if self.exists:
+                _write_if_changed(
+                    ssid_path(self.ssid, self.ap_path),
+                    set_network_keys(self.text, **dict.fromkeys(PIN_KEYS)))
             return True
         return False
 
@@ -99,6 +151,22 @@ def ssid_path(ssid, ap_path=None):
     return os.path.join(ap_path or Wpa.ap_path, f'{ssid}.conf')
 
 
+def wpa_path(iface='wlan0'):
+    '''The wpa_supplicant config an interface uses: ``WPA_PATH`` for the primary
+    interface, ``wpa_supplicant-{iface}.conf`` for the others.'''
+    if not iface or iface == Wpa.PRIMARY_IFACE:
+        return Wpa.WPA_PATH
+    return Wpa.IFACE_WPA_PATH.format(iface=iface)
+
+
+def current_networks():
+    '''The current config of each interface that has one: ``{iface: Wpa}``.'''
+    prefix, suffix = Wpa.IFACE_WPA_PATH.split('{iface}')
+    ifaces = [Wpa.PRIMARY_IFACE] + sorted(
+        f[len(prefix):len(f) - len(suffix)] for f in glob.glob(prefix + '*' + suffix))
+    return {i: Wpa(iface=i) for i in ifaces if os.path.isfile(wpa_path(i))}
+
+
 def ssids_from_dir(ap_path=None, pat='*.conf'):
     '''Get file name -> file path mapping for files in a directory.
     e.g.: `{file: ap_path/file.ext for f in glob(ap_path)}`'''
@@ -114,9 +182,10 @@ def sync_aps(repo_path, ap_path=None, force=True, backup=True):
     fnames_repo = ssids_from_dir(repo_path)
     fnames_aps = ssids_from_dir(ap_path)
     for fn in (fnames_repo if force else set(fnames_repo) - set(fnames_aps)):
-        copyfile(fnames_repo[fn], os.path.join(ap_path, fn + '.conf'))
+        _copy_if_changed(fnames_repo[fn], os.path.join(ap_path, fn + '.conf'))
     if backup:
-        Wpa().backup()
+        for wpa in current_networks().values():
+            wpa.backup()
 
 
 
@@ -137,9 +206,19 @@ def generate_wpa_config(
         password (str, optional): The
 
     Returns:
-        status (bool): True if no exception was raised when creating
+        status (str): 'added', 'updated', or 'unchanged' if the file
+            already had the same contents (it isn't rewritten).
     '''
     logger.debug("Creating config for: " + str(ssid))
+    return _write_if_changed(
+        ssid_path(ssid, ap_path=ap_path),
+        render_wpa_config(ssid, password, kind, group, country, askpass, **kw))
+
+
+def render_wpa_config(
+        ssid, password=None, kind='basic', group='netdev',
+        country='US', askpass=False, **kw):
+    '''Render the contents of a single network wpa_supplicant file.'''
     password = password or kw.pop('psk', None)
     if askpass and not password:
         import getpass
@@ -148,7 +227,7 @@ def generate_wpa_config(
     if kind == 'basic':
         network = (
             dict(ssid=ssid, psk=password) if password else
-            dict(ssid, key_mgmt='NONE'))
+            dict(ssid=ssid, key_mgmt='NONE'))
     elif kind == 'edu':
         network = dict(
             ssid=ssid, proto='RSN', key_mgmt='WPA-EAP',
@@ -167,11 +246,140 @@ network={{
 {network}
 }}'''.strip()
 
-    with open(ensure_dir(ssid_path(ssid, ap_path=ap_path)), 'w') as f:
-        f.write(tmpl.format(
-            group=group, country=country,
-            network=util.indent(_wpa_keys(**network, **kw), 2)))
-    return True
+    return tmpl.format(
+        group=group, country=country,
+        network=util.indent(_wpa_keys(**network, **kw), 2))
+
+
+def update_networks(networks, ap_path=None, prune=()):
+    '''(Re)generate the files for a list of networks, only writing what changed.
+
+    Arguments:
+        networks (list[dict]): kwargs for ``generate_wpa_config``.
+        prune (list, bool): ssids whose files should be removed if they aren't
+            in ``networks``. ``True`` prunes everything else in ``ap_path``.
+
+    Returns:
+        summary (dict): {'added': [...], 'updated': [...], 'unchanged': [...], 'removed': [...]}
+    '''
+    summary = {'added': [], 'updated': [], 'unchanged': [], 'removed': []}
+    seen = set()
+    for net in networks or ():
+        net = dict(net)
+        ssid = net.pop('ssid')
+        seen.add(ssid)
+        summary[generate_wpa_config(ssid, ap_path=ap_path, **net)].append(ssid)
+    summary['removed'] = _prune(seen, ap_path, prune)
+    return summary
+
+
+def import_networks(src, ap_path=None, fmt=None, prune=False, **defaults):
+    '''Split a bunch of networks into per-ssid files in one pass.
+
+    Arguments:
+        src (str, list): a multi-network ``wpa_supplicant.conf``, a csv (with an
+            ``ssid`` column, plus ``password``, ``kind``, etc.), a yaml list (or
+            a config with a ``networks`` list), or an already loaded list of dicts.
+        fmt (str): 'wpa', 'csv' or 'yaml'. Guessed from the extension by default.
+        prune (bool, list): see ``update_networks``.
+        **defaults: default options for csv/yaml networks (e.g. ``country``).
+
+    Returns:
+        summary (dict): {'added': [...], 'updated': [...], 'unchanged': [...], 'removed': [...]}
+    '''
+    if not isinstance(src, str):
+        return update_networks([dict(defaults, **n) for n in src], ap_path, prune)
+
+    fmt = fmt or {'.csv': 'csv', '.yml': 'yaml', '.yaml': 'yaml'}.get(
+        os.path.splitext(src)[1].lower(), 'wpa')
+    with open(src, 'r') as f:
+        if fmt == 'csv':
+            import csv
+            networks = [{k: v for k, v in row.items() if k and v} for row in csv.DictReader(f)]
+        elif fmt == 'yaml':
+            import yaml
+            networks = yaml.safe_load(f) or []
+            if isinstance(networks, dict):
+                networks = networks.get('networks') or []
+        elif fmt == 'wpa':
+            return _split_wpa_config(f.read(), ap_path, prune)
+        else:
+            raise ValueError('Unknown network import format "{}"'.format(fmt))
+    return update_networks([dict(defaults, **n) for n in networks], ap_path, prune)
+
+
+def set_network_keys(text, **keys):
+    '''Set keys in the network block of a wpa_supplicant config (None removes them).'''
+    m = _network_block.search(text or '')
+    if not m:
+        return text
+    lines = [
+        l for l in m.group(1).splitlines()
+        if l.strip() and l.split('=', 1)[0].strip() not in keys]
+    lines += [util.indent(_wpa_keys(**{k: v}), 2) for k, v in keys.items() if v is not None]
+    return '{}\n{}\n{}'.format(text[:m.start(1)], '\n'.join(lines), text[m.end(1):])
+
+
+PIN_KEYS = ('bssid', 'freq_list')  # set when connecting, not part of the credentials
+
+_network_block = re.compile(r'^\s*network\s*=\s*\{(.*?)^\s*\}', re.M | re.S)
+_ssid_line = re.compile(r'^\s*ssid\s*=\s*"?(.*?)"?\s*$', re.M)
+
+def _split_wpa_config(text, ap_path=None, prune=False):
+    '''Split a multi-network wpa_supplicant.conf, keeping its global settings
+    (ctrl_interface, country, ...) at the top of every file.'''
+    header = _network_block.sub('', text).strip()
+    summary = {'added': [], 'updated': [], 'unchanged': [], 'removed': []}
+    seen = set()
+    for m in _network_block.finditer(text):
+        ssid = _ssid_line.search(m.group(1))
+        if not ssid:
+            logger.warning('Skipping network block without an ssid: %s', m.group(0))
+            continue
+        ssid = ssid.group(1)
+        body = '\n'.join(l.strip() for l in m.group(1).strip().splitlines() if l.strip())
+        seen.add(ssid)
+        summary[_write_if_changed(
+            ssid_path(ssid, ap_path=ap_path),
+            '{}\nnetwork={{\n{}\n}}'.format(header, util.indent(body, 2)).strip(),
+        )].append(ssid)
+    summary['removed'] = _prune(seen, ap_path, prune)
+    return summary
+
+
+def _prune(keep, ap_path=None, prune=()):
+    if not prune:
+        return []
+    existing = ssids_from_dir(ap_path)
+    candidates = existing if prune is True else (s for s in prune if s in existing)
+    removed = sorted(s for s in candidates if s not in keep)
+    for ssid in removed:
+        os.remove(existing[ssid])
+    return removed
+
+
+def _write_if_changed(fname, text):
+    '''Atomically write a file unless it already has those contents.'''
+    if os.path.isfile(fname):
+        with open(fname, 'r') as f:
+            if f.read() == text:
+                return 'unchanged'
+        status = 'updated'
+    else:
+        status = 'added'
+    util.atomic_write(ensure_dir(fname), text)
+    return status
+
+
+def _copy_if_changed(src, dest):
+    '''Atomically copy a file. Returns False if dest already had the same contents.'''
+    with open(src, 'rb') as f:
+        data = f.read()
+    if os.path.isfile(dest):
+        with open(dest, 'rb') as f:
+            if f.read() == data:
+                return False
+    return util.atomic_write(dest, data)
 
 
 def ensure_dir(path):
@@ -181,8 +389,11 @@ def ensure_dir(path):
     return path
 
 
+# keys that wpa_supplicant doesn't want quoted
+_UNQUOTED_KEYS = 'bssid', 'freq_list'
+
 def _wpa_keys(*a, sep='\n', **kw):
     return sep.join(list(map(str, a)) + [
-        '{}={}'.format(k, '{!r}'.format(v))
+        '{}={}'.format(k, v if k in _UNQUOTED_KEYS else '{!r}'.format(v))
         for k, v in kw.items()
     ])
@@ -0,0 +1,36 @@
+import pytest
+import netswitch
+
+
+class StubWorld:
+    '''Stand-ins for the parts of a switch that look at this machine. Set
+    ``ifaces``, ``trusted`` or ``counters`` on a subclass to change what it sees.'''
+    ifaces = {}
+    trusted = ()
+    counters = {}
+
+    def _interfaces(self):
+        return dict(self.ifaces)
+
+    def _trusted_ssids(self):
+        return list(self.trusted)
+
+    def _aps_version(self):
+        return None
+
+    def _counters(self):
+        return dict(self.counters)
+
+
+@pytest.fixture
+def stub_switch():
+    '''A NetSwitch (or ``base``) class that doesn't look at this machine, e.g.
+
+    ```
+    class Switch(stub_switch()):
+        ifaces = {'eth0': {}}
+    ```
+    '''
+    def make(base=netswitch.NetSwitch):
+        return type('Stub' + base.__name__, (StubWorld, base), {})
+    return make
@@ -0,0 +1,62 @@
+import netswitch
+from netswitch import accounting
+
+
+def test_read_counters(tmp_path):
+    fname = tmp_path / 'dev'
+    fname.write_text(
+        'Inter-|   Receive                                                |  Transmit\n'
+        ' face |bytes    packets errs drop fifo frame compressed multicast|bytes    packets errs drop fifo colls carrier compressed\n'
+        '    lo:     100       1    0    0    0     0          0         0      100       1    0    0    0     0       0          0\n'
+        '  ppp0:2000000    1500    0    0    0     0          0         0    30000     300    0    0    0     0       0          0\n')
+    assert accounting.read_counters(str(fname)) == {'lo': (100, 100), 'ppp0': (2000000, 30000)}
+    assert accounting.parse_size('1.5GB') == 1.5e9
+    assert accounting.parse_size('500M') == 5e8
+    assert accounting.format_size(2030000) == '2.0MB'
+
+
+def test_usage(tmp_path):
+    fname = str(tmp_path / 'usage.json')
+    t = 10 * accounting.DAY
+    u = accounting.Usage(fname)
+    u.sample({'ppp0': (1000, 100)}, t=t)  # first sample is just the baseline
+    assert u.total('ppp0', 'day', t) == 0
+    u.sample({'ppp0': (3000, 600)}, t=t + 10)
+    assert u.total('ppp0', 'hour', t + 10) == 2500
+    assert u.rates['ppp0'] == (200, 50)
+    # the counters reset (e.g. the modem was replugged)
+    u.sample({'ppp0': (400, 100)}, t=t + 2 * accounting.HOUR)
+    assert u.total('ppp0', 'hour', t + 2 * accounting.HOUR) == 500
+    assert u.total('ppp0', 'day', t + 2 * accounting.HOUR) == 3000
+    assert u.total('ppp0', 'month', t + 5 * accounting.DAY) == 3000
+    assert u.total('ppp0', 'day', t + 5 * accounting.DAY) == 0
+
+    assert u.over_budget({'ppp*': '2KB'}, t=t + 10) == {'ppp0'}
+    assert u.over_budget({'ppp*': {'hour': '3KB'}}, t=t + 10) == set()
+    assert u.over_budget({'wlan*': 1}, t=t + 10) == set()
+
+    # it survives restarts
+    u.sample({'ppp0': (900, 100)}, t=t + 2 * accounting.HOUR + 10)  # not saved yet
+    assert u.save(force=True)
+    u = accounting.Usage(fname)
+    assert u.total('ppp0', 'day', t + 2 * accounting.HOUR) == 3500
+    # including the counters, so the traffic since the last sample isn't dropped
+    u.sample({'ppp0': (1900, 100)}, t=t + 3 * accounting.HOUR)
+    assert u.total('ppp0', 'day', t + 3 * accounting.HOUR) == 4500
+
+
+def test_close_saves_usage(tmp_path):
+    fname = str(tmp_path / 'usage.json')
+    counters = [{'ppp0': (5000, 0)}, {'ppp0': (9000, 0)}]
+
+    class Switch(netswitch.NetSwitch):
+        def _counters(self):
+            return counters.pop(0)
+
+    witch = Switch(['ppp*'], usage_file=fname)
+    witch._account()
+    witch._account()  # within the save interval, so it's only in memory
+    assert accounting.Usage(fname)._last == {'ppp0': (5000, 0)}
+    witch.close()
+    u = accounting.Usage(fname)
+    assert u._last == {'ppp0': (9000, 0)} and u.total('ppp0') == 4000
@@ -0,0 +1,146 @@
+import time
+import socket
+import asyncio
+import pytest
+from access_points import AccessPoint
+from netswitch import aio, commands
+
+
+class FakeAsyncWLan(aio.AsyncWLan):
+    def __init__(self, iface='wlan0', scans=(), online=True):
+        super().__init__(iface)
+        self.scans_ = list(scans)
+        self.online = online
+        self.activated = []
+
+    async def scan(self, trusted=None, timeout=None):
+        await asyncio.sleep(0)
+        return self._scanned(self.scans_.pop(0) if self.scans_ else [], time.time(), trusted)
+
+    def current_ssid(self):
+        return None
+
+    async def activate(self, ssid):
+        self.activated.append(ssid)
+        return True
+
+    async def probe(self):
+        return self.online
+
+
+def ap(ssid, quality):
+    return AccessPoint(ssid, '00:00:00:00:00:00', quality, '')
+
+
+def test_run_cmd_timeout_kills():
+    async def main():
+        assert await aio.run_cmd(['echo', 'hi']) == (0, b'hi\n')
+        t0 = time.time()
+        with pytest.raises(asyncio.TimeoutError):
+            await aio.run_cmd(['sleep', '10'], timeout=0.2)
+        assert time.time() - t0 < 2
+    asyncio.run(main())
+    assert commands.metrics()['sleep']['timeouts'] >= 1
+
+    fake = commands.FakeExecutor({'ifconfig': 0})
+    with commands.use_executor(fake):
+        assert asyncio.run(aio.ifup('wlan0', sleep=0))
+    assert fake.calls == [('ifconfig', 'wlan0', 'up')]
+
+
+def test_check_quorum():
+    srv = socket.socket()
+    srv.bind(('127.0.0.1', 0))
+    srv.listen()
+    port = srv.getsockname()[1]
+    closed = socket.socket()
+    closed.bind(('127.0.0.1', 0))  # bound but not listening -> refused
+    try:
+        async def main():
+            ok = 'tcp:127.0.0.1:{}'.format(port)
+            bad = 'tcp:127.0.0.1:{}'.format(closed.getsockname()[1])
+            assert await aio.check(targets=[ok, bad], quorum=1, timeout=1)
+            assert not await aio.check(targets=[ok, bad], quorum=2, timeout=1)
+            assert not await aio.check(targets=[bad], timeout=1)
+        asyncio.run(main())
+    finally:
+        srv.close()
+        closed.close()
+
+
+def test_check_short_dns_reply():
+    srv = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    srv.bind(('127.0.0.1', 0))
+    srv.setblocking(False)
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        answered = loop.create_future()
+        loop.add_reader(srv.fileno(), lambda: answered.done() or answered.set_result(
+            srv.sendto(b'\x00', srv.recvfrom(512)[1])))  # truncated
+        try:
+            return await aio.check(targets='dns:127.0.0.1:{}'.format(srv.getsockname()[1]), timeout=1)
+        finally:
+            loop.remove_reader(srv.fileno())
+    try:
+        assert asyncio.run(main()) is False
+    finally:
+        srv.close()
+
+
+def test_async_select_best_ssid():
+    async def main():
+        wlan = FakeAsyncWLan(scans=[[ap('a', 70), ap('b', 50)]] * 2 + [[ap('b', 70)]])
+        assert await wlan.select_best_ssid(['a', 'b'], nscans=2, throttle=0) == 'a'
+        assert await wlan.connect(trusted=['a', 'b'], nscans=1, throttle=0)
+        assert wlan.ssid == 'b' and wlan.activated == ['b']
+    asyncio.run(main())
+
+
+def test_async_netswitch(stub_switch):
+    class Switch(stub_switch(aio.AsyncNetSwitch)):
+        ifaces = {'wlan0': {'inet': '10.0.0.2'}}
+        trusted = ['a']
+
+        def _get_iface_obj(self, iface):
+            return FakeAsyncWLan(iface, scans=[[ap('a', 70)]] * 5)
+
+        async def _probe(self, iface=None):
+            return iface == 'wlan0'
+
+    async def main():
+        witch = Switch([{'interface': 'wlan*', 'throttle': 0}])
+        assert await witch.check()
+        assert witch.active == ('wlan0', 'a')
+        # a hung check is cancelled
+        async def hang(**kw):
+            await asyncio.sleep(10)
+        witch._get_obj('wlan0').connect = hang
+        assert not await witch.check(timeout=0.1)
+        assert witch.active is None
+    asyncio.run(main())
+
+
+def test_check_doesnt_block_the_loop(stub_switch):
+    class Switch(stub_switch(aio.AsyncNetSwitch)):
+        def _interfaces(self):
+            time.sleep(0.3)  # like ifcfg running ifconfig
+            return {}
+
+        async def _probe(self, iface=None):
+            return True
+
+    async def main():
+        ticks = []
+
+        async def tick():
+            while True:
+                ticks.append(time.time())
+                await asyncio.sleep(0.01)
+        ticker = asyncio.ensure_future(tick())
+        try:
+            assert await Switch([]).check()
+        finally:
+            ticker.cancel()
+        return ticks
+    assert len(asyncio.run(main())) > 10
@@ -0,0 +1,68 @@
+from netswitch import util
+from netswitch.arbiter import Arbiter
+from netswitch.trace import VirtualClock
+
+
+def test_arbiter_hysteresis(monkeypatch):
+    monkeypatch.setattr(util, 'clock', VirtualClock())
+    arb = Arbiter(margin=0.5, dwell=10)
+    eth = lambda: arb.score('eth0', rank=0, n=2)
+    wlan = lambda: arb.score('wlan0', rank=1, n=2)
+
+    for ok in [1, 1, 1]:
+        arb.observe('eth0', ok), arb.observe('wlan0', 1)
+    assert arb.choose([eth(), wlan()]).iface == 'eth0'
+
+    # eth0 starts dropping probes - wlan0 has to stay better for the dwell time
+    arb.observe('eth0', 0), arb.observe('eth0', 0)
+    assert arb.choose([eth(), wlan()], 'eth0').iface == 'eth0'
+    assert arb.challenger[0] == 'wlan0'
+    util.clock.sleep(5)
+    assert arb.choose([eth(), wlan()], 'eth0').iface == 'eth0'
+    util.clock.sleep(5)
+    assert arb.choose([eth(), wlan()], 'eth0').iface == 'wlan0'
+    assert arb.scores[0].iface == 'wlan0'
+
+    # a blip doesn't send us back and forth
+    arb.observe('eth0', 1)
+    assert arb.choose([eth(), wlan()], 'wlan0').iface == 'wlan0'
+
+    # but if the current link is down, move now
+    down = arb.score('wlan0', ok=False, rank=1, n=2)
+    assert arb.choose([eth(), down], 'wlan0').iface == 'eth0'
+    assert arb.choose([down]) is None
+
+
+def test_score_mode(monkeypatch, stub_switch):
+    monkeypatch.setattr(util, 'clock', VirtualClock())
+    lossy = None
+
+    class Switch(stub_switch()):
+        ifaces = {'eth0': {}, 'ppp0': {}}
+
+        def _probe(self, iface=None):
+            return bool(next(lossy)) if iface == 'eth0' else True
+
+    config = ['eth0', 'ppp0']
+    lossy = iter([1, 0, 0, 0])
+    # first match sticks with eth0 as long as a probe gets through
+    witch = Switch(config)
+    assert witch.check() and witch.active == ('eth0', None)
+
+    seen = []
+    lossy = iter([1, 0, 0, 0])
+    witch = Switch(config, arbitration='score', arbitration_dwell=0, costs={'ppp*': 0.5})
+    witch.on_scores(lambda scores, choice: seen.append(choice), sync=True)
+    assert witch.check() and witch.active[0] == 'eth0'
+    for _ in range(3):
+        witch.check()
+    assert witch.active[0] == 'ppp0'
+    assert seen[0] == 'eth0' and seen[-1] == 'ppp0'
+    assert [s['iface'] for s in witch.scores] == ['ppp0', 'eth0']
+    assert witch.scores[0]['cost'] == 0.5
+
+    # a weight dropped from the config goes back to its default
+    witch._on_config_update(interfaces=config, arbitration='score', score_weights={'quality': 5})
+    assert witch.arbiter.weights['quality'] == 5
+    witch._on_config_update(interfaces=config, arbitration='score', score_weights={'cost': 2})
+    assert witch.arbiter.weights == {'priority': 1., 'quality': 2., 'cost': 2}
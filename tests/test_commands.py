@@ -0,0 +1,82 @@
+import time
+import asyncio
+import threading
+import subprocess
+import pytest
+import netswitch
+from netswitch import commands
+
+
+def test_run():
+    runner = commands.Runner()
+    r = runner.run(['echo', 'hi there'])
+    assert r.ok and r.text == 'hi there\n'
+    assert not runner.run(['false']).ok
+    assert runner.run(['definitely-not-a-command']).returncode == 127
+    with pytest.raises(subprocess.CalledProcessError):
+        runner.run(['false'], check=True)
+
+    # hung commands are killed
+    t0 = time.time()
+    r = runner.run(['sleep', '10'], timeout=0.2)
+    assert r.timed_out and not r.ok and time.time() - t0 < 2
+    with pytest.raises(subprocess.TimeoutExpired):
+        r.check()
+
+    m = runner.metrics()
+    assert m['echo']['count'] == 1 and m['false']['failures'] == 2
+    assert m['sleep']['timeouts'] == 1
+
+
+def test_dedup():
+    fake = commands.FakeExecutor({'iwlist': 'scan results'}, delay=0.2)
+    runner = commands.Runner(fake)
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(runner.run(['iwlist', 'wlan0', 'scanning'])))
+        for _ in range(3)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(fake.calls) == 1
+    assert [r.text for r in results] == ['scan results'] * 3
+    assert runner.metrics()['iwlist']['deduped'] == 2
+    # not deduped once it's done
+    runner.run(['iwlist', 'wlan0', 'scanning'])
+    assert len(fake.calls) == 2
+
+
+def test_arun_dedup():
+    fake = commands.FakeExecutor({'iwlist': 'scan results'}, delay=0.2)
+    runner = commands.Runner(fake)
+
+    async def main():
+        return await asyncio.gather(*[runner.arun(['iwlist', 'wlan0', 'scanning']) for _ in range(3)])
+    results = asyncio.run(main())
+    assert [r.text for r in results] == ['scan results'] * 3
+    assert fake.calls == [('iwlist', 'wlan0', 'scanning')]
+    assert runner.metrics()['iwlist']['count'] == 1 and runner.metrics()['iwlist']['deduped'] == 2
+
+
+def test_fake_executor():
+    fake = commands.FakeExecutor({('ifconfig', 'wlan1', 'up'): 1})
+    with commands.use_executor(fake):
+        assert netswitch.util.ifup('wlan0', sleep=0)
+        assert not netswitch.util.ifup('wlan1', sleep=0)
+        assert netswitch.util.wpa_reconfigure('wlan0')
+    assert fake.calls == [
+        ('ifconfig', 'wlan0', 'up'), ('ifconfig', 'wlan1', 'up'),
+        ('wpa_cli', '-i', 'wlan0', 'reconfigure')]
+    assert commands.runner.executor is not fake
+
+
+def test_internet_connected_old_args():
+    fake = commands.FakeExecutor({'ping': '3 packets transmitted, 3 received, 0% packet loss'})
+    with commands.use_executor(fake):
+        # the old (iface, n, reliability) arguments still ping
+        with pytest.warns(DeprecationWarning):
+            assert netswitch.util.internet_connected('wlan0', 3)
+    assert fake.calls[0][:3] == ('ping', '-c', '3') and fake.calls[0][-1] == '8.8.8.8'
+    with pytest.raises(TypeError):  # the new ones are keyword only
+        netswitch.util.internet_connected('wlan0', 1, 0.5, ['tcp:1.1.1.1'])
@@ -41,9 +41,9 @@ def test_cell():
 #     print(best_ap, all_aps)
 
 
-def test_wpasup(tmp_path):
-    netswitch.Wpa.ap_path = str(tmp_path / 'wpa/aps')
-    netswitch.Wpa.WPA_PATH = str(tmp_path / 'wpa/wpa_supplicant.conf')
+def test_wpasup(tmp_path, monkeypatch):
+    monkeypatch.setattr(netswitch.Wpa, 'ap_path', str(tmp_path / 'wpa/aps'))
+    monkeypatch.setattr(netswitch.Wpa, 'WPA_PATH', str(tmp_path / 'wpa/wpa_supplicant.conf'))
 
     creds = [
         ('asdf', 'asdf'),
@@ -93,3 +93,407 @@ def test_wpasup(tmp_path):
     wpsup2.connect(restart=False)
     assert os.path.isfile(wpsup.path)
     assert netswitch.Wpa().ssid == wpsup2.ssid
+
+
+def test_etcinterfaces(tmp_path):
+    from netswitch.etcinterfaces import Interfaces
+    (tmp_path / 'interfaces.d').mkdir()
+    body = '\n'.join([
+        '# main file',
+        'source-directory interfaces.d',
+        '',
+        'auto eth0',
+        'iface eth0 inet manual',
+        '  # a comment',
+        '  post-up echo hi',
+        '',
+    ])
+    (tmp_path / 'interfaces').write_text(body)
+    (tmp_path / 'interfaces.d' / 'ppp').write_text('allow-hotplug ppp0\niface ppp0 inet wvdial\n')
+    (tmp_path / 'interfaces.d' / 'ignored.conf').write_text('iface nope inet manual\n')
+
+    ifaces = Interfaces(str(tmp_path / 'interfaces'))
+    assert str(ifaces) == body  # round trips untouched
+    assert ifaces.iface_priority == ['ppp0', 'eth0']
+    assert ifaces['ppp0'].method == 'wvdial'
+    assert ifaces.get('ppp0', 'allow-hotplug') is not None
+
+    ifaces['eth0'].set_option('post-up', 'echo bye')
+    ifaces.touch(ifaces['eth0'])
+    ifaces.add_subs('iface wlan0 inet manual', ['wpa-roam /etc/wpa.conf'])
+    ifaces.save()
+    assert '  # a comment\n  post-up echo bye' in (tmp_path / 'interfaces').read_text()
+
+    ifaces = Interfaces(str(tmp_path / 'interfaces'))
+    assert ifaces['wlan0'].options == {'wpa-roam': ['/etc/wpa.conf']}
+    assert not ifaces.refresh()
+
+    # an edit that keeps the same mtime is still seen (the size changed)
+    fname = tmp_path / 'interfaces.d' / 'ppp'
+    st = os.stat(fname)
+    fname.write_text('allow-hotplug ppp0\niface ppp0 inet ppp\n')
+    os.utime(fname, ns=(st.st_atime_ns, st.st_mtime_ns))
+    ifaces = Interfaces(str(tmp_path / 'interfaces'))
+    assert ifaces['ppp0'].method == 'ppp'
+
+    # a new file in a source-directory is picked up
+    (tmp_path / 'interfaces.d' / 'wlan1').write_text('iface wlan1 inet manual\n')
+    assert ifaces.refresh() and 'wlan1' in ifaces
+    assert not ifaces.refresh()
+    # and a missing file isn't a change every time
+    missing = Interfaces(str(tmp_path / 'nope'))
+    assert not missing.refresh()
+
+
+def test_etciface_gen(tmp_path, monkeypatch):
+    from netswitch import etciface_gen, util
+    fname = str(tmp_path / 'interfaces')
+    with open(fname, 'w') as f:
+        f.write('# keep me\nauto eth0\niface eth0 inet manual\n')
+
+    restarted = []
+    monkeypatch.setattr(util, 'restart_iface', restarted.append)
+    config = ['eth0', {'interface': 'wlan0', 'ssids': 'asdf'}]
+    assert etciface_gen.diff_config(config, fname) == ['lo', 'wlan0']
+    assert etciface_gen.apply(config, fname, restart=False) == ['lo', 'wlan0']
+    body = open(fname).read()
+    assert body.startswith('# keep me\nauto eth0\niface eth0 inet manual\n')
+    assert 'wpa-roam /etc/wpa_supplicant/wpa_supplicant.conf' in body
+
+    # nothing changed - nothing written or restarted
+    mtime = os.path.getmtime(fname)
+    assert etciface_gen.apply(config, fname) == []
+    assert os.path.getmtime(fname) == mtime
+    assert not restarted
+
+    config[1]['etc'] = {'wpa': '/etc/other.conf'}
+    assert etciface_gen.apply(config, fname, restart=False) == ['wlan0']
+    assert 'wpa-roam /etc/other.conf' in open(fname).read()
+
+    # an interface matched by two entries only gets one stanza, so applying is idempotent
+    config = ['wlan*', 'eth*', {'interface': 'wlan0', 'etc': {'wpa': '/etc/ignored.conf'}}, 'usb0']
+    assert etciface_gen.apply(config, fname, restart=False) == ['wlan0', 'wlan1', 'eth1']
+    assert etciface_gen.apply(config, fname) == [] and not restarted
+    assert 'ignored' not in open(fname).read()
+
+    # or from a config file
+    conf = tmp_path / 'config.yml'
+    conf.write_text('interfaces: [eth0, usb0, {interface: ppp0}]\n')
+    assert etciface_gen.diff_config(str(conf), fname) == ['ppp0']
+
+
+def test_wpasup_connect_hash(tmp_path, monkeypatch):
+    from netswitch import util
+    monkeypatch.setattr(netswitch.Wpa, 'ap_path', str(tmp_path / 'aps'))
+    monkeypatch.setattr(netswitch.Wpa, 'WPA_PATH', str(tmp_path / 'wpa_supplicant.conf'))
+    restarted = []
+    monkeypatch.setattr(util, 'restart_iface', lambda iface, **kw: restarted.append(iface) or True)
+
+    netswitch.generate_wpa_config('asdf', 'password1')
+    assert netswitch.Wpa('asdf').connect()
+    assert restarted == ['wlan0']
+
+    # identical bytes - no restart
+    assert netswitch.Wpa('asdf').connect()
+    assert restarted == ['wlan0']
+
+    # same ssid, new credentials - applied
+    netswitch.generate_wpa_config('asdf', 'password2')
+    assert netswitch.Wpa('asdf').connect()
+    assert restarted == ['wlan0', 'wlan0']
+    assert netswitch.Wpa().password == 'password2'
+    assert not [f for f in os.listdir(tmp_path) if f.startswith('.')]  # no temp files left
+
+
+def test_wpasup_per_iface(tmp_path, monkeypatch):
+    from netswitch import util, etciface_gen
+    monkeypatch.setattr(netswitch.Wpa, 'ap_path', str(tmp_path / 'aps'))
+    monkeypatch.setattr(netswitch.Wpa, 'WPA_PATH', str(tmp_path / 'wpa_supplicant.conf'))
+    monkeypatch.setattr(netswitch.Wpa, 'IFACE_WPA_PATH', str(tmp_path / 'wpa_supplicant-{iface}.conf'))
+    restarted = []
+    monkeypatch.setattr(util, 'restart_iface', lambda iface, **kw: restarted.append(iface) or True)
+    netswitch.generate_wpa_config('home', 'password')
+    netswitch.generate_wpa_config('backup', 'password')
+
+    # each radio has its own network, and only it is restarted
+    assert netswitch.wpasup.connect('home', verify=True)
+    assert netswitch.wpasup.connect('backup', verify=True, iface='wlan1')
+    assert restarted == ['wlan0', 'wlan1']
+    assert netswitch.Wpa().ssid == 'home'
+    assert netswitch.Wpa(iface='wlan1').path == str(tmp_path / 'wpa_supplicant-wlan1.conf')
+    assert netswitch.Wpa(iface='wlan1').ssid == 'backup'
+    assert {i: w.ssid for i, w in netswitch.wpasup.current_networks().items()} == {
+        'wlan0': 'home', 'wlan1': 'backup'}
+    assert netswitch.WLan('wlan1').current_ssid() == 'backup'
+    assert 'wpa-roam {}'.format(tmp_path / 'wpa_supplicant-wlan1.conf') in etciface_gen.wlan(1)
+
+
+def test_import_networks(tmp_path):
+    ap_path = str(tmp_path / 'aps')
+    conf = tmp_path / 'wpa_supplicant.conf'
+    conf.write_text('''
+ctrl_interface=DIR=/var/run/wpa_supplicant GROUP=netdev
+country=US
+
+network={
+    ssid="home"
+    psk="secret"
+}
+
+network={
+    ssid="work"
+    key_mgmt=NONE
+}
+''')
+    summary = netswitch.import_networks(str(conf), ap_path)
+    assert summary['added'] == ['home', 'work']
+    assert netswitch.Wpa('home', ap_path=ap_path).password == 'secret'
+    assert netswitch.Wpa('work', ap_path=ap_path).info['country'] == 'US'
+
+    # re-importing is a no-op
+    assert netswitch.import_networks(str(conf), ap_path)['unchanged'] == ['home', 'work']
+
+    csv = tmp_path / 'networks.csv'
+    csv.write_text('ssid,password\nhome,secret2\ncafe,coffee\n')
+    summary = netswitch.import_networks(str(csv), ap_path, prune=True)
+    assert summary == {
+        'added': ['cafe'], 'updated': ['home'], 'unchanged': [], 'removed': ['work']}
+    assert sorted(netswitch.ssids_from_dir(ap_path)) == ['cafe', 'home']
+
+
+class FakeWLan(netswitch.WLan):
+    '''A WLan that "scans" from a list of (ssid, quality) instead of a radio.'''
+    def __init__(self, iface='wlan0', aps=(), delay=0):
+        self.iface = iface
+        self.aps = list(aps)
+        self.delay = delay
+        self.nscans = 0
+        self._failed_ssids = {}
+
+    def scan(self, trusted=None, timeout=None):
+        import time
+        import access_points
+        time.sleep(self.delay)
+        self.nscans += 1
+        aps = [access_points.AccessPoint(s, None, q, None) for s, q in self.aps]
+        aps = sorted(aps, key=lambda ap: ap.quality, reverse=True)
+        return [ap for ap in aps if ap.ssid in trusted] if trusted else aps
+
+
+def test_scan_coordinator():
+    import time
+    wlan0 = FakeWLan('wlan0', [('a', 50), ('b', 60)], delay=0.1)
+    wlan1 = FakeWLan('wlan1', [('a', 70)], delay=0.1)
+    scans = netswitch.ScanCoordinator({'wlan0': wlan0, 'wlan1': wlan1})
+
+    t0 = time.time()
+    assert wlan1.select_best_ssid(['a', 'b'], nscans=3, throttle=0) == 'a'
+    assert time.time() - t0 < 0.5  # radios are scanned at the same time
+    assert wlan0.select_best_ssid(['a', 'b'], nscans=3, throttle=0) == 'b'
+    assert (wlan0.nscans, wlan1.nscans) == (3, 3)  # the second radio reused the scans
+
+    assert scans.view() == {'wlan0': {'a': 50, 'b': 60}, 'wlan1': {'a': 70}}
+    assert all(ap.radio == i for i, aps in scans.rounds[0].items() for ap in aps)
+    scans.reset()
+    wlan0.select_best_ssid(['a'], nscans=1, throttle=0)
+    assert (wlan0.nscans, wlan1.nscans) == (4, 4)
+
+
+def test_background_scanning():
+    import time
+    wlan = FakeWLan('wlan0', [('a', 50)])
+    wlan.start_scanning(interval=0.01, window=5)
+    try:
+        while not wlan.recent_scans():
+            time.sleep(0.01)
+        t0 = time.time()
+        assert wlan.select_best_ssid(['a'], nscans=5, throttle=1) == 'a'
+        assert time.time() - t0 < 0.5  # answered from the buffer, not by scanning
+        assert wlan.recent_scans(1)[0][0].radio == 'wlan0'
+    finally:
+        wlan.stop_scanning()
+    assert not wlan.scanning
+
+
+def test_plan(tmp_path, monkeypatch):
+    monkeypatch.setattr(netswitch.Wpa, 'ap_path', str(tmp_path / 'aps'))
+    for ssid in ('home', 'home-5G', 'work'):
+        netswitch.generate_wpa_config(ssid, 'password')
+
+    class Switch(netswitch.NetSwitch):
+        ifaces = {'wlan0': {}, 'wlan1': {}, 'eth0': {}}
+        def _interfaces(self):
+            return dict(self.ifaces)
+
+    witch = Switch([
+        {'interface': 'wlan*', 'ssids': 'home*', 'nscans': 2},
+        {'interface': 'eth*', 'require_internet': False},
+        'wlan0',
+    ])
+    plan = witch.get_plan()
+    assert [(s.iface, s.ssids) for s in plan] == [
+        ('wlan1', ('home', 'home-5G')), ('wlan0', ('home', 'home-5G')),
+        ('eth0', None), ('wlan0', ('home', 'home-5G', 'work'))]
+    assert plan.steps[0].options == {'nscans': 2}
+    assert not plan.steps[2].require_internet
+
+    # cached until the interfaces, config or aps change
+    assert witch.get_plan() is plan
+    witch.ifaces.pop('wlan1')
+    assert witch.get_plan() is not plan
+    assert [s.iface for s in witch.get_plan()] == ['wlan0', 'eth0', 'wlan0']
+
+
+def test_iface_lifecycle():
+    from netswitch import util
+    from netswitch.trace import VirtualClock
+    from netswitch.ifaces import IfaceManager, Eth
+    clock, util.clock = util.clock, VirtualClock()
+    try:
+        closed = []
+        class Backend(Eth):
+            def close(self):
+                closed.append(self.iface)
+
+        objs = IfaceManager(Backend, grace=30)
+        eth0 = objs['eth0']
+        objs.update({'eth0': {'ether': 'aa'}})
+        assert objs['eth0'] is eth0
+
+        # unplugged briefly - kept
+        objs.update({})
+        util.clock.sleep(10)
+        objs.update({'eth0': {'ether': 'aa'}})
+        assert objs['eth0'] is eth0 and not closed
+
+        # gone for longer than the grace period - evicted
+        objs.update({})
+        util.clock.sleep(31)
+        objs.update({})
+        assert 'eth0' not in objs and closed == ['eth0']
+
+        # a different device under the same name - evicted right away
+        eth0 = objs['eth0']
+        objs.update({'eth0': {'ether': 'aa'}})
+        objs.update({'eth0': {'ether': 'bb'}})
+        assert objs['eth0'] is not eth0 and closed == ['eth0', 'eth0']
+    finally:
+        util.clock = clock
+
+
+def test_netswitch_instances_dont_share_ifaces():
+    a, b = netswitch.NetSwitch([]), netswitch.NetSwitch([])
+    assert a._get_obj('eth0') is not b._get_obj('eth0')
+    assert isinstance(a._get_obj('ppp0'), netswitch.ifaces.PPP)
+
+
+def test_cycle_budget(monkeypatch, stub_switch):
+    from netswitch import util
+    from netswitch.trace import VirtualClock
+    monkeypatch.setattr(util, 'clock', VirtualClock())
+
+    d = util.Deadline(10)
+    assert d.remaining(3) == 3 and d.remaining() == 10 and d.remaining(reserve=4) == 6
+    assert util.Deadline().remaining(3) == 3 and not util.Deadline().expired
+
+    class SlowWLan(FakeWLan):
+        def scan(self, trusted=None, timeout=None):
+            scan_timeouts.append(timeout)
+            util.clock.sleep(3)  # a slow radio
+            return super().scan(trusted)
+
+        def current_ssid(self):
+            return None
+
+        def probe(self):
+            timeouts.append(self.deadline.remaining(3, floor=1))
+            return False
+
+    timeouts, scan_timeouts = [], []
+
+    class Switch(stub_switch()):
+        ifaces = {'wlan0': {}, 'wlan1': {}}
+        trusted = ['a']
+
+        def _get_iface_obj(self, iface):
+            return SlowWLan(iface, [('b', 50)])
+
+        def _probe(self, iface=None):
+            timeouts.append(self.deadline.remaining(3, floor=1))
+            util.clock.sleep(timeouts[-1])
+            return False
+
+    kw = dict(nscans=5, throttle=1, timeout=30)
+    witch = Switch([dict(kw, interface='wlan*', ssids='a'), dict(kw, interface='wlan*')], cycle_budget=20)
+    t0 = util.clock.time()
+    assert not witch.check()
+    # without the budget it would keep going for 5 rounds of slow scans
+    assert util.clock.time() - t0 <= 20 + 3
+    assert witch.scans.rounds and len(witch.scans.rounds) < 5
+    assert timeouts[-1] == 1  # the last probe only got what was left
+    # the scan command is killed at the deadline too, not after its own 30s
+    assert scan_timeouts[0] == 20 and scan_timeouts == sorted(scan_timeouts, reverse=True)
+
+    # once the budget is gone, interfaces aren't probed (the last, any interface probe still is)
+    witch.deadline = util.Deadline(0)
+    assert netswitch.NetSwitch._skip_probe(witch, 'wlan0')
+
+
+IWLIST = '''wlan0     Scan completed :
+          Cell 01 - Address: AA:AA:AA:AA:AA:01
+                    Channel:1
+                    Frequency:2.412 GHz (Channel 1)
+                    Quality=60/70  Signal level=-50 dBm
+                    ESSID:"home"
+          Cell 02 - Address: AA:AA:AA:AA:AA:02
+                    Channel:36
+                    Frequency:5.18 GHz (Channel 36)
+                    Quality=55/70  Signal level=-55 dBm
+                    ESSID:"home"
+'''
+
+
+def test_bssid_pinning(tmp_path, monkeypatch):
+    import access_points
+    from netswitch import iw, util, commands
+    aps = access_points.IwlistWifiScanner('wlan0').parse_output(IWLIST)
+    iw.tag_frequencies(aps, IWLIST)
+    assert [(ap.bssid, ap.frequency) for ap in aps] == [
+        ('AA:AA:AA:AA:AA:01', 2412), ('AA:AA:AA:AA:AA:02', 5180)]
+    assert iw.normalize_band('5GHz') == '5' and iw.band_of(2412) == '2.4'
+
+    wlan = FakeWLan('wlan0')
+    wlan._scanned(aps, util.clock.time())
+    stats = wlan.bss_stats('home')
+    assert stats['aa:aa:aa:aa:aa:02']['band'] == '5'
+
+    # the strongest radio, unless 5GHz gets a bonus
+    assert wlan._choose_pin('home', pin_bssid=True)[1] == 'aa:aa:aa:aa:aa:01'
+    assert wlan._choose_pin('home', pin_bssid=True, band=5)[1] == 'aa:aa:aa:aa:aa:02'
+    assert wlan._choose_pin('home', band='5GHz') == ({'freq_list': '5180'}, None)
+    # pinned to the 5GHz one - 60 vs 55 isn't worth moving for
+    wlan.ssid, wlan.bssid = 'home', 'aa:aa:aa:aa:aa:02'
+    assert wlan._choose_pin('home', pin_bssid=True, roam_margin=8)[1] == 'aa:aa:aa:aa:aa:02'
+    assert wlan._choose_pin('home', pin_bssid=True, roam_margin=2)[1] == 'aa:aa:aa:aa:aa:01'
+
+    # the pin goes in the installed config, not the ap's file
+    monkeypatch.setattr(netswitch.Wpa, 'ap_path', str(tmp_path / 'aps'))
+    monkeypatch.setattr(netswitch.Wpa, 'WPA_PATH', str(tmp_path / 'wpa_supplicant.conf'))
+    netswitch.generate_wpa_config('home', 'password')
+    assert netswitch.Wpa('home').install(bssid='aa:aa:aa:aa:aa:02')
+    assert 'bssid=aa:aa:aa:aa:aa:02' in netswitch.Wpa().text
+    assert 'bssid' not in netswitch.Wpa('home').text
+    assert netswitch.Wpa('home').install(bssid='aa:aa:aa:aa:aa:02') is None
+    # backing up the active config doesn't save the pin with the credentials
+    netswitch.Wpa().backup()
+    assert 'bssid' not in netswitch.Wpa('home').text and 'password' in netswitch.Wpa('home').text
+    assert netswitch.Wpa('home').install()  # unpinned
+    assert 'bssid' not in netswitch.Wpa().text
+
+    # nothing is restarted for an ap we don't have, or one that's already installed
+    fake = commands.FakeExecutor()
+    with commands.use_executor(fake):
+        assert netswitch.Wpa('nope').install() is False
+        assert not netswitch.Wpa('nope').connect()
+        assert netswitch.Wpa('home').connect()
+    assert fake.calls == []
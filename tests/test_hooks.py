@@ -0,0 +1,61 @@
+import time
+import pytest
+import netswitch
+from netswitch.hooks import Hooks
+
+
+def test_hooks():
+    hooks = Hooks(maxsize=2)
+    hooks.emit('switch', old=None, new=None)  # nobody's listening
+
+    calls = []
+    hooks.on('switch', lambda **kw: calls.append(kw), sync=True)
+    hooks.emit('switch', old=None, new=('eth0', None))
+    assert calls == [{'old': None, 'new': ('eth0', None)}]
+
+    with pytest.raises(ValueError):
+        hooks.on('nope', print)
+
+    # slow subscribers don't hold up emit, and drop events when they fall behind
+    @hooks.on('offline')
+    def slow():
+        time.sleep(0.2)
+        calls.append('slow')
+
+    t0 = time.time()
+    for _ in range(5):
+        hooks.emit('offline')
+    assert time.time() - t0 < 0.1
+    hooks.join()
+    assert calls.count('slow') < 5 and hooks.dropped
+
+    hooks.off('offline', slow)
+    hooks.emit('offline')
+    assert not hooks._queue.qsize()
+
+
+class ScriptedSwitch(netswitch.NetSwitch):
+    def __init__(self, script, *a, **kw):
+        self.script = list(script)
+        super().__init__(*a, **kw)
+
+    def _check(self):
+        self.active = self.script.pop(0)
+        return self.active is not None
+
+
+def test_netswitch_hooks():
+    witch = ScriptedSwitch([('eth0', None), ('eth0', None), None, ('wlan0', 'home')], [])
+    events = []
+    witch.on_cycle_start(lambda: events.append('cycle'), sync=True)
+    witch.on_switch(lambda old, new: events.append(('switch', old, new)), sync=True)
+    witch.on_connected(lambda active: events.append(('connected', active)), sync=True)
+    witch.on_offline(lambda: events.append('offline'), sync=True)
+    for _ in range(4):
+        witch.check()
+    assert events == [
+        'cycle', ('switch', None, ('eth0', None)), ('connected', ('eth0', None)),
+        'cycle',
+        'cycle', ('switch', ('eth0', None), None), 'offline',
+        'cycle', ('switch', None, ('wlan0', 'home')), ('connected', ('wlan0', 'home')),
+    ]
@@ -0,0 +1,95 @@
+import netswitch
+from netswitch import linkstate
+
+ROUTES = '''Iface	Destination	Gateway 	Flags	RefCnt	Use	Metric	Mask		MTU	Window	IRTT
+eth0	00000000	010200C0	0003	0	0	0	00000000	0	0	0
+eth0	000200C0	00000000	0001	0	0	0	00FFFFFF	0	0	0
+wlan0	000A0A0A	00000000	0001	0	0	0	00FFFFFF	0	0	0
+'''
+
+
+def fake_sys(tmp_path, monkeypatch, ifaces):
+    for iface, files in ifaces.items():
+        for name, value in files.items():
+            f = tmp_path / 'net' / iface / name
+            f.parent.mkdir(parents=True, exist_ok=True)
+            f.write_text(value + '\n')
+    (tmp_path / 'route').write_text(ROUTES)
+    (tmp_path / 'if_inet6').write_text(
+        'fe800000000000000000000000000001 03 40 20 80 wlan0\n'   # link local
+        '20010db8000000000000000000000001 04 40 00 80 wlan1\n')  # global
+    monkeypatch.setattr(linkstate, 'SYS_NET', str(tmp_path / 'net'))
+    monkeypatch.setattr(linkstate, 'PROC_ROUTE', str(tmp_path / 'route'))
+    (tmp_path / 'ipv6_route').write_text(
+        '00000000000000000000000000000000 00 00000000000000000000000000000000 00 '
+        'fe800000000000000000000000000001 00000400 00000001 00000000 00000003   wlan1\n'
+        '00000000000000000000000000000000 00 00000000000000000000000000000000 00 '
+        '00000000000000000000000000000000 ffffffff 00000001 00000000 00200200      lo\n')
+    monkeypatch.setattr(linkstate, 'PROC_IF_INET6', str(tmp_path / 'if_inet6'))
+    monkeypatch.setattr(linkstate, 'PROC_IPV6_ROUTE', str(tmp_path / 'ipv6_route'))
+    monkeypatch.setattr(linkstate, '_ipv4_address', lambda iface: {'eth0': '192.0.2.5'}.get(iface, ''))
+
+
+SYS = {
+    'eth0': {'flags': '0x1003', 'operstate': 'up', 'carrier': '1'},
+    'eth1': {'flags': '0x1003', 'operstate': 'down', 'carrier': '0'},
+    'wlan0': {'flags': '0x1003', 'operstate': 'down', 'carrier': '0', 'wireless/x': ''},
+    'wlan1': {'flags': '0x1003', 'operstate': 'up', 'carrier': '1', 'phy80211/rfkill3/soft': '1', 'phy80211/rfkill3/hard': '0'},
+    'usb0': {'flags': '0x1002', 'operstate': 'down'},
+}
+
+
+def test_read(tmp_path, monkeypatch):
+    fake_sys(tmp_path, monkeypatch, SYS)
+    eth0 = linkstate.read('eth0')
+    assert eth0.carrier and eth0.has_addr and eth0.default_route and not eth0.wireless
+    assert eth0.blocked is None and eth0.offline is None
+
+    assert linkstate.read('eth1').blocked == 'no carrier'
+    # not associated yet - fine to connect, but no point probing
+    wlan0 = linkstate.read('wlan0')
+    assert wlan0.wireless and wlan0.blocked is None and wlan0.offline == 'no carrier'
+    assert not wlan0.has_addr and not wlan0.default_route
+    wlan1 = linkstate.read('wlan1')
+    assert wlan1.blocked == 'rfkill blocked' and wlan1.has_addr and wlan1.default_route  # ipv6
+    assert linkstate.read('usb0').offline == 'interface is down'
+    # unknown never counts against it
+    nope = linkstate.read('ppp0')
+    assert nope.exists is False and nope.blocked is None and nope.offline is None
+    assert linkstate.default_routes() == {'eth0'}
+    assert linkstate.default_routes6() == {'wlan1'}
+
+    # an ipv6 only link still has a route
+    (tmp_path / 'route').write_text(ROUTES.splitlines()[0] + '\n')
+    assert not linkstate.snapshot().no_default_route
+    (tmp_path / 'ipv6_route').write_text('')
+    assert linkstate.snapshot().no_default_route
+
+
+def test_prechecks(tmp_path, monkeypatch, stub_switch):
+    fake_sys(tmp_path, monkeypatch, SYS)
+    connects, probes, ifups = [], [], []
+
+    class Switch(stub_switch()):
+        ifaces = {i: {'inet': None} for i in SYS}
+
+        def connect(self, iface, **kw):
+            connects.append(iface)
+            return True
+
+        def _ifup(self, iface):
+            ifups.append(iface)
+
+    snapshots = []
+    snapshot = linkstate.snapshot
+    monkeypatch.setattr(linkstate, 'snapshot', lambda: snapshots.append(1) or snapshot())
+    monkeypatch.setattr(netswitch.core, 'internet_connected', lambda iface, **kw: probes.append(iface) or iface == 'eth0')
+    witch = Switch(['wlan1', 'eth1', 'usb0', 'eth0'], restart_missing_ip=True)
+    assert witch.check() and witch.active == ('eth0', None)
+    # the routes and addresses are read once for the check, and again before each probe
+    assert len(snapshots) == 3
+    # the rfkill'd radio and unplugged cable aren't tried, and we don't bother probing a down link
+    assert connects == ['usb0', 'eth0'] and probes == ['eth0']
+    assert list(witch.scans.radios) == ['wlan0']  # wlan1 is rfkill'd, so it isn't scanned
+    # eth0 has an address even though ifcfg didn't say so
+    assert ifups == ['usb0']
@@ -0,0 +1,76 @@
+import os
+import signal
+import logging
+from netswitch import logs
+
+
+def record(msg, *args, t=0, level=logging.INFO, name='netswitch.core'):
+    r = logging.LogRecord(name, level, __file__, 1, msg, args, None)
+    r.created = t
+    return r
+
+
+def test_rate_limit():
+    f = logs.RateLimit(window=60, burst=3, per=10)
+    assert f.filter(record('Interfaces: %s', 'eth0', t=0))
+    # the same message again is dropped, until the window is up
+    assert not any(f.filter(record('Interfaces: %s', 'eth0', t=t)) for t in range(1, 50))
+    r = record('Interfaces: %s', 'eth0', t=60)
+    assert f.filter(r) and r.getMessage() == 'Interfaces: eth0 (repeated 49 times)'
+    # different messages from the same line are limited to a burst
+    assert [f.filter(record('Ping %s', i, t=100)) for i in range(5)] == [True] * 3 + [False] * 2
+    assert f.filter(record('Ping %s', 9, t=111))
+    # errors always get through
+    assert f.filter(record('Interfaces: %s', 'eth0', t=61, level=logging.ERROR))
+
+
+def test_ring_buffer(tmp_path):
+    fname = str(tmp_path / 'debug.log')
+    ring = logs.RingBuffer(capacity=3, fname=fname, min_interval=60)
+    log = logging.getLogger('netswitch.test_ring')
+    log.setLevel(logging.DEBUG)
+    log.addHandler(ring)
+    try:
+        for i in range(5):
+            log.debug('step %s', i)
+        assert [r.getMessage() for r in ring.records] == ['step 2', 'step 3', 'step 4']
+        assert not os.path.exists(fname)  # nothing written until something goes wrong
+
+        log.error('oh no')
+        text = open(fname).read()
+        assert 'step 3' in text and 'oh no' in text and 'step 1' not in text
+        assert not ring.records
+
+        log.error('again')  # too soon to write again
+        assert 'again' not in open(fname).read()
+        assert ring.dump() == fname and 'again' in open(fname).read()
+    finally:
+        log.removeHandler(ring)
+
+
+def test_dump_signal(tmp_path, monkeypatch):
+    fname = str(tmp_path / 'debug.log')
+    monkeypatch.setattr(logs, 'ring', logs.RingBuffer(fname=fname))
+    logs.ring.emit(record('hello'))
+    prev = signal.getsignal(signal.SIGUSR1)
+    try:
+        assert logs.handle_dump_signal()
+        assert logs.dump_logs(os.getpid()) == fname
+        assert 'hello' in open(fname).read()
+    finally:
+        signal.signal(signal.SIGUSR1, prev)
+
+
+def test_setup_rings_every_module(tmp_path, monkeypatch):
+    root, pkg = logging.getLogger(), logging.getLogger('netswitch')
+    handlers, level = list(root.handlers), pkg.level
+    monkeypatch.setattr(logs, 'ring', None)
+    logging.getLogger('netswitch.iw').setLevel(logging.INFO)  # a module pinning itself
+    try:
+        ring = logs.setup('WARNING', ring_file=str(tmp_path / 'debug.log'))
+        logging.getLogger('netswitch.iw').debug('scanning %s', 'wlan0')
+        assert [r.getMessage() for r in ring.records] == ['scanning wlan0']
+    finally:
+        pkg.removeHandler(logs.ring)
+        root.handlers[:] = handlers
+        pkg.setLevel(level)
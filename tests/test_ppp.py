@@ -0,0 +1,91 @@
+import netswitch
+from netswitch import util, ppp
+from netswitch.trace import VirtualClock
+
+
+class FakeDialer(ppp.Dialer):
+    link = False
+    is_registered = True
+
+    def link_up(self):
+        return self.link
+
+    def registered(self):
+        return self.is_registered
+
+
+def test_dialer(monkeypatch):
+    monkeypatch.setattr(util, 'clock', VirtualClock())
+    d = FakeDialer('ppp0', 'sleep 30', backoff=1, max_backoff=4, dial_timeout=10)
+    try:
+        # no coverage - don't dial, back off
+        d.is_registered = False
+        d.step()
+        assert d.state == 'unregistered' and d.dials == 0
+        d.step()
+        assert d.state == 'backoff'
+
+        # registered - dial once the backoff is over
+        d.is_registered = True
+        util.clock.sleep(1)
+        d.step()
+        assert d.state == 'dialing' and d.dials == 1
+        d.step()
+        assert d.state == 'dialing' and d.dials == 1
+
+        # the attempt times out -> kill it and back off (1, 2, 4, 4, ... seconds)
+        util.clock.sleep(10)
+        proc = d._proc
+        d.step()
+        assert d.state == 'backoff' and proc.poll() is not None
+        assert d._next_attempt - util.clock.time() == 2
+        util.clock.sleep(2)
+        d.step()
+        assert d.state == 'dialing' and d.dials == 2
+
+        # the link comes up, then drops -> redial right away
+        d.link = True
+        d.step()
+        assert d.state == 'up' and d.up and d.attempts == 0
+        d.link = False
+        d.step()
+        assert d.state == 'dialing' and d.dials == 3
+    finally:
+        d.stop()
+    assert d.state == 'stopped' and d._proc is None
+
+
+def test_ppp_backend_uses_dialer(monkeypatch):
+    started = []
+    monkeypatch.setattr(FakeDialer, 'start', lambda self: started.append(self.iface))
+
+    class Switch(netswitch.NetSwitch):
+        def _make_dialer(self, **kw):
+            return FakeDialer(**kw)
+
+    witch = Switch([{'interface': 'ppp*', 'dialer': 'sleep 30'}])
+    try:
+        # building a switch (or its plan, or a slice of it) doesn't bring up the modem
+        assert witch.get_plan({'ppp0': {}}).steps[0].options == {}
+        witch[:1].start()
+        assert started == []
+        witch.start()
+        witch.start()
+        assert started == ['ppp0']
+        assert not witch.connect('ppp0')
+        witch._dialers['ppp0'].link = True
+        assert witch.connect('ppp0')
+    finally:
+        witch.close()
+    assert witch._dialers == {}
+
+
+def test_creg_registered():
+    from netswitch.cell import creg_registered
+    assert creg_registered('+CREG: 0,1')
+    assert creg_registered('+CREG: 2,5,"00C3","0A3F",7')
+    assert creg_registered('+CREG: 2,1,"00C3","0A3F"')
+    assert not creg_registered('+CREG: 2,2,"00C3","0A3F",7')  # still searching
+    assert not creg_registered('+CREG: 1,0')
+    assert creg_registered('+CREG: 1,"00C3","0A3F"')  # unsolicited - no <n>
+    assert not creg_registered('ERROR')
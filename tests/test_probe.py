@@ -0,0 +1,80 @@
+import socket
+import threading
+import http.server
+import pytest
+from netswitch import probe
+
+
+@pytest.fixture
+def tcp_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    s.listen()
+    yield s.getsockname()[1]
+    s.close()
+
+
+@pytest.fixture
+def closed_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+@pytest.fixture
+def http_url():
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(204 if self.path == '/generate_204' else 200)
+            self.end_headers()
+        def log_message(self, *a):
+            pass
+    server = http.server.HTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield 'http://127.0.0.1:{}'.format(server.server_port)
+    server.shutdown()
+
+
+def test_parse():
+    assert str(probe.parse('tcp:1.1.1.1:443')) == 'tcp:1.1.1.1:443'
+    assert probe.parse('8.8.8.8').kind == 'icmp'
+    assert probe.parse('http://x/generate_204').kind == 'http'
+    with pytest.raises(ValueError):
+        probe.parse('carrier-pigeon:coop')
+
+
+def test_probes(tcp_port, closed_port, http_url):
+    assert probe.check(targets='tcp:127.0.0.1:{}'.format(tcp_port))
+    assert not probe.check(targets='tcp:127.0.0.1:{}'.format(closed_port), timeout=1)
+    assert probe.check(targets=http_url + '/generate_204')
+    assert not probe.check(targets=http_url + '/portal')  # e.g. a captive portal
+
+
+def test_quorum(tcp_port, closed_port):
+    up, down = 'tcp:127.0.0.1:{}'.format(tcp_port), 'tcp:127.0.0.1:{}'.format(closed_port)
+    assert probe.check(targets=[down, up])
+    assert probe.check(targets=[up, down, up], quorum=2)
+    assert not probe.check(targets=[up, down, down], quorum=2, timeout=1)
+
+
+def test_dns_short_reply():
+    srv = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    srv.bind(('127.0.0.1', 0))
+
+    def answer():
+        try:
+            while True:
+                _, addr = srv.recvfrom(512)
+                srv.sendto(b'\x00', addr)  # truncated
+        except OSError:  # closed
+            pass
+    threading.Thread(target=answer, daemon=True).start()
+    try:
+        target = 'dns:127.0.0.1:{}'.format(srv.getsockname()[1])
+        assert not probe._dns_ok(1, b'\x00')
+        assert not probe.check(targets=target, timeout=1)
+        assert not probe.check(targets=[target, target], quorum=2, timeout=1)
+    finally:
+        srv.close()
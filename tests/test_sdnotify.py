@@ -0,0 +1,66 @@
+import socket
+import pytest
+import netswitch
+from netswitch import sdnotify, systemctl_install, util
+from netswitch.trace import VirtualClock
+
+
+@pytest.fixture
+def notify_socket(tmp_path):
+    path = str(tmp_path / 'notify')
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.bind(path)
+    sock.settimeout(1)
+    yield path, lambda: sock.recv(4096).decode()
+    sock.close()
+
+
+def test_notifier(notify_socket):
+    path, recv = notify_socket
+    n = sdnotify.Notifier(environ={'NOTIFY_SOCKET': path, 'WATCHDOG_USEC': '30000000'})
+    assert n.enabled and n.watchdog == 30
+    assert n.cycle('Offline')
+    assert sorted(recv().splitlines()) == ['READY=1', 'STATUS=Offline', 'WATCHDOG=1']
+    n.cycle('Connected via eth0')
+    assert 'READY=1' not in recv()
+
+    # nothing to do outside of systemd, or if the watchdog is for someone else
+    assert not sdnotify.Notifier(environ={}).send(READY=1)
+    assert sdnotify.Notifier(environ={'WATCHDOG_USEC': '1', 'WATCHDOG_PID': '1'}).watchdog is None
+
+
+def test_run_notifies(notify_socket, monkeypatch):
+    path, recv = notify_socket
+    monkeypatch.setattr(util, 'clock', VirtualClock())
+    checks = iter([False, True])
+
+    class Switch(netswitch.NetSwitch):
+        def check(self):
+            try:
+                connected = next(checks)
+            except StopIteration:
+                raise KeyboardInterrupt
+            self.active = ('eth0', None) if connected else None
+            return connected
+
+    witch = Switch([])
+    witch.notifier = sdnotify.Notifier(environ={'NOTIFY_SOCKET': path, 'WATCHDOG_USEC': '10000000'})
+    with pytest.raises(KeyboardInterrupt):
+        witch.run(interval=8)
+    # systemd waits for the first check (two default check times) before it's ready
+    assert 'EXTEND_TIMEOUT_USEC=120000000' in recv()
+    assert 'READY=1' in recv()
+    assert recv() == 'WATCHDOG=1'  # kept alive while sleeping between checks
+    assert 'STATUS=Connected via eth0' in recv()
+    assert recv() == 'WATCHDOG=1'
+    witch.close()
+    assert recv() == 'STOPPING=1'
+
+
+def test_service_file():
+    body = systemctl_install.format('config.yml', interval=60)
+    assert 'Type=notify' in body and 'WatchdogSec=240' in body and 'TimeoutStartSec=120' in body
+    assert '-m netswitch run config.yml --interval 60' in body
+    # a check can't take longer than its budget
+    body = systemctl_install.format('config.yml', interval=20, cycle_budget=30)
+    assert 'WatchdogSec=100' in body and 'TimeoutStartSec=60' in body
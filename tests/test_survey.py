@@ -0,0 +1,84 @@
+import io
+import json
+import os
+from access_points import AccessPoint
+from netswitch import survey, util, iw
+from netswitch.trace import VirtualClock
+
+
+def ap(ssid, bssid, quality, frequency=None):
+    a = AccessPoint(ssid, bssid, quality, '')
+    a['frequency'] = frequency
+    return a
+
+
+def test_store_roundtrip(tmp_path):
+    store = survey.ScanStore(str(tmp_path / 'scans.bin'))
+    for t in range(10):
+        store.append('wlan0', [ap('a', '00:11:22:33:44:55', 50 + t, 2412), ap('b', None, 30)], t=t)
+    store.append('wlan1', [ap('a', '00:11:22:33:44:66', 90, 5180)], t=10)
+    store.close()
+
+    rs = list(survey.ScanStore(store.path).records())
+    assert len(rs) == 21
+    assert rs[0] == survey.Record(0, 'wlan0', '00:11:22:33:44:55', 'a', 2412, 50)
+    assert rs[1].bssid is None and rs[1].frequency is None
+
+    # time ranges are inclusive
+    assert [r.t for r in store.records(since=3, until=5, ssid='a')] == [3, 4, 5]
+    assert [r.radio for r in store.records(since=10)] == ['wlan1']
+    assert not list(store.records(ssid='nope'))
+
+    stats = store.percentiles(q=(50, 100))
+    assert stats['a'] == {'n': 11, 'p50': 55, 'p100': 90}
+    assert stats['b']['p50'] == 30
+    assert set(store.percentiles(by='radio')) == {'wlan0', 'wlan1'}
+
+
+def test_store_rotation(tmp_path):
+    store = survey.ScanStore(str(tmp_path / 'scans.bin'), max_bytes=3 * 1000, segments=3)
+    for t in range(500):
+        store.append('wlan0', [ap('a', '00:11:22:33:44:55', t % 100)], t=t)
+    store.close()
+    files = store.files()
+    assert len(files) == 3
+    assert sum(os.path.getsize(f) for f in files) <= store.max_bytes + survey.RECORD.size
+    ts = [r.t for r in store.records()]
+    assert ts == sorted(ts) and ts[-1] == 499 and ts[0] > 0  # the oldest were dropped
+
+
+def test_store_rotates_names(tmp_path):
+    store = survey.ScanStore(str(tmp_path / 'scans.bin'), max_bytes=3 * 1000, segments=3)
+    for t in range(500):
+        store.append('wlan0', [ap('ssid{}'.format(t), None, 50)], t=t)
+    store.close()
+    # names leave with the records that used them
+    names = [f + '.names' for f in store.files()]
+    assert sorted(str(p) for p in tmp_path.glob('*.names')) == sorted(names)
+    assert sum(len(survey._load_names(f)) for f in store.files()) < 200
+    assert all(r.ssid == 'ssid{}'.format(int(r.t)) for r in store.records())
+    assert [r.t for r in store.records(ssid='ssid499')] == [499]
+
+
+def test_wlan_stores_scans(tmp_path, monkeypatch):
+    monkeypatch.setattr(util, 'clock', VirtualClock())
+    store = survey.ScanStore(str(tmp_path / 'scans.bin'))
+    wlan = iw.WLan('wlan0')
+    wlan.store = store
+    wlan._scanned([ap('a', '00:11:22:33:44:55', 70)], 0)
+    assert [r.ssid for r in store.records()] == ['a']
+    # a record that doesn't fit is logged, not raised
+    wlan._scanned([ap('b', None, 70, frequency=10**6)], 0)
+    assert [r.ssid for r in store.records()] == ['a']
+
+
+def test_survey_cli(tmp_path, monkeypatch):
+    monkeypatch.setattr(util, 'clock', VirtualClock())
+    monkeypatch.setattr(iw.WLan, 'scan', lambda self, trusted=None, timeout=None: [ap('a', '00:11:22:33:44:55', 60, 2437)])
+    monkeypatch.setattr('netswitch.get_ifaces', lambda *a: {'wlan0': {}, 'wlan1': {}})
+    out = io.StringIO()
+    survey.survey(count=2, interval=1, store=str(tmp_path / 'scans.bin'), out=out)
+    lines = [json.loads(l) for l in out.getvalue().splitlines()]
+    assert len(lines) == 4 and {l['radio'] for l in lines} == {'wlan0', 'wlan1'}
+    assert lines[0]['frequency'] == 2437 and lines[0]['signal'] == 60
+    assert survey.stats(str(tmp_path / 'scans.bin'))['a']['n'] == 4
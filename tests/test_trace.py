@@ -0,0 +1,44 @@
+import netswitch
+from netswitch import trace
+
+
+def _events():
+    # home wifi is strong for the first minute, then drops out and only the
+    # cafe is around. eth0 never has internet.
+    events = [
+        {'t': 0, 'event': 'aps', 'ssids': ['home', 'cafe']},
+        {'t': 0, 'event': 'interfaces', 'interfaces': {'wlan0': {'inet': None}, 'eth0': {'inet': None}}},
+        {'t': 0, 'event': 'probe', 'iface': 'eth0', 'ok': False, 'dt': 1},
+        {'t': 0, 'event': 'probe', 'iface': 'wlan0', 'ssid': 'home', 'ok': True, 'dt': 0.5},
+        {'t': 0, 'event': 'probe', 'iface': 'wlan0', 'ssid': 'cafe', 'ok': True, 'dt': 0.5},
+        {'t': 0, 'event': 'probe', 'iface': None, 'ok': False, 'dt': 1},
+    ]
+    for t in range(0, 180, 2):
+        aps = [['home', 'aa', 70], ['cafe', 'bb', 40]] if t < 60 else [['cafe', 'bb', 40]]
+        events.append({'t': t, 'event': 'scan', 'iface': 'wlan0', 'aps': aps, 'dt': 1})
+    return events
+
+
+def test_record(tmp_path):
+    fname = str(tmp_path / 'trace.jsonl')
+    rec = trace.Trace(fname)
+    rec.write('probe', iface='eth0', ok=True, dt=0.1)
+    rec.close()
+    events = trace.load(fname)
+    assert events[0]['event'] == 'probe' and events[0]['ok']
+
+
+def test_replay():
+    t0 = netswitch.util.clock.time()
+    report = trace.simulate(_events(), ['eth*', 'wlan*'], interval=10)
+    assert netswitch.util.clock.time() - t0 < 60  # the real clock is restored
+    assert report['cycles'] > 5
+    links = [link for t, link in report['links']]
+    assert links[0] == ('wlan0', 'home') and links[-1] == ('wlan0', 'cafe')
+    assert report['switches'] == len(links) - 1
+    assert report['offline'] < 60
+    assert report['latency']['max'] >= 5  # 5 one second scans
+    assert report['wall_time'] < report['duration']
+
+    fewer = trace.simulate(_events(), [{'interface': 'wlan*', 'nscans': 1}], interval=10)
+    assert fewer['latency']['max'] < report['latency']['max']